@@ -0,0 +1,39 @@
+from time import sleep
+
+from libetrv.bluetooth import btle
+from libetrv.device import eTRVDevice
+from loguru import logger
+
+
+class eTRVAdapterDevice(eTRVDevice):
+    """eTRVDevice that connects through a selected local HCI adapter"""
+
+    def __init__(self, address, adapter: int = 0, **kwargs):
+        super().__init__(address, **kwargs)
+        self.adapter = adapter
+
+    # same as eTRVDevice.connect() but passes adapter number to bluepy
+    def connect(self, send_pin: bool = True):
+        logger.debug("Trying connect to {} via hci{}",
+                     self.address, self.adapter)
+        if self.is_connected():
+            logger.debug("Device already connected {}", self.address)
+            return
+
+        retry_limit = self.retry_limit
+
+        while retry_limit == None or retry_limit >= 0:
+            try:
+                self.ble_device = btle.Peripheral(
+                    self.address, iface=self.adapter)
+                if send_pin:
+                    self.send_pin()
+                break
+            except btle.BTLEDisconnectError:
+                logger.error(
+                    "Unable connect to {}. Retrying in 100ms", self.address)
+                if retry_limit != None:
+                    retry_limit -= 1
+                    if retry_limit < 0:
+                        raise
+                sleep(0.1)
@@ -0,0 +1,289 @@
+import asyncio
+import math
+import signal
+import threading
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import partial
+from typing import Any, Dict, List, NoReturn, Optional, Set, Type
+
+from loguru import logger
+
+from etrv2mqtt import metrics
+from etrv2mqtt.config import Config, ThermostatConfig
+from etrv2mqtt.devices import DeviceBase, DeviceManager
+from etrv2mqtt.etrvutils import eTRVData
+from etrv2mqtt.mqtt import Mqtt
+from etrv2mqtt.poller import PollingEngine
+from etrv2mqtt.presence import RadioGate
+from etrv2mqtt.scheduling import RadioOccupancy
+
+
+class AsyncDeviceAdapter():
+    """Exposes blocking DeviceBase methods as coroutines executed in a thread pool"""
+
+    def __init__(self, device: DeviceBase, adapter_slot: asyncio.Semaphore, executor: Executor,
+                 adapter: int = 0, occupancy: Optional[RadioOccupancy] = None,
+                 gate: Optional[RadioGate] = None):
+        self._device = device
+        self._gate = gate
+        self._adapter_slot = adapter_slot
+        self._executor = executor
+        self._adapter = adapter
+        self._occupancy = occupancy
+        # poll and set_temperature must not run concurrently on the same device
+        self._lock = asyncio.Lock()
+        # duration of the last operation without waiting for adapter slot
+        self.last_duration = 0.0
+
+    async def _run(self, func, *args):
+        async with self._lock:
+            async with self._adapter_slot:
+                start = time.monotonic()
+                if self._gate is not None:
+                    # waits for a running scan in the executor thread, not on the loop
+                    func = partial(self._gate.run, self._adapter, func)
+                try:
+                    return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+                finally:
+                    end = time.monotonic()
+                    self.last_duration = end - start
+                    if self._occupancy is not None:
+                        self._occupancy.record(self._adapter, start, end)
+
+    async def poll(self, mqtt: Mqtt, probe: bool = False) -> Optional[eTRVData]:
+        return await self._run(self._device.poll, mqtt, probe)
+
+    async def set_temperature(self, mqtt: Mqtt, temperature: float, refresh: bool = False,
+                              probe: bool = False) -> Optional[eTRVData]:
+        return await self._run(self._device.set_temperature, mqtt, temperature, refresh, probe)
+
+    async def apply_settings(self, settings: Dict[str, Any], probe: bool = False) -> Optional[Dict[str, Any]]:
+        return await self._run(self._device.apply_settings, settings, probe)
+
+
+class AsyncDeviceManager(DeviceManager):
+    """DeviceManager running on asyncio event loop. Polls, debounced setpoints and MQTT I/O
+    are scheduled on exact deadlines, blocking device calls run in an executor."""
+
+    def __init__(self, config: Config, deviceClass: Type[DeviceBase]):
+        # used by _add_device() called from DeviceManager constructor
+        self._async_devices: Dict[str, AsyncDeviceAdapter] = {}
+        self._executor: Optional[Executor] = None
+        super().__init__(config, deviceClass)
+        self._setpoint_timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    def poll_forever(self) -> NoReturn:
+        self._start_metrics_server()
+        self._start_presence_scan()
+        asyncio.run(self._run())
+
+    async def _run(self):
+        self._loop = asyncio.get_running_loop()
+        # set to recalculate poll deadlines, _poll_all_pending makes every device due
+        self._wakeup = asyncio.Event()
+        self._poll_all_pending = False
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=self._config.poll_workers, thread_name_prefix='etrv-poll')
+        self._adapter_slots: Dict[int, asyncio.Semaphore] = {}
+        for name in self._devices.keys():
+            self._add_async_device(name)
+
+        # MQTT callbacks are called from the event loop thread in asyncio mode
+        self._mqtt.connected_callback = self._connected_callback
+        self._install_reload_handler()
+
+        loops = [self._mqtt.run_async(), self._poll_loop()]
+        if self._config.metrics_interval > 0:
+            loops.append(self._metrics_loop())
+        if self._config.config_watch_interval > 0:
+            loops.append(self._config_watch_loop())
+        if self._coordinator is not None:
+            loops.append(self._coordination_loop())
+        if self._state_store is not None:
+            loops.append(self._state_store_loop())
+        # setpoints replayed from state store
+        self._arm_setpoint_timer()
+        await asyncio.gather(*loops)
+
+    def _create_poll_engine(self) -> Optional[PollingEngine]:
+        # device calls run on executor created with the event loop
+        return None
+
+    def _add_async_device(self, name: str):
+        adapter = self._adapters[name]
+        if adapter not in self._adapter_slots:
+            self._adapter_slots[adapter] = asyncio.Semaphore(
+                self._config.adapter_max_connections)
+        self._async_devices[name] = AsyncDeviceAdapter(
+            self._devices[name], self._adapter_slots[adapter], self._executor,
+            adapter, self._occupancy, self._radio_gate)
+
+    def _add_device(self, thermostat_config: ThermostatConfig):
+        super()._add_device(thermostat_config)
+        # devices from initial config are wrapped once event loop is running
+        if self._executor is not None:
+            self._add_async_device(thermostat_config.topic)
+
+    def _remove_device(self, name: str):
+        super()._remove_device(name)
+        self._async_devices.pop(name, None)
+
+    def _poll_added_devices(self, names: List[str]):
+        if self._poll_scheduler is not None:
+            super()._poll_added_devices(names)
+        else:
+            self._create_task(self._poll_devices_async(names))
+
+    def _request_reload(self):
+        self._reload_pending = True
+        self._wakeup.set()
+
+    def _install_reload_handler(self):
+        if hasattr(signal, 'SIGHUP') and threading.current_thread() is threading.main_thread():
+            self._loop.add_signal_handler(signal.SIGHUP, self._request_reload)
+
+    async def _config_watch_loop(self):
+        while True:
+            await asyncio.sleep(self._config.config_watch_interval)
+            self._check_config_file()
+
+    async def _coordination_loop(self):
+        while True:
+            await asyncio.sleep(1)
+            if len(self._coordinate()) > 0:
+                # next poll deadline moved closer
+                self._wakeup.set()
+
+    async def _state_store_loop(self):
+        while True:
+            await asyncio.sleep(self._config.state_store_flush_interval)
+            await self._loop.run_in_executor(None, self._state_store.flush)
+
+    def _create_task(self, coro):
+        task = self._loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _poll_devices_async(self, names: List[str]):
+        pollable = self._pollable(names)
+        results = await asyncio.gather(*(self._async_devices[name].poll(self._mqtt, probe)
+                                         for name, probe in pollable),
+                                       return_exceptions=True)
+        for (name, _), result in zip(pollable, results):
+            if isinstance(result, Exception):
+                logger.opt(exception=result).error(
+                    "Polling {} failed", name)
+                result = None
+            self._record_reading(name, result,
+                                 self._async_devices[name].last_duration)
+
+    async def _poll_loop(self):
+        deadline = time.monotonic()
+        while True:
+            timeout: Optional[float] = None
+            if self._mqtt.is_connected():
+                if self._poll_scheduler is not None:
+                    deadline = self._poll_scheduler.next_deadline() or math.inf
+                timeout = max(0, deadline - time.monotonic())
+                if math.isinf(timeout):
+                    timeout = None
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            if self._reload_pending:
+                self._reload_pending = False
+                self.reload_config()
+
+            if self._poll_all_pending:
+                self._poll_all_pending = False
+                self._poll_all_requested()
+                deadline = time.monotonic()
+
+            if not self._mqtt.is_connected():
+                continue
+
+            now = time.monotonic()
+            if now >= deadline:
+                metrics.scheduler_lag_seconds.observe(now - deadline)
+
+            if self._poll_scheduler is not None:
+                await self._poll_devices_async(self._poll_scheduler.pop_due())
+            elif now >= deadline:
+                deadline = time.monotonic() + self._config.poll_interval
+                await self._poll_devices_async(list(self._async_devices.keys()))
+
+    async def _metrics_loop(self):
+        while True:
+            await asyncio.sleep(self._config.metrics_interval)
+            self._mqtt.publish_metrics()
+
+    async def _set_temperature_task(self, name: str, temperature: float):
+        refresh = self._poll_scheduler is not None and self._poll_scheduler.due_within(
+            name, self._config.setpoint_debounce_time)
+        try:
+            reading = await self._async_devices[name].set_temperature(
+                self._mqtt, temperature, refresh, self._write_is_probe(name))
+        except Exception as e:
+            logger.opt(exception=e).error("Setting {} failed", name)
+            reading = None
+        self._record_write(name, temperature, reading)
+
+    async def _apply_settings_task(self, name: str, requested: Dict[str, Any]):
+        error: Optional[str] = None
+        try:
+            settings = await self._async_devices[name].apply_settings(
+                requested, self._write_is_probe(name))
+        except (ValueError, OverflowError) as e:
+            logger.error("Writing settings to {} failed: {}", name, e)
+            settings, error = None, str(e)
+        except Exception as e:
+            logger.opt(exception=e).error("Writing settings to {} failed", name)
+            settings = None
+        self._settings_applied(name, requested, settings, error)
+
+    def _queue_settings(self, requests: Dict[str, Any]):
+        super()._queue_settings(requests)
+        # written right away instead of on the next pass of a poll loop
+        self._run_pending_settings()
+
+    def _run_pending_settings(self):
+        for name, requested in self._settings.pop_pending():
+            if name in self._async_devices:
+                self._create_task(self._apply_settings_task(name, requested))
+
+    def _arm_setpoint_timer(self):
+        deadline = self._setpoint_queue.next_deadline()
+        if self._setpoint_timer is None and deadline is not None:
+            self._setpoint_timer = self._loop.call_later(
+                max(0, deadline - time.monotonic()), self._start_due_setpoints)
+
+    def _start_due_setpoints(self):
+        self._setpoint_timer = None
+        for name, temperature in self._due_setpoints():
+            self._create_task(self._set_temperature_task(name, temperature))
+        self._arm_setpoint_timer()
+
+    def _set_temperature_callback(self, mqtt: Mqtt, name: str, temperature: float):
+        super()._set_temperature_callback(mqtt, name, temperature)
+        self._arm_setpoint_timer()
+        if self._poll_scheduler is not None:
+            # next poll deadline may have moved closer
+            self._wakeup.set()
+
+    def _request_poll_all(self):
+        self._poll_all_pending = True
+        self._wakeup.set()
+
+    def _connected_callback(self, mqtt: Mqtt):
+        self._request_poll_all()
+
+    def _hass_birth_callback(self, mqtt: Mqtt):
+        self._refresh_all_fields()
+        self._request_poll_all()
@@ -1,6 +1,8 @@
 import copy
 import json
 from dataclasses import dataclass
+from types import MappingProxyType
+from typing import AbstractSet, Dict, Mapping, Optional
 from etrv2mqtt.config import Config
 
 
@@ -31,9 +33,8 @@ class Autodiscovery():
             "manufacturer": "Danfoss",
             "model": "eTRV"
         },
-        "availability_topic": "etrv2mqtt/state",
-        "payload_available": "online",
-        "payload_not_available": "offline"
+        "availability": [],
+        "availability_mode": "all"
     }
     """)
 
@@ -50,9 +51,8 @@ class Autodiscovery():
             "manufacturer": "Danfoss",
             "model": "eTRV"
         },
-        "availability_topic": "etrv2mqtt/state",
-        "payload_available": "online",
-        "payload_not_available": "offline"
+        "availability": [],
+        "availability_mode": "all"
     }
     """)
 
@@ -67,9 +67,8 @@ class Autodiscovery():
             "manufacturer": "Danfoss",
             "model": "eTRV"
         },
-        "availability_topic": "etrv2mqtt/state",
-        "payload_available": "online",
-        "payload_not_available": "offline"
+        "availability": [],
+        "availability_mode": "all"
     }
     """)
 
@@ -86,9 +85,8 @@ class Autodiscovery():
             "manufacturer": "Danfoss",
             "model": "eTRV"
         },
-        "availability_topic": "etrv2mqtt/state",
-        "payload_available": "online",
-        "payload_not_available": "offline"
+        "availability": [],
+        "availability_mode": "all"
     }
     """)
 
@@ -104,9 +102,49 @@ class Autodiscovery():
             "manufacturer": "Danfoss",
             "model": "eTRV"
         },
-        "availability_topic": "etrv2mqtt/state",
-        "payload_available": "online",
-        "payload_not_available": "offline"
+        "availability": [],
+        "availability_mode": "all"
+    }
+    """)
+
+    _zone_template = json.loads("""
+    {
+        "~": "etrv/ground_floor",
+        "name":"Ground floor",
+        "unique_id":"etrv_ground_floor_zone",
+        "temp_cmd_t":"~/set",
+        "temp_stat_t":"~/state",
+        "temp_stat_tpl":"{{ value_json.set_point }}",
+        "curr_temp_t":"~/state",
+        "curr_temp_tpl":"{{ value_json.room_temp }}",
+        "min_temp":"10",
+        "max_temp":"40",
+        "temp_step":"0.5",
+        "modes":["heat"],
+        "device": {
+            "identifiers":"etrv_ground_floor_zone",
+            "manufacturer": "Danfoss",
+            "model": "eTRV zone"
+        },
+        "availability": []
+    }
+    """)
+
+    _rssi_template = json.loads("""
+    {
+        "device_class": "signal_strength",
+        "name": "kitchen signal strength",
+        "unique_id":"0000_rssi",
+        "state_topic": "etrv/kitchen/rssi",
+        "unit_of_measurement": "dBm",
+        "entity_category": "diagnostic",
+        "device": {
+            "identifiers":"0000",
+            "manufacturer": "Danfoss",
+            "model": "eTRV"
+        },
+        "availability": [],
+        "availability_mode": "all"
     }
     """)
 
@@ -129,7 +167,11 @@ class Autodiscovery():
             ':', '_')+'_'+sensor_name.lower().replace(' ', '_')
         payload['device']['name'] = dev_name
         payload['device']['identifiers'] = dev_mac
-        payload['availability_topic'] = self._config.mqtt.base_topic + "/state"
+        # entity is available while both bridge and thermostat are
+        payload['availability'] = [
+            {'topic': self._config.availability_topic},
+            {'topic': self._config.device_availability_topic(dev_name)},
+        ]
         return payload
 
     def register_termostat(self, dev_name: str, dev_mac: str) -> AutodiscoveryResult:
@@ -193,3 +235,66 @@ class Autodiscovery():
             'state'
         ))
         return AutodiscoveryResult(autodiscovery_topic, payload=json.dumps(autodiscovery_msg))
+
+    def register_rssi(self, dev_name: str, dev_mac: str) -> AutodiscoveryResult:
+        autodiscovery_topic = self._autodiscovery_topic(
+            dev_mac, 'sensor', 'rssi')
+
+        autodiscovery_msg = self._autodiscovery_payload(
+            self._rssi_template, dev_mac, dev_name, "Signal strength")
+        autodiscovery_msg['state_topic'] = '/'.join((
+            self._config.mqtt.base_topic,
+            dev_name,
+            'rssi'
+        ))
+        return AutodiscoveryResult(autodiscovery_topic, payload=json.dumps(autodiscovery_msg))
+
+    def register_thermostat_entities(self, dev_name: str, dev_mac: str) -> Dict[str, bytes]:
+        results = [
+            self.register_termostat(dev_name, dev_mac),
+            self.register_battery(dev_name, dev_mac),
+            self.register_reported_name(dev_name, dev_mac),
+        ]
+        if self._config.report_room_temperature:
+            results.append(self.register_room_temperature(dev_name, dev_mac))
+        results.append(self.register_last_update_timestamp(dev_name, dev_mac))
+        if self._config.presence_scan:
+            results.append(self.register_rssi(dev_name, dev_mac))
+
+        return {result.topic: result.payload.encode('utf-8') for result in results}
+
+    def register_zone(self, zone_name: str) -> AutodiscoveryResult:
+        zone_id = self._config.mqtt.base_topic + '_' + zone_name + '_zone'
+        autodiscovery_topic = '/'.join((
+            self._config.mqtt.autodiscovery_topic,
+            'climate',
+            self._config.mqtt.base_topic,
+            zone_name + '_zone',
+            'config'
+        ))
+
+        autodiscovery_msg = copy.deepcopy(self._zone_template)
+        autodiscovery_msg['~'] = self._config.mqtt.base_topic+'/'+zone_name
+        autodiscovery_msg['name'] = zone_name
+        autodiscovery_msg['unique_id'] = zone_id
+        autodiscovery_msg['device']['identifiers'] = zone_id
+        autodiscovery_msg['device']['name'] = zone_name
+        autodiscovery_msg['availability'] = [
+            {'topic': self._config.availability_topic}]
+        return AutodiscoveryResult(autodiscovery_topic, payload=json.dumps(autodiscovery_msg))
+
+    def payloads(self, names: Optional[AbstractSet[str]] = None) -> Mapping[str, bytes]:
+        """Read-only autodiscovery topic -> payload map for configured thermostats, all of them if names is None"""
+        payloads: Dict[str, bytes] = {}
+        for thermostat in self._config.thermostats.values():
+            if names is not None and thermostat.topic not in names:
+                continue
+            payloads.update(self.register_thermostat_entities(
+                thermostat.topic, thermostat.address))
+        for zone in self._config.zones.values():
+            # announced by whoever publishes zone state, handler of the first thermostat
+            first = zone.thermostats[0]
+            if first in self._config.thermostats and (names is None or first in names):
+                result = self.register_zone(zone.topic)
+                payloads[result.topic] = result.payload.encode('utf-8')
+        return MappingProxyType(payloads)
@@ -2,18 +2,28 @@ import sys
 
 from loguru import logger
 
-from etrv2mqtt.config import Config
-from etrv2mqtt.devices import DeviceManager, TRVDevice
+from etrv2mqtt.config import Config, default_cache_dir
 
 
 def main(config_file: str):
     try:
-        config = Config(config_file)
+        config = Config(config_file, cache_dir=default_cache_dir())
     except Exception as e:
         logger.error(e)
         sys.exit(1)
 
-    deviceManager = DeviceManager(config, TRVDevice)
+    # imported after config is loaded so only the selected event loop is initialized
+    from etrv2mqtt.devices import DeviceManager, TRVDevice
+    if config.shards > 1:
+        from etrv2mqtt.supervisor import ShardSupervisor
+        ShardSupervisor(config, TRVDevice).run()
+        return
+
+    if config.event_loop == 'asyncio':
+        from etrv2mqtt.aio import AsyncDeviceManager
+        deviceManager = AsyncDeviceManager(config, TRVDevice)
+    else:
+        deviceManager = DeviceManager(config, TRVDevice)
     deviceManager.poll_forever()
 
 
@@ -0,0 +1,96 @@
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+
+class SetpointQueue():
+    """Per-device queue of requested setpoints. Requests for the same device
+    arriving within debounce_time of each other are merged into one write
+    of the latest value."""
+
+    def __init__(self, debounce_time: float):
+        self._debounce_time = debounce_time
+        self._lock = threading.Lock()
+        # name -> (temperature, deadline)
+        self._pending: Dict[str, Tuple[float, float]] = {}
+
+    def put(self, name: str, temperature: float, now: Optional[float] = None) -> bool:
+        """Queues setpoint, returns True if it replaced a pending one"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            replaced = name in self._pending
+            self._pending[name] = (temperature, now + self._debounce_time)
+            return replaced
+
+    def discard(self, name: str):
+        with self._lock:
+            self._pending.pop(name, None)
+
+    def pending(self, name: str) -> Optional[float]:
+        with self._lock:
+            entry = self._pending.get(name)
+            return entry[0] if entry is not None else None
+
+    def next_deadline(self) -> Optional[float]:
+        with self._lock:
+            return min((deadline for _, deadline in self._pending.values()), default=None)
+
+    def pop_due(self, now: Optional[float] = None) -> List[Tuple[str, float]]:
+        """Returns (name, temperature) of every setpoint whose debounce time has passed"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            due = [(name, temperature) for name, (temperature, deadline) in self._pending.items()
+                   if deadline <= now]
+            for name, _ in due:
+                del self._pending[name]
+            return due
+
+
+CommandHandler = Callable[[str, bytes, bool], None]
+THERMOSTAT = 'thermostat'
+ZONE = 'zone'
+
+
+class CommandRouter():
+    """Maps <base_topic>/<target>/<command> topics to (target, handler) with a single dict
+    lookup, targets are thermostats or zones. Table is rebuilt when targets or commands change."""
+
+    def __init__(self, base_topic: str):
+        self._prefix = base_topic + '/'
+        # kind -> target names and kind -> command -> handler
+        self._targets: Dict[str, List[str]] = {THERMOSTAT: [], ZONE: []}
+        self._commands: Dict[str, Dict[str, CommandHandler]] = {
+            THERMOSTAT: {}, ZONE: {}}
+        self._routes: Dict[str, Tuple[str, CommandHandler]] = {}
+
+    def _rebuild(self):
+        # replaced at once, route() may run on another thread
+        self._routes = {self._prefix + name + '/' + command: (name, handler)
+                        for kind, names in self._targets.items() for name in names
+                        for command, handler in self._commands[kind].items()}
+
+    def register(self, command: str, handler: CommandHandler, kind: str = THERMOSTAT):
+        """handler(target, payload, retain) is called for messages on <base_topic>/<target>/<command>"""
+        self._commands[kind][command] = handler
+        self._rebuild()
+
+    def set_targets(self, names: Iterable[str], kind: str = THERMOSTAT):
+        self._targets[kind] = list(names)
+        self._rebuild()
+
+    def route(self, topic: str) -> Optional[Tuple[str, CommandHandler]]:
+        return self._routes.get(topic)
+
+    def unknown_thermostat(self, topic: str) -> Optional[str]:
+        """Thermostat name if topic is a command to a thermostat not in config"""
+        if not topic.startswith(self._prefix):
+            return None
+        parts = topic[len(self._prefix):].split('/', 1)
+        return parts[0] if len(parts) == 2 and parts[1] in self._commands[THERMOSTAT] else None
+
+    def topic_filters(self, per_target: bool = False) -> List[str]:
+        """Subscriptions for registered commands, per_target lists only configured targets"""
+        if per_target:
+            return list(self._routes.keys())
+        return list(dict.fromkeys(self._prefix + '+/' + command
+                                  for commands in self._commands.values() for command in commands.keys()))
@@ -1,9 +1,12 @@
+import hashlib
 import json
-from dataclasses import dataclass
+import os
+import socket
+from dataclasses import dataclass, field
 from importlib import resources as importlib_resources
 
-from jsonschema import validate, Draft7Validator, validators
-from typing import Dict, Optional
+from loguru import logger
+from typing import Dict, List, Optional
 
 
 @dataclass
@@ -11,6 +14,17 @@ class ThermostatConfig:
     topic: str
     address: str
     secret_key: str
+    adapter: int = 0
+    # adapter was not set in config but picked round-robin
+    auto_adapter: bool = field(default=False, compare=False)
+
+
+@dataclass
+class ZoneConfig:
+    topic: str
+    thermostats: List[str]
+    # mean or min
+    room_temp: str = 'mean'
 
 
 @dataclass
@@ -25,11 +39,29 @@ class _MQTTConfig:
     autodiscovery_retain: bool
     hass_birth_topic: str
     hass_birth_payload: str
+    queue_size: int
+    queue_full_policy: str
+    queue_block_timeout: float
+    flush_batch_size: int
+
+
+@dataclass
+class _SimulationConfig:
+    connect_latency: float
+    operation_latency: float
+    latency_jitter: float
+    connect_failure_rate: float
+    drop_rate: float
+    adapter_slots: int
+    battery_drain: float
+    seed: int
 
 # from https://python-jsonschema.readthedocs.io/en/stable/faq/#why-doesn-t-my-schema-s-default-property-set-the-default-on-my-instance
 
 
 def extend_with_default(validator_class):
+    from jsonschema import validators
+
     validate_properties = validator_class.VALIDATORS["properties"]
 
     def set_defaults(validator, properties, instance, schema):
@@ -47,17 +79,68 @@ def extend_with_default(validator_class):
     )
 
 
-class Config:
-    def __init__(self, filename: str):
-        _config_schema = json.load(importlib_resources.open_text(
-            'etrv2mqtt.schemas', 'config.schema.json'))
+def default_cache_dir() -> str:
+    return os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'etrv2mqtt')
+
+
+def _validate(config_json: dict, config_schema: dict):
+    # jsonschema is slow to import, it's only needed when there is no cached validation result
+    from jsonschema import Draft7Validator
+
+    # apply config schema defaults if values are missing
+    DefaultValidatingDraft7Validator = extend_with_default(Draft7Validator)
+    DefaultValidatingDraft7Validator(config_schema).validate(config_json)
+
+
+def _load_validated(filename: str, cache_dir: Optional[str]) -> dict:
+    """Returns validated config with schema defaults applied. Result is cached in cache_dir
+    under hash of config file and schema, so unchanged config is validated only once."""
+    schema_raw = importlib_resources.read_binary(
+        'etrv2mqtt.schemas', 'config.schema.json')
+    with open(filename, 'rb') as configfile:
+        config_raw = configfile.read()
 
-        with open(filename, 'r') as configfile:
-            _config_json = json.load(configfile)
+    cache_file: Optional[str] = None
+    if cache_dir is not None:
+        digest = hashlib.sha256(schema_raw + b'\0' + config_raw).hexdigest()
+        cache_file = os.path.join(cache_dir, 'config-' + digest + '.json')
+        try:
+            with open(cache_file, 'r') as cached:
+                logger.debug("Using validated config from {}", cache_file)
+                return json.load(cached)
+        except (OSError, ValueError):
+            pass
 
-        # apply config schema defaults if values are missing
-        DefaultValidatingDraft7Validator = extend_with_default(Draft7Validator)
-        DefaultValidatingDraft7Validator(_config_schema).validate(_config_json)
+    config_json = json.loads(config_raw)
+    _validate(config_json, json.loads(schema_raw))
+
+    if cache_file is not None:
+        try:
+            # config holds secrets, keep it private like the original should be.
+            # Directory may have been created world-readable by an older version.
+            os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+            os.chmod(cache_dir, 0o700)
+            tmp_file = cache_file + '.' + str(os.getpid())
+            with os.fdopen(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as cached:
+                json.dump(config_json, cached)
+            os.replace(tmp_file, cache_file)
+            # previous versions of config are never read again
+            for entry in os.listdir(cache_dir):
+                if entry.startswith('config-') and entry.endswith('.json') and \
+                        entry != os.path.basename(cache_file):
+                    os.remove(os.path.join(cache_dir, entry))
+        except OSError as e:
+            logger.debug("Unable to cache validated config: {}", e)
+
+    return config_json
+
+
+class Config:
+    def __init__(self, filename: str, cache_dir: Optional[str] = None):
+        """cache_dir enables caching of validated config, see default_cache_dir()"""
+        self.filename = filename
+        self.cache_dir = cache_dir
+        _config_json = _load_validated(filename, cache_dir)
 
         self.mqtt = _MQTTConfig(
             _config_json['mqtt']['server'],
@@ -72,20 +155,130 @@ class Config:
             _config_json['mqtt']['autodiscovery_retain'],
             _config_json['mqtt']['hass_birth_topic'],
             _config_json['mqtt']['hass_birth_payload'],
+            _config_json['mqtt']['queue_size'],
+            _config_json['mqtt']['queue_full_policy'],
+            _config_json['mqtt']['queue_block_timeout'],
+            _config_json['mqtt']['flush_batch_size'],
         )
         self.retry_limit: int = _config_json['options']['retry_limit']
         self.poll_interval: int = _config_json['options']['poll_interval']
         self.stay_connected: bool = _config_json['options']['stay_connected']
         self.report_room_temperature: bool = _config_json['options']['report_room_temperature']
         self.setpoint_debounce_time: int = _config_json['options']['setpoint_debounce_time']
+        self.poll_workers: int = _config_json['options']['poll_workers']
+        self.adapters: List[int] = _config_json['options']['adapters']
+        self.adapter_max_connections: int = _config_json['options']['adapter_max_connections']
+        self.event_loop: str = _config_json['options']['event_loop']
+        self.max_connections: int = _config_json['options']['max_connections']
+        self.connection_idle_timeout: int = _config_json['options']['connection_idle_timeout']
+        self.adaptive_polling: bool = _config_json['options']['adaptive_polling']
+        self.min_poll_interval: int = min(
+            _config_json['options']['min_poll_interval'], self.poll_interval)
+        self.poll_change_threshold: float = _config_json['options']['poll_change_threshold']
+        self.suppress_unchanged_state: bool = _config_json['options']['suppress_unchanged_state']
+        self.room_temp_deadband: float = _config_json['options']['room_temp_deadband']
+        self.battery_deadband: int = _config_json['options']['battery_deadband']
+        self.state_max_silence: int = _config_json['options']['state_max_silence']
+        self.state_heartbeat: bool = _config_json['options']['state_heartbeat']
+        self.metrics_port: int = _config_json['options']['metrics_port']
+        self.metrics_bind_address: str = _config_json['options']['metrics_bind_address']
+        self.metrics_interval: int = _config_json['options']['metrics_interval']
+        self.config_watch_interval: int = _config_json['options']['config_watch_interval']
+        self.shards: int = _config_json['options']['shards']
+        self.coordination: bool = _config_json['options']['coordination']
+        self.node_id: str = _config_json['options']['node_id'] or socket.gethostname()
+        self.lease_time: int = _config_json['options']['lease_time']
+        self.takeover_margin: float = _config_json['options']['takeover_margin']
+        self.release_after_failures: int = _config_json['options']['release_after_failures']
+        self.breaker_failures: int = _config_json['options']['breaker_failures']
+        self.breaker_backoff: int = _config_json['options']['breaker_backoff']
+        self.breaker_max_backoff: int = max(
+            _config_json['options']['breaker_max_backoff'], self.breaker_backoff)
+        self.probe_retry_limit: int = _config_json['options']['probe_retry_limit']
+        self.state_store: Optional[str] = _config_json['options']['state_store'] or None
+        self.state_store_flush_interval: int = _config_json['options']['state_store_flush_interval']
+        self.state_store_retention: int = _config_json['options']['state_store_retention']
+        self.history_size: int = _config_json['options']['history_size']
+        self.name_refresh_interval: int = _config_json['options']['name_refresh_interval']
+        self.battery_refresh_interval: int = _config_json['options']['battery_refresh_interval']
+        self.presence_scan: bool = _config_json['options']['presence_scan']
+        self.presence_timeout: int = _config_json['options']['presence_timeout']
+        self.poll_spread: bool = _config_json['options']['poll_spread']
+        self.catchup_poll_rate: float = _config_json['options']['catchup_poll_rate']
+        self.transport: str = _config_json['options']['transport']
+        self.simulation = _SimulationConfig(
+            _config_json['simulation']['connect_latency'],
+            _config_json['simulation']['operation_latency'],
+            _config_json['simulation']['latency_jitter'],
+            _config_json['simulation']['connect_failure_rate'],
+            _config_json['simulation']['drop_rate'],
+            _config_json['simulation']['adapter_slots'],
+            _config_json['simulation']['battery_drain'],
+            _config_json['simulation']['seed'],
+        )
+        # worker number in sharded mode, see select_shard()
+        self.shard: Optional[int] = None
         self.thermostats: Dict[str, ThermostatConfig] = {}
 
-        for t in _config_json['thermostats']:
+        for i, t in enumerate(_config_json['thermostats']):
             if t['topic'] in self.thermostats.keys():
                 raise ValueError("Duplicate thermostat topic: "+t['topic'])
 
             self.thermostats[t['topic']] = ThermostatConfig(
                 t['topic'],
                 t['address'],
-                t['secret_key']
+                t['secret_key'],
+                # spread devices without explicit adapter evenly across all adapters
+                t['adapter'] if 'adapter' in t.keys(
+                ) else self.adapters[i % len(self.adapters)],
+                'adapter' not in t.keys()
             )
+
+        self.zones: Dict[str, ZoneConfig] = {}
+        for z in _config_json['zones']:
+            if z['topic'] in self.thermostats.keys() or z['topic'] in self.zones.keys():
+                raise ValueError("Duplicate zone topic: "+z['topic'])
+            for name in z['thermostats']:
+                if name not in self.thermostats.keys():
+                    raise ValueError("Zone {} has unknown thermostat {}".format(
+                        z['topic'], name))
+            self.zones[z['topic']] = ZoneConfig(
+                z['topic'], list(dict.fromkeys(z['thermostats'])), z['room_temp'])
+
+        if self.shards > 1:
+            # a worker without adapter would sit idle while another one gets its thermostats
+            adapters = sorted({t.adapter for t in self.thermostats.values()})
+            if len({adapter % self.shards for adapter in adapters}) < self.shards:
+                raise ValueError("{} shards need thermostats on at least as many adapters, "
+                                 "adapters in use: {}".format(self.shards, adapters))
+
+    def shard_of(self, thermostat: ThermostatConfig) -> int:
+        """Worker handling thermostat in sharded mode, each adapter belongs to one worker"""
+        return thermostat.adapter % self.shards
+
+    def select_shard(self, shard: int):
+        """Keeps only thermostats handled by given worker of sharded bridge"""
+        self.shard = shard
+        self.thermostats = {name: thermostat for name, thermostat in self.thermostats.items()
+                            if self.shard_of(thermostat) == shard}
+
+    @property
+    def node_name(self) -> str:
+        """Node name in coordination mode, workers of sharded bridge are separate nodes"""
+        if self.shard is None:
+            return self.node_id
+        return self.node_id + '-' + str(self.shard)
+
+    def device_availability_topic(self, name: str) -> str:
+        """Availability of a single thermostat, unavailable while it is unreachable"""
+        return self.mqtt.base_topic + '/' + name + '/availability'
+
+    @property
+    def availability_topic(self) -> str:
+        if self.coordination:
+            # thermostats are announced with availability of the node owning them
+            return self.mqtt.base_topic + '/_nodes/' + self.node_name + '/state'
+        if self.shard is None:
+            return self.mqtt.base_topic + '/state'
+        # every worker has its own last will
+        return self.mqtt.base_topic + '/_shards/' + str(self.shard) + '/state'
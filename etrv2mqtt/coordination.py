@@ -0,0 +1,253 @@
+import json
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from loguru import logger
+
+from etrv2mqtt import metrics
+from etrv2mqtt.config import Config
+from etrv2mqtt.mqtt import Mqtt
+
+
+@dataclass
+class _Claim():
+    node: str
+    # owner's poll latency, lower is better
+    score: Optional[float]
+    # when ownership of this node started and when claim was last renewed, local monotonic time
+    since: float
+    seen: float
+    # node took the thermostat over from another node that may still be accessing it
+    takeover: bool
+
+
+class DeviceCoordinator():
+    """Splits thermostats between bridge nodes sharing one MQTT server.
+
+    Every node publishes retained claims to <base_topic>/_claims/<thermostat> and the
+    last claim delivered by the server wins, all nodes see claims in the same order.
+    Owner renews its claims and starts accessing a thermostat only after the claim settled,
+    node taking over from another one waits a whole lease so the previous owner has
+    stopped by then. Claims of nodes whose last will fired are free to take."""
+
+    # renewals per lease
+    RENEWALS = 3
+    # claim of a free thermostat settles after this many seconds unless someone else claimed it later
+    SETTLE_TIME = 2.0
+    # latency measured this long ago is not used to prefer a node
+    SCORE_MAX_AGE_LEASES = 20
+    # weight of the latest sample in latency average
+    SCORE_SMOOTHING = 0.3
+
+    def __init__(self, config: Config, mqtt: Mqtt, names: Iterable[str]):
+        self._mqtt = mqtt
+        self._node = config.node_name
+        self._lease_time = float(config.lease_time)
+        self._takeover_margin = config.takeover_margin
+        self._release_after_failures = config.release_after_failures
+        self._claim_prefix = config.mqtt.base_topic + '/_claims/'
+        self._node_prefix = config.mqtt.base_topic + '/_nodes/'
+
+        self._lock = threading.Lock()
+        self._devices: Set[str] = set(names)
+        self._claims: Dict[str, _Claim] = {}
+        self._offline_nodes: Set[str] = set()
+        self._online_nodes: Set[str] = set()
+        # name -> (latency average, measured at)
+        self._scores: Dict[str, Tuple[float, float]] = {}
+        self._failures: Dict[str, int] = {}
+        self._free_since: Dict[str, float] = {}
+        self._claimed_at: Dict[str, float] = {}
+        self._renewed_at: Dict[str, float] = {}
+        # no claims by this node until then, set after releasing a failing thermostat
+        self._backoff_until: Dict[str, float] = {}
+        self._owned: Set[str] = set()
+
+        mqtt.add_handler(self._claim_prefix + '+', self._on_claim)
+        mqtt.add_handler(self._node_prefix + '+/state', self._on_node_state)
+        metrics.coordination_owned_devices.set_function(lambda: len(self._owned))
+
+    def _on_claim(self, topic: str, payload: bytes, retain: bool):
+        name = topic[len(self._claim_prefix):]
+        now = time.monotonic()
+        with self._lock:
+            previous = self._claims.get(name)
+            if len(payload) == 0:
+                # released
+                self._claims.pop(name, None)
+                return
+            try:
+                claim = json.loads(payload)
+                node = str(claim['node'])
+                score = claim.get('score')
+            except (ValueError, KeyError, TypeError):
+                logger.warning("Invalid claim of {}: {}", name, payload)
+                return
+            if previous is not None and previous.node == node:
+                previous.score = score
+                previous.seen = now
+                return
+            if previous is not None and previous.node == self._node:
+                logger.info("{} was claimed by node {}", name, node)
+                metrics.coordination_events_total.labels('lost').inc()
+            self._claims[name] = _Claim(node, score, now, now,
+                                        previous is not None)
+
+    def _on_node_state(self, topic: str, payload: bytes, retain: bool):
+        node = topic[len(self._node_prefix):-len('/state')]
+        with self._lock:
+            if payload == b'offline':
+                if node not in self._offline_nodes:
+                    logger.info("Node {} went offline", node)
+                self._offline_nodes.add(node)
+                self._online_nodes.discard(node)
+            else:
+                self._offline_nodes.discard(node)
+                self._online_nodes.add(node)
+
+    def _score(self, name: str, now: float) -> Optional[float]:
+        # must be called with self._lock held
+        if name not in self._scores:
+            return None
+        score, measured_at = self._scores[name]
+        if now - measured_at > self._lease_time * self.SCORE_MAX_AGE_LEASES:
+            return None
+        return score
+
+    def _is_free(self, claim: Optional[_Claim], now: float) -> bool:
+        return claim is None or claim.node in self._offline_nodes or \
+            now - claim.seen >= self._lease_time
+
+    def _owns(self, name: str, now: float) -> bool:
+        # must be called with self._lock held
+        claim = self._claims.get(name)
+        if claim is None or claim.node != self._node or now - claim.seen >= self._lease_time:
+            return False
+        settle_time = self._lease_time if claim.takeover else self.SETTLE_TIME
+        return now - claim.since >= settle_time
+
+    def owns(self, name: str) -> bool:
+        """True if this node may access the thermostat now"""
+        if not self._mqtt.is_connected():
+            return False
+        with self._lock:
+            return self._owns(name, time.monotonic())
+
+    def claiming(self, name: str) -> bool:
+        """True if this node holds the latest claim, it may not have settled yet"""
+        with self._lock:
+            claim = self._claims.get(name)
+            return claim is not None and claim.node == self._node
+
+    def record_result(self, name: str, duration: Optional[float], success: bool):
+        """Records outcome of a device operation, duration of successful polls is the node's score"""
+        now = time.monotonic()
+        with self._lock:
+            if not success:
+                self._failures[name] = self._failures.get(name, 0) + 1
+                return
+            self._failures[name] = 0
+            if duration is None:
+                return
+            score = self._score(name, now)
+            if score is not None:
+                duration = score + \
+                    (duration - score) * self.SCORE_SMOOTHING
+            self._scores[name] = (duration, now)
+
+    def set_devices(self, names: Iterable[str]):
+        """Thermostats changed with config reload, claims of removed ones are released"""
+        with self._lock:
+            self._devices = set(names)
+            removed = [name for name, claim in self._claims.items()
+                       if name not in self._devices and claim.node == self._node]
+        for name in removed:
+            self._release(name)
+
+    def _claim_delay(self, name: str, score: Optional[float], held: int) -> float:
+        # must be called with self._lock held
+        # nodes with a known latency claim first and nodes holding more than their share
+        # of thermostats last, the rest spreads thermostats pseudo-randomly
+        jitter = zlib.crc32((self._node + '/' + name).encode()) / 2**32
+        excess = held - len(self._devices) / max(1, len(self._online_nodes))
+        return self.SETTLE_TIME * (jitter + (0 if score is not None else 1) + max(0.0, excess))
+
+    def _publish_claim(self, name: str, score: Optional[float], now: float):
+        self._mqtt.publish(self._claim_prefix + name,
+                           json.dumps({'node': self._node, 'score': score}), retain=True)
+        self._renewed_at[name] = now
+
+    def _release(self, name: str):
+        self._mqtt.publish(self._claim_prefix + name, b'', retain=True)
+        metrics.coordination_events_total.labels('released').inc()
+
+    def tick(self) -> List[str]:
+        """Renews, releases and makes claims, returns thermostats this node just became owner of"""
+        if not self._mqtt.is_connected():
+            return []
+        now = time.monotonic()
+        claims: Dict[str, Optional[float]] = {}
+        releases: List[str] = []
+        with self._lock:
+            held = sum(1 for name in self._devices
+                       if name in self._claims and self._claims[name].node == self._node)
+            for name in self._devices:
+                claim = self._claims.get(name)
+                score = self._score(name, now)
+
+                if claim is not None and claim.node == self._node:
+                    if self._failures.get(name, 0) >= self._release_after_failures:
+                        logger.warning("Releasing {} after {} failures", name,
+                                       self._failures[name])
+                        releases.append(name)
+                        self._failures[name] = 0
+                        self._scores.pop(name, None)
+                        self._backoff_until[name] = now + self._lease_time
+                    elif now - self._renewed_at.get(name, -self._lease_time) >= self._lease_time / self.RENEWALS:
+                        claims[name] = score
+                    continue
+
+                if now < self._backoff_until.get(name, 0) or \
+                        now - self._claimed_at.get(name, -self._lease_time) < self._lease_time:
+                    # waiting for our previous claim to come back or be overridden
+                    continue
+
+                if self._is_free(claim, now):
+                    free_since = self._free_since.setdefault(name, now)
+                    if now - free_since >= self._claim_delay(name, score, held):
+                        claims[name] = score
+                        held += 1
+                        metrics.coordination_events_total.labels('claimed').inc()
+                else:
+                    self._free_since.pop(name, None)
+                    if score is not None and claim.score is not None and \
+                            now - claim.since >= self._lease_time and \
+                            score < claim.score * (1 - self._takeover_margin):
+                        logger.info("Taking over {} from node {}, latency {:.2f}s vs {:.2f}s",
+                                    name, claim.node, score, claim.score)
+                        claims[name] = score
+                        metrics.coordination_events_total.labels('takeover').inc()
+
+            for name in claims.keys():
+                if name not in self._claims or self._claims[name].node != self._node:
+                    self._claimed_at[name] = now
+                self._free_since.pop(name, None)
+
+            owned = set(name for name in self._devices
+                        if name not in releases and self._owns(name, now))
+            gained = [name for name in owned if name not in self._owned]
+            changed = owned != self._owned
+            self._owned = owned
+
+        for name, score in claims.items():
+            self._publish_claim(name, score, now)
+        for name in releases:
+            self._release(name)
+        if changed:
+            if len(gained) > 0:
+                logger.info("Node {} now owns {}", self._node, sorted(gained))
+            self._mqtt.set_autodiscovery_devices(owned)
+        return gained
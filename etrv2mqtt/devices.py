@@ -1,122 +1,1047 @@
+import atexit
+import json
+import math
+import os
+import random
+import signal
+import threading
 import time
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import replace
+from functools import partial
 
-from libetrv.bluetooth import btle
 from loguru import logger
 
 from etrv2mqtt.config import Config, ThermostatConfig
-from etrv2mqtt.etrvutils import eTRVUtils
+from etrv2mqtt import metrics
+from etrv2mqtt.etrvutils import eTRVData, eTRVUtils
+from etrv2mqtt.commands import SetpointQueue
+from etrv2mqtt.coordination import DeviceCoordinator
+from etrv2mqtt.history import History
 from etrv2mqtt.mqtt import Mqtt
-from typing import Type, Dict, NoReturn
+from etrv2mqtt.poller import PollJob, PollingEngine
+from etrv2mqtt.presence import PresenceScanner, PresenceTable, RadioGate
+from etrv2mqtt.settings import SettingsSync, validate as validate_settings
+from etrv2mqtt.zones import ZoneStates
+from etrv2mqtt.scheduling import AdaptivePollScheduler, PollPlanner, PollScheduler, RadioOccupancy
+from etrv2mqtt.transport import DisconnectError, create_transport
+from typing import TYPE_CHECKING, Any, Type, Dict, Iterable, List, NoReturn, Optional, Tuple
 import schedule
 
+if TYPE_CHECKING:
+    from libetrv.device import eTRVDevice
+    from etrv2mqtt.statestore import StateStore
+
 
 class DeviceBase(ABC):
     def __init__(self, thermostat_config: ThermostatConfig, config: Config):
         super().__init__()
 
     @abstractmethod
-    def poll(self, mqtt: Mqtt):
+    def poll(self, mqtt: Mqtt, probe: bool = False) -> Optional[eTRVData]:
+        """Reads and publishes device data, probe of unreachable device should give up quickly"""
         pass
 
     @abstractmethod
-    def set_temperature(self, mqtt: Mqtt, temperature: float):
+    def set_temperature(self, mqtt: Mqtt, temperature: float, refresh: bool = False,
+                        probe: bool = False) -> Optional[eTRVData]:
+        """Writes setpoint and publishes confirmation, refresh also reads every field like poll()"""
+        pass
+
+    def close(self):
+        """Called when device is removed from config"""
+        pass
+
+    def invalidate(self):
+        """Next readout reads every field again, including ones that are normally reused"""
+        pass
+
+    @property
+    def connected(self) -> bool:
+        """True if device can be accessed without connecting first"""
+        return False
+
+    @abstractmethod
+    def apply_settings(self, settings: Dict[str, Any], probe: bool = False) -> Optional[Dict[str, Any]]:
+        """Writes settings differing from the device in one session, returns all settings
+        read back from device or None on failure. Values the device can't take raise ValueError."""
         pass
 
 
+class CircuitBreaker():
+    """Takes an unreachable device out of the poll path. After failure_threshold failed
+    operations in a row the breaker opens for backoff seconds, doubled with every failed
+    probe up to max_backoff. Once backoff has passed a single probe is let through
+    (half-open), success closes the breaker again. Probe that does not report back
+    within max_backoff counts as failed."""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int, backoff: float, max_backoff: float):
+        self._failure_threshold = failure_threshold
+        self._initial_backoff = backoff
+        self._max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self._backoff = backoff
+        self._open_until = 0.0
+        self._probe_until = 0.0
+
+    @property
+    def available(self) -> bool:
+        return self.state == self.CLOSED
+
+    def acquire(self, now: Optional[float] = None, force: bool = False) -> Optional[bool]:
+        """Returns None if device must not be accessed now, otherwise whether access is a probe.
+        force lets setpoint writes through as probes while the breaker is open."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self.state == self.CLOSED:
+                return False
+            if self.state == self.HALF_OPEN and now >= self._probe_until:
+                # result of the probe was lost
+                self._failed_probe(now)
+            if self.state == self.OPEN and now >= self._open_until:
+                self.state = self.HALF_OPEN
+                self._probe_until = now + self._max_backoff
+                return True
+            return True if force else None
+
+    def record(self, success: bool, now: Optional[float] = None) -> bool:
+        """Records result of an operation, returns True if device availability changed"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            was_available = self.state == self.CLOSED
+            if success:
+                self.state = self.CLOSED
+                self.failures = 0
+                self._backoff = self._initial_backoff
+                return not was_available
+
+            self.failures += 1
+            if self.state == self.CLOSED and self.failures < self._failure_threshold:
+                return False
+            if self.state != self.CLOSED:
+                self._failed_probe(now)
+            else:
+                self._open(now)
+            return was_available
+
+    def _failed_probe(self, now: float):
+        # must be called with self._lock held
+        self._backoff = min(self._backoff * 2, self._max_backoff)
+        self._open(now)
+
+    def _open(self, now: float):
+        # must be called with self._lock held
+        self.state = self.OPEN
+        # spread probes of devices that failed together
+        self._open_until = now + self._backoff * random.uniform(0.9, 1.1)
+
+
+class ConnectionPool():
+    """Keeps up to max_connections BLE connections open between operations.
+    Least recently used and idle connections are closed first."""
+
+    def __init__(self, max_connections: int, idle_timeout: float):
+        self._max_connections = max_connections
+        self._idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        # address -> (device, last use time), oldest first
+        self._idle: 'OrderedDict[str, Tuple[eTRVDevice, float]]' = OrderedDict()
+        self._in_use: Dict[str, int] = {}
+        self._device_locks: Dict[str, threading.RLock] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._sweeper = threading.Thread(
+            target=self._sweep_forever, daemon=True, name='etrv-pool-sweeper')
+        self._sweeper.start()
+
+    def _device_lock(self, address: str) -> threading.RLock:
+        with self._lock:
+            if address not in self._device_locks:
+                self._device_locks[address] = threading.RLock()
+            return self._device_locks[address]
+
+    def _select_evictions(self, now: float) -> List['eTRVDevice']:
+        # must be called with self._lock held
+        evicted: List['eTRVDevice'] = []
+        while len(self._idle) > 0:
+            address, (device, last_used) = next(iter(self._idle.items()))
+            over_capacity = len(self._idle) + \
+                len(self._in_use) > self._max_connections
+            if not over_capacity and now - last_used < self._idle_timeout:
+                break
+            del self._idle[address]
+            evicted.append(device)
+            self.evictions += 1
+        return evicted
+
+    def _close(self, devices: List['eTRVDevice']):
+        for device in devices:
+            lock = self._device_lock(device.address)
+            # device is being used again, new owner decides what to do with connection
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                logger.debug("Closing pooled connection to {}", device.address)
+                with metrics.ble_operation_seconds.labels('disconnect').time():
+                    device.disconnect()
+            except DisconnectError as e:
+                logger.debug(e)
+            finally:
+                lock.release()
+
+    @contextmanager
+    def connection(self, device: 'eTRVDevice'):
+        address = device.address
+        with self._device_lock(address):
+            with self._lock:
+                self._idle.pop(address, None)
+                if device.is_connected():
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                self._in_use[address] = self._in_use.get(address, 0) + 1
+                evicted = self._select_evictions(time.monotonic())
+            self._close(evicted)
+
+            try:
+                if not device.is_connected():
+                    with metrics.ble_operation_seconds.labels('connect').time():
+                        device.connect()
+                yield device
+            finally:
+                with self._lock:
+                    self._in_use[address] -= 1
+                    if self._in_use[address] == 0:
+                        del self._in_use[address]
+                        if device.is_connected():
+                            self._idle[address] = (device, time.monotonic())
+                    evicted = self._select_evictions(time.monotonic())
+                self._close(evicted)
+
+    def discard(self, device: 'eTRVDevice'):
+        """Closes idle connection of device that won't be used anymore"""
+        with self._lock:
+            entry = self._idle.pop(device.address, None)
+        if entry is not None:
+            self._close([entry[0]])
+
+    def sweep(self):
+        with self._lock:
+            evicted = self._select_evictions(time.monotonic())
+        self._close(evicted)
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(max(1.0, self._idle_timeout / 2))
+            self.sweep()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'open': len(self._idle) + len(self._in_use),
+            }
+
+    def register_metrics(self):
+        for event in ('hits', 'misses', 'evictions'):
+            metrics.connection_pool_total.labels(event).set_function(
+                partial(getattr, self, event))
+        metrics.connection_pool_open.set_function(
+            lambda: len(self._idle) + len(self._in_use))
+
+
 class TRVDevice(DeviceBase):
+    # shared by all thermostats, created by first TRVDevice if enabled in config
+    connection_pool: Optional[ConnectionPool] = None
+
     def __init__(self, thermostat_config: ThermostatConfig, config: Config):
         super().__init__(thermostat_config, config)
-        self._device = eTRVUtils.create_device(thermostat_config.address,
-                                               bytes.fromhex(
-                                                   thermostat_config.secret_key),
-                                               retry_limit=config.retry_limit)
+        self._thermostat_config = thermostat_config
+        self._retry_limit = config.retry_limit
+        self._probe_retry_limit = config.probe_retry_limit
+        self._etrv_device: Optional['eTRVDevice'] = None
         self._name = thermostat_config.topic
         self._stay_connected = config.stay_connected
+        self._last_reading: Optional[eTRVData] = None
+        # seconds between reads of rarely changing fields, copied from the last readout in between
+        self._refresh_intervals = {'name': config.name_refresh_interval,
+                                   'battery': config.battery_refresh_interval}
+        self._read_at: Dict[str, float] = {}
+        self._refresh_all = True
 
-    def poll(self, mqtt: Mqtt):
-        try:
-            logger.debug("Polling data from {}", self._name)
+        if eTRVUtils.transport is None:
+            eTRVUtils.transport = create_transport(config)
+        if config.max_connections > 0 and TRVDevice.connection_pool is None:
+            TRVDevice.connection_pool = ConnectionPool(
+                config.max_connections, config.connection_idle_timeout)
+            TRVDevice.connection_pool.register_metrics()
+
+    @property
+    def _device(self) -> 'eTRVDevice':
+        # created on first use so MQTT is up before libetrv is imported
+        if self._etrv_device is None:
+            self._etrv_device = eTRVUtils.create_device(self._thermostat_config.address,
+                                                        bytes.fromhex(
+                                                            self._thermostat_config.secret_key),
+                                                        retry_limit=self._retry_limit,
+                                                        adapter=self._thermostat_config.adapter)
+        return self._etrv_device
 
+    @contextmanager
+    def _connection(self, probe: bool = False):
+        self._device.retry_limit = self._probe_retry_limit if probe else self._retry_limit
+        if TRVDevice.connection_pool is not None:
+            with TRVDevice.connection_pool.connection(self._device):
+                yield
+        else:
             if not self._device.is_connected():
-                self._device.connect()
+                with metrics.ble_operation_seconds.labels('connect').time():
+                    self._device.connect()
+            yield
+            if self._stay_connected == False:
+                with metrics.ble_operation_seconds.labels('disconnect').time():
+                    self._device.disconnect()
 
-            ret = eTRVUtils.read_device(self._device)
-            logger.debug(str(ret))
-            mqtt.publish_device_data(self._name, str(ret))
+    def _publish(self, mqtt: Mqtt, data: eTRVData) -> eTRVData:
+        self._last_reading = data
+        logger.debug("{}", data)
+        mqtt.publish_device_data(self._name, data)
+        return data
 
-            if self._stay_connected == False:
-                self._device.disconnect()
-        except btle.BTLEDisconnectError as e:
+    def _read(self, fields: Tuple[str, ...]) -> eTRVData:
+        """Reads fields and the rarely changing ones whose refresh interval elapsed"""
+        now = time.monotonic()
+        refresh_all = self._refresh_all
+        due = fields + tuple(field for field, interval in self._refresh_intervals.items()
+                             if refresh_all or now - self._read_at.get(field, -math.inf) >= interval)
+        with metrics.ble_operation_seconds.labels('read').time():
+            data = eTRVUtils.read_device(self._device, due, self._last_reading)
+        for field in due:
+            metrics.device_field_reads_total.labels(field).inc()
+            if field in self._refresh_intervals:
+                self._read_at[field] = now
+        if refresh_all:
+            self._refresh_all = False
+        return data
+
+    def _read_and_publish(self, mqtt: Mqtt) -> eTRVData:
+        return self._publish(mqtt, self._read(('temperature',)))
+
+    def invalidate(self):
+        self._refresh_all = True
+
+    @property
+    def connected(self) -> bool:
+        return self._etrv_device is not None and self._etrv_device.is_connected()
+
+    def close(self):
+        if self._etrv_device is None:
+            return
+        if TRVDevice.connection_pool is not None:
+            TRVDevice.connection_pool.discard(self._etrv_device)
+        elif self._etrv_device.is_connected():
+            try:
+                self._etrv_device.disconnect()
+            except DisconnectError as e:
+                logger.debug(e)
+
+    def poll(self, mqtt: Mqtt, probe: bool = False) -> Optional[eTRVData]:
+        try:
+            logger.debug("{} data from {}",
+                         "Probing" if probe else "Polling", self._name)
+
+            with self._connection(probe):
+                return self._read_and_publish(mqtt)
+        except DisconnectError as e:
             logger.error(e)
+            metrics.device_failures_total.labels(
+                self._name, type(e).__name__).inc()
+        return None
 
-    def set_temperature(self, mqtt: Mqtt, temperature: float):
+    def apply_settings(self, settings: Dict[str, Any], probe: bool = False) -> Optional[Dict[str, Any]]:
+        try:
+            logger.info("Writing {} settings to {}", len(settings), self._name)
+
+            with self._connection(probe):
+                with metrics.ble_operation_seconds.labels('read_settings').time():
+                    current = eTRVUtils.read_settings(self._device)
+                with metrics.ble_operation_seconds.labels('write_settings').time():
+                    written = eTRVUtils.write_settings(
+                        self._device, current, settings)
+                logger.debug("{} settings written: {}", self._name, written)
+                return dict(current, **settings)
+        except DisconnectError as e:
+            logger.error(e)
+            metrics.device_failures_total.labels(
+                self._name, type(e).__name__).inc()
+        return None
+
+    def set_temperature(self, mqtt: Mqtt, temperature: float, refresh: bool = False,
+                        probe: bool = False) -> Optional[eTRVData]:
         try:
             logger.info("Setting {} to {}C", self._name, temperature)
 
-            if not self._device.is_connected():
-                self._device.connect()
-            eTRVUtils.set_temperature(self._device, temperature)
-            # Home assistant needs to see updated temperature value to confirm change
-            self.poll(mqtt)
-        except btle.BTLEDisconnectError as e:
+            with self._connection(probe):
+                with metrics.ble_operation_seconds.labels('write').time():
+                    eTRVUtils.set_temperature(self._device, temperature)
+                # Home assistant needs to see updated temperature value to confirm change.
+                # Temperature struct was just read and written, only name and battery may need a read.
+                if refresh or self._last_reading is None:
+                    data = self._read(())
+                else:
+                    data = eTRVUtils.read_temperature(
+                        self._device, self._last_reading)
+                return self._publish(mqtt, data)
+        except DisconnectError as e:
             logger.error(e)
+            metrics.device_failures_total.labels(
+                self._name, type(e).__name__).inc()
+        return None
 
 
 class DeviceManager():
     def __init__(self, config: Config, deviceClass: Type[DeviceBase]):
         self._config = config
+        self._device_class = deviceClass
         self._devices: Dict[str, DeviceBase] = {}
+        self._adapters: Dict[str, int] = {}
+        # failing devices are skipped, breaker_failures 0 disables breakers
+        self._breakers: Dict[str, CircuitBreaker] = {}
         for thermostat_config in self._config.thermostats.values():
-            logger.info("Adding device {} MAC: {} key: {}", thermostat_config.topic,
-                        thermostat_config.address, thermostat_config.secret_key)
-            device = deviceClass(thermostat_config, config)
-            self._devices[thermostat_config.topic] = device
+            self._add_device(thermostat_config)
+
+        self._occupancy = RadioOccupancy(
+            config.poll_interval, config.adapter_max_connections)
+        # presence scans pause thermostat operations on their adapter
+        self._radio_gate: Optional[RadioGate] = RadioGate() if config.presence_scan else None
+        self._poll_engine = self._create_poll_engine()
 
-        self._mqtt = Mqtt(self._config)
+        self._poll_scheduler: Optional[PollScheduler] = None
+        if config.adaptive_polling:
+            self._poll_scheduler = AdaptivePollScheduler(self._devices.keys(), config.min_poll_interval,
+                                                         config.poll_interval, config.poll_change_threshold,
+                                                         config.catchup_poll_rate)
+        elif config.poll_spread:
+            self._poll_scheduler = PollPlanner(self._devices.keys(), config.poll_interval,
+                                               config.catchup_poll_rate)
+
+        self._setpoint_queue = SetpointQueue(config.setpoint_debounce_time)
+
+        self._state_store: Optional['StateStore'] = None
+        # readings from previous run, published flagged stale until thermostat is read again
+        self._stale_readings: Dict[str, eTRVData] = {}
+        if config.state_store is not None:
+            self._open_state_store()
+
+        self._mqtt = Mqtt(self._config, autostart=False)
         self._mqtt.set_temperature_callback = self._set_temperature_callback
         self._mqtt.hass_birth_callback = self._hass_birth_callback
 
-    def _poll_devices(self):
-        for device in self._devices.values():
-            device.poll(self._mqtt)
+        # zone setpoints fan out to zone thermostats, zone state is combined from their published states
+        self._zones = ZoneStates(config.zones.values())
+        self._published_zone_states: Dict[str, bytes] = {}
+        self._watching_zones = False
+        self._mqtt.add_zone_command('set', self._zone_set_request)
+        self._watch_zones()
+
+        # desired settings documents, <base_topic>/_settings/set takes several thermostats at once
+        self._settings = SettingsSync()
+        self._mqtt.add_device_command('settings/set', self._settings_request)
+        self._mqtt.add_handler(config.mqtt.base_topic + '/_settings/set',
+                               self._bulk_settings_request)
+
+        self._history: Optional[History] = None
+        if config.history_size > 0:
+            self._history = History(config.history_size)
+            self._mqtt.add_device_command('history/get', self._history_request)
+
+        self._coordinator: Optional[DeviceCoordinator] = None
+        if config.coordination:
+            self._coordinator = DeviceCoordinator(
+                config, self._mqtt, self._devices.keys())
+        metrics.breaker_open_devices.set_function(
+            lambda: sum(1 for breaker in list(self._breakers.values()) if not breaker.available))
+
+        # thermostats not heard from recently are not polled
+        self._presence: Optional[PresenceTable] = None
+        self._published_rssi: Dict[str, int] = {}
+        if config.presence_scan:
+            self._presence = PresenceTable(config.presence_timeout)
+            self._presence.set_thermostats(config.thermostats.values())
+            metrics.absent_devices.set_function(
+                lambda: sum(1 for name in list(self._devices.keys()) if not self._presence.present(name)))
+        self._poll_all_pending = False
+        self._reload_pending = False
+        self._config_stamp = self._config_file_stamp()
+
+    def _create_poll_engine(self) -> Optional[PollingEngine]:
+        return PollingEngine(self._config.poll_workers, self._config.adapters,
+                             self._config.adapter_max_connections, self._occupancy, self._radio_gate)
+
+    def _run_jobs(self, jobs: Iterable[PollJob]):
+        # asyncio manager runs device calls on its own executor and never gets here
+        assert self._poll_engine is not None
+        self._poll_engine.run(jobs)
+
+    def _add_device(self, thermostat_config: ThermostatConfig):
+        logger.info("Adding device {} MAC: {} key: {}", thermostat_config.topic,
+                    thermostat_config.address, thermostat_config.secret_key)
+        name = thermostat_config.topic
+        self._devices[name] = self._device_class(
+            thermostat_config, self._config)
+        self._adapters[name] = thermostat_config.adapter
+        if self._config.breaker_failures > 0:
+            self._breakers[name] = CircuitBreaker(self._config.breaker_failures, self._config.breaker_backoff,
+                                                  self._config.breaker_max_backoff)
+
+    def _open_state_store(self):
+        from etrv2mqtt.statestore import StateStore
+        self._state_store = StateStore(self._config.state_store,
+                                       self._config.state_store_retention * 3600)
+        # closing the last connection checkpoints the write-ahead log into the database
+        atexit.register(self._state_store.close)
+        self._stale_readings = {name: data for name, data in self._state_store.load_readings().items()
+                                if name in self._devices}
+        for name, temperature in self._state_store.load_setpoints().items():
+            if name in self._devices:
+                logger.info("Setting {} to {}C requested before restart",
+                            name, temperature)
+                self._setpoint_queue.put(name, temperature)
+        logger.info("Loaded {} readings from {}", len(self._stale_readings),
+                    self._config.state_store)
+
+    def _remove_device(self, name: str):
+        logger.info("Removing device {}", name)
+        device = self._devices.pop(name)
+        del self._adapters[name]
+        self._breakers.pop(name, None)
+        self._stale_readings.pop(name, None)
+        self._published_rssi.pop(name, None)
+        self._settings.forget(name)
+        self._zones.forget(name)
+        if self._state_store is not None:
+            self._state_store.forget(name)
+        if self._history is not None:
+            self._history.remove(name)
+        self._setpoint_queue.discard(name)
+        if self._poll_scheduler is not None:
+            self._poll_scheduler.remove(name)
+        self._mqtt.forget_device(name)
+        device.close()
+
+    def _poll_added_devices(self, names: List[str]):
+        if self._poll_scheduler is not None:
+            # due immediately, picked up by the next scheduler run
+            for name in names:
+                self._poll_scheduler.add(name)
+        else:
+            self._poll_devices(names)
+
+    def reload_config(self):
+        """Applies thermostat changes from config file. Unchanged thermostats keep their
+        connections and schedules, other options need a restart."""
+        self._config_stamp = self._config_file_stamp()
+        try:
+            new_config = Config(self._config.filename,
+                                cache_dir=self._config.cache_dir)
+        except Exception as e:
+            logger.error("Config reload failed, keeping current config: {}", e)
+            return
+        if self._config.shard is not None:
+            # changing number of shards needs a restart
+            new_config.shards = self._config.shards
+            new_config.select_shard(self._config.shard)
+
+        current = self._config.thermostats
+        thermostats = dict(new_config.thermostats)
+        for name, thermostat in thermostats.items():
+            # removing a thermostat shifts round-robin adapters of the following ones, keep running assignment
+            if thermostat.auto_adapter and name in current and \
+                    replace(current[name], adapter=thermostat.adapter) == thermostat:
+                thermostats[name] = current[name]
+
+        removed = [name for name in current.keys()
+                   if thermostats.get(name) != current[name]]
+        added = [name for name in thermostats.keys()
+                 if current.get(name) != thermostats[name]]
+        zones_changed = new_config.zones != self._config.zones
+        logger.info("Config reloaded, {} thermostats removed or changed, {} added or changed",
+                    len(removed), len(added))
+        if len(removed) == 0 and len(added) == 0 and not zones_changed:
+            return
+        if zones_changed:
+            self._config.zones = new_config.zones
+            self._zones.set_zones(new_config.zones.values())
+            self._published_zone_states = {}
+            self._watch_zones()
+
+        for name in removed:
+            self._remove_device(name)
+        self._config.thermostats = thermostats
+        for name in added:
+            self._add_device(thermostats[name])
+
+        self._mqtt.reload_thermostats()
+        if self._presence is not None:
+            self._presence.set_thermostats(thermostats.values())
+        if self._coordinator is not None:
+            self._coordinator.set_devices(self._devices.keys())
+            # polled once claimed
+            added = [name for name in added if self._coordinator.owns(name)]
+        for name in added:
+            self._publish_availability(name)
+        self._poll_added_devices(added)
+
+    def _config_file_stamp(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self._config.filename)
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
+
+    def _check_config_file(self):
+        if self._config_file_stamp() != self._config_stamp:
+            self._request_reload()
+
+    def _request_reload(self):
+        self._reload_pending = True
+
+    def _install_reload_handler(self):
+        # signal handlers can only be installed from main thread
+        if hasattr(signal, 'SIGHUP') and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGHUP,
+                          lambda signum, frame: self._request_reload())
+
+    def _record_reading(self, name: str, reading: Optional[eTRVData], duration: Optional[float] = None):
+        if self._poll_scheduler is not None:
+            self._poll_scheduler.record_reading(name, reading)
+        if reading is not None and self._state_store is not None:
+            self._stale_readings.pop(name, None)
+            self._state_store.record_reading(name, reading)
+        if reading is not None and self._history is not None:
+            self._history.record(name, reading)
+        if reading is not None and self._presence is not None:
+            self._presence.seen(name)
+            self._publish_rssi(name)
+        self._record_availability(name, reading is not None)
+        if self._coordinator is not None:
+            self._coordinator.record_result(
+                name, duration, reading is not None)
+
+    def _record_availability(self, name: str, success: bool):
+        breaker = self._breakers.get(name)
+        if breaker is not None and breaker.record(success):
+            if breaker.available:
+                logger.info("{} is reachable again", name)
+            else:
+                logger.warning("{} failed {} times, marking it unavailable",
+                               name, breaker.failures)
+            self._publish_availability(name)
+
+    def _query_history(self, name: str, request: Dict) -> Optional[Dict]:
+        """None for unknown thermostats and ones owned by another node in coordination mode"""
+        if self._history is None or name not in self._devices or \
+                (self._coordinator is not None and not self._coordinator.owns(name)):
+            return None
+        try:
+            start, end, step = (None if request.get(key) is None else float(request[key])
+                                for key in ('start', 'end', 'step'))
+        except (TypeError, ValueError):
+            raise ValueError("start, end and step must be numbers")
+        if any(value is not None and not math.isfinite(value) for value in (start, end, step)):
+            raise ValueError("start, end and step must be finite")
+        return self._history.query(name, start, end, step or 0)
+
+    def _history_request(self, name: str, payload: bytes, retain: bool):
+        if retain:
+            # would be answered again on every reconnect
+            return
+        try:
+            request = json.loads(payload) if len(payload) > 0 else {}
+            if not isinstance(request, dict):
+                raise ValueError("request must be an object")
+            response_topic = request.get('response_topic') or \
+                self._config.mqtt.base_topic + '/' + name + '/history'
+            # anyone able to publish requests must not get the bridge to publish elsewhere
+            if not isinstance(response_topic, str) or \
+                    not response_topic.startswith(self._config.mqtt.base_topic + '/') or \
+                    '+' in response_topic or '#' in response_topic:
+                raise ValueError("response_topic must be a topic under " +
+                                 self._config.mqtt.base_topic + "/")
+            result = self._query_history(name, request)
+        except ValueError as e:
+            logger.warning("Invalid history request for {}: {}", name, e)
+            return
+        if result is None:
+            return
+        if 'id' in request:
+            result['id'] = request['id']
+        self._mqtt.publish(response_topic, json.dumps(result))
+
+    def _publish_settings_result(self, name: str, status: str, requested: Iterable[str],
+                                 settings: Optional[Dict[str, Any]] = None, error: Optional[str] = None):
+        result: Dict[str, Any] = {'status': status, 'requested': sorted(requested)}
+        if settings is not None:
+            result['settings'] = settings
+        if error is not None:
+            result['error'] = error
+        self._mqtt.publish(self._config.mqtt.base_topic + '/' + name + '/settings/result',
+                           json.dumps(result))
+
+    def _queue_settings(self, requests: Dict[str, Any]):
+        for name, document in requests.items():
+            if name not in self._devices:
+                logger.warning("Device {} not found", name)
+                continue
+            if self._coordinator is not None and not self._coordinator.owns(name):
+                # written by the owner
+                continue
+            try:
+                settings = validate_settings(document)
+            except (ValueError, OverflowError) as e:
+                logger.warning("Invalid settings for {}: {}", name, e)
+                self._publish_settings_result(
+                    name, 'invalid', [], error=str(e))
+                continue
+            queued = self._settings.request(name, settings)
+            self._publish_settings_result(
+                name, 'pending' if len(queued) > 0 else 'unchanged', queued)
+
+    def _settings_request(self, name: str, payload: bytes, retain: bool):
+        if retain:
+            # would be written again on every reconnect
+            return
+        try:
+            document = json.loads(payload)
+        except ValueError as e:
+            logger.warning("Invalid settings for {}: {}", name, e)
+            return
+        self._queue_settings({name: document})
+
+    def _bulk_settings_request(self, topic: str, payload: bytes, retain: bool):
+        """Payload maps thermostats to settings, settings under "*" apply to every thermostat"""
+        if retain:
+            return
+        try:
+            document = json.loads(payload)
+            if not isinstance(document, dict):
+                raise ValueError("settings must be an object")
+        except ValueError as e:
+            logger.warning("Invalid bulk settings: {}", e)
+            return
+        common = document.pop('*', None)
+        requests: Dict[str, Any] = {}
+        if common is not None:
+            requests = {name: common for name in list(self._devices.keys())}
+        for name, settings in document.items():
+            if isinstance(common, dict) and isinstance(settings, dict):
+                settings = dict(common, **settings)
+            requests[name] = settings
+        self._queue_settings(requests)
+
+    def _settings_applied(self, name: str, requested: Dict[str, Any], settings: Optional[Dict[str, Any]],
+                          error: Optional[str] = None):
+        # thermostat that rejected values was reached, write may have been a breaker probe
+        self._record_availability(name, settings is not None or error is not None)
+        self._settings.applied(name, settings)
+        self._publish_settings_result(name, 'failed' if settings is None else 'applied',
+                                      requested, settings, error)
+
+    def _apply_settings(self, name: str, requested: Dict[str, Any]):
+        error: Optional[str] = None
+        try:
+            settings = self._devices[name].apply_settings(
+                requested, self._write_is_probe(name))
+        except (ValueError, OverflowError) as e:
+            logger.error("Writing settings to {} failed: {}", name, e)
+            settings, error = None, str(e)
+        except Exception as e:
+            logger.opt(exception=e).error("Writing settings to {} failed", name)
+            settings = None
+        self._settings_applied(name, requested, settings, error)
+
+    def _run_pending_settings(self):
+        # one session per thermostat, thermostats in parallel like polls
+        pending = [(name, requested) for name, requested in self._settings.pop_pending()
+                   if name in self._devices]
+        if len(pending) > 0:
+            self._run_jobs(
+                (self._adapters[name], partial(self._apply_settings, name, requested))
+                for name, requested in pending)
+
+    def _watch_zones(self):
+        # states of all thermostats come back to the bridge only when some zone needs them
+        if len(self._config.zones) > 0 and not self._watching_zones:
+            self._watching_zones = True
+            self._mqtt.add_handler(self._config.mqtt.base_topic + '/+/state',
+                                   self._thermostat_state)
+
+    def _publishes_zone(self, zone_name: str) -> bool:
+        # node or shard handling the first thermostat of the zone publishes zone state
+        first = self._config.zones[zone_name].thermostats[0]
+        return first in self._devices and \
+            (self._coordinator is None or self._coordinator.owns(first))
+
+    def _thermostat_state(self, topic: str, payload: bytes, retain: bool):
+        name = topic[len(self._config.mqtt.base_topic)+1:-len('/state')]
+        for zone_name in self._zones.update(name, payload):
+            if not self._publishes_zone(zone_name):
+                continue
+            state = self._zones.state(zone_name)
+            if state is not None and state != self._published_zone_states.get(zone_name):
+                self._published_zone_states[zone_name] = state
+                self._mqtt.publish_zone_state(zone_name, state)
+
+    def _zone_set_request(self, zone_name: str, payload: bytes, retain: bool):
+        try:
+            temperature = float(payload)
+        except ValueError:
+            logger.warning("{}: {} is not a valid float",
+                           zone_name, payload)
+            return
+        zone = self._config.zones.get(zone_name)
+        if zone is None:
+            return
+        logger.info("Setting zone {} to {}C", zone_name, temperature)
+        for name in zone.thermostats:
+            # thermostats of other shards are set by their own worker
+            if name in self._devices:
+                self._set_temperature_callback(self._mqtt, name, temperature)
+
+    def _connection_order(self, name: str) -> Tuple[bool, float]:
+        """Sort key putting connected thermostats first, then ones with the strongest signal"""
+        return (not self._devices[name].connected,
+                self._presence.signal_order(name) if self._presence is not None else 0)
+
+    def _publish_rssi(self, name: str):
+        rssi = self._presence.rssi(name)
+        if rssi is not None and self._published_rssi.get(name) != rssi:
+            self._published_rssi[name] = rssi
+            self._mqtt.publish_device_rssi(name, rssi)
+
+    def _publish_availability(self, name: str):
+        breaker = self._breakers.get(name)
+        self._mqtt.publish_device_availability(
+            name, breaker is None or breaker.available)
+
+    def _publish_all_availability(self):
+        for name in list(self._devices.keys()):
+            if self._coordinator is None or self._coordinator.owns(name):
+                self._publish_availability(name)
+
+    def _publish_stale_states(self, names: Iterable[str]):
+        for name in names:
+            data = self._stale_readings.get(name)
+            if data is not None:
+                self._mqtt.publish_device_data(name, data, stale=True)
+
+    def _record_write(self, name: str, temperature: float, reading: Optional[eTRVData]):
+        self._record_reading(name, reading)
+        if reading is not None and self._state_store is not None:
+            self._state_store.setpoint_written(name, temperature)
+
+    def _pollable(self, names: Iterable[str]) -> List[Tuple[str, bool]]:
+        """(name, probe) of thermostats to poll now, strongest signal first. Thermostats owned
+        by other nodes in coordination mode, not seen by presence scan and ones with open
+        circuit breaker are skipped."""
+        pollable: List[Tuple[str, bool]] = []
+        for name in names:
+            probe: Optional[bool] = False
+            if self._coordinator is not None and not self._coordinator.owns(name):
+                probe = None
+            elif self._presence is not None and not self._presence.present(name):
+                logger.debug("Skipping {}, not seen for {}s", name,
+                             self._config.presence_timeout)
+                probe = None
+            elif name in self._breakers:
+                probe = self._breakers[name].acquire()
+            if probe is not None:
+                pollable.append((name, probe))
+            elif self._poll_scheduler is not None:
+                # keeps it scheduled until it can be polled again
+                self._poll_scheduler.record_reading(name, None)
+        if self._presence is not None:
+            pollable.sort(key=lambda item: self._presence.signal_order(item[0]))
+        return pollable
+
+    def _coordinate(self) -> List[str]:
+        """Returns thermostats this node just became owner of, they are polled right away"""
+        if self._coordinator is None:
+            return []
+        gained = self._coordinator.tick()
+        for name in gained:
+            self._publish_availability(name)
+        self._publish_stale_states(gained)
+        if len(gained) > 0:
+            self._poll_added_devices(gained)
+        return gained
+
+    def _poll_device(self, name: str, probe: bool = False):
+        start = time.monotonic()
+        try:
+            reading = self._devices[name].poll(self._mqtt, probe)
+        except Exception as e:
+            # counted as failed poll, device stays scheduled
+            logger.opt(exception=e).error("Polling {} failed", name)
+            reading = None
+        self._record_reading(name, reading, time.monotonic() - start)
+
+    def _poll_devices(self, names: Optional[Iterable[str]] = None):
+        if names is None:
+            names = list(self._devices.keys())
+        self._run_jobs(
+            (self._adapters[name], partial(self._poll_device, name, probe))
+            for name, probe in self._pollable(names))
+
+    def _poll_due_devices(self):
+        self._poll_devices(self._poll_scheduler.pop_due())
+
+    def _poll_all_requested(self):
+        # called on connect and Home Assistant birth
+        self._publish_all_availability()
+        self._publish_stale_states([name for name in list(self._stale_readings.keys())
+                                    if self._coordinator is None or self._coordinator.owns(name)])
+        if self._poll_scheduler is not None:
+            self._poll_scheduler.poll_all_now()
+
+    def _start_presence_scan(self):
+        if self._presence is not None:
+            for adapter in sorted(set(self._adapters.values())):
+                PresenceScanner(self._presence, adapter,
+                                self._radio_gate).start()
+
+    def _start_metrics_server(self):
+        if self._config.metrics_port > 0:
+            # every worker of sharded bridge listens on its own port
+            server = metrics.MetricsHttpServer(metrics.registry, self._config.metrics_bind_address,
+                                               self._config.metrics_port + (self._config.shard or 0))
+            if self._history is not None:
+                server.add_route('/history/', self._query_history)
+            server.start()
 
     def poll_forever(self) -> NoReturn:
-        schedule.every(self._config.poll_interval).seconds.do(
-            self._poll_devices)
+        self._start_metrics_server()
+        self._start_presence_scan()
+        self._install_reload_handler()
+        self._mqtt.start()
+        if self._poll_scheduler is not None:
+            schedule.every(1).seconds.do(self._poll_due_devices)
+        else:
+            schedule.every(self._config.poll_interval).seconds.do(
+                self._poll_devices)
+        if self._config.metrics_interval > 0:
+            schedule.every(self._config.metrics_interval).seconds.do(
+                self._mqtt.publish_metrics)
+        if self._config.config_watch_interval > 0:
+            schedule.every(self._config.config_watch_interval).seconds.do(
+                self._check_config_file)
+        if self._state_store is not None:
+            schedule.every(self._config.state_store_flush_interval).seconds.do(
+                self._state_store.flush)
         mqtt_was_connected: bool = False
 
         while True:
+            if self._reload_pending:
+                self._reload_pending = False
+                self.reload_config()
+
             if self._mqtt.is_connected():
                 # run all pending jobs on connect
-                if not mqtt_was_connected:
+                if not mqtt_was_connected or self._poll_all_pending:
                     mqtt_was_connected = True
+                    self._poll_all_pending = False
+                    self._poll_all_requested()
                     schedule.run_all(delay_seconds=1)
 
+                idle_seconds = schedule.idle_seconds()
+                if idle_seconds is not None and idle_seconds < 0:
+                    metrics.scheduler_lag_seconds.observe(-idle_seconds)
                 schedule.run_pending()
+                self._coordinate()
+                self._run_due_setpoints()
+                self._run_pending_settings()
                 time.sleep(1)
             else:
                 mqtt_was_connected = False
                 time.sleep(2)
 
-    def _set_temerature_task(self, device: DeviceBase, temperature: float):
-        device.set_temperature(self._mqtt, temperature)
-        # this will cause the task to be executed only once
-        return schedule.CancelJob
+    def _write_is_probe(self, name: str) -> bool:
+        # setpoints are not held back by open breaker, but give up as quickly as probes
+        breaker = self._breakers.get(name)
+        return breaker is not None and bool(breaker.acquire(force=True))
+
+    def _set_temperature(self, name: str, temperature: float):
+        # poll due soon is done in the same BLE session instead of a separate connection later
+        refresh = self._poll_scheduler is not None and self._poll_scheduler.due_within(
+            name, self._config.setpoint_debounce_time)
+        try:
+            reading = self._devices[name].set_temperature(
+                self._mqtt, temperature, refresh=refresh, probe=self._write_is_probe(name))
+        except Exception as e:
+            # counted as failed write, failed probe must not leave breaker half-open
+            logger.opt(exception=e).error("Setting {} failed", name)
+            reading = None
+        self._record_write(name, temperature, reading)
+
+    def _due_setpoints(self) -> List[Tuple[str, float]]:
+        due: List[Tuple[str, float]] = []
+        for name, temperature in self._setpoint_queue.pop_due():
+            # device may have been removed by config reload after setpoint was queued
+            if name not in self._devices:
+                continue
+            if self._coordinator is not None and not self._coordinator.owns(name):
+                # every node receives the setpoint, only the owner writes it. Claim that
+                # has not settled yet gets the setpoint once it does.
+                if self._coordinator.claiming(name):
+                    self._setpoint_queue.put(name, temperature)
+                elif self._state_store is not None:
+                    self._state_store.setpoint_written(name, temperature)
+                continue
+            due.append((name, temperature))
+        # written in parallel, ones that can be reached quickest start first
+        due.sort(key=lambda item: self._connection_order(item[0]))
+        return due
+
+    def _run_due_setpoints(self):
+        due = self._due_setpoints()
+        if len(due) > 0:
+            self._run_jobs(
+                (self._adapters[name], partial(self._set_temperature, name, temperature))
+                for name, temperature in due)
 
     def _set_temperature_callback(self, mqtt: Mqtt, name: str, temperature: float):
         if name not in self._devices.keys():
             logger.warning(
                 "Device {} not found", name)
             return
-        device = self._devices[name]
 
-        # cancel pending temeperature update for the same device
-        schedule.clear(device)
+        # pending temperature update for the same device is replaced
+        if self._setpoint_queue.put(name, temperature):
+            metrics.setpoints_coalesced_total.inc()
+        if self._state_store is not None:
+            self._state_store.record_setpoint(name, temperature)
+
+        if self._poll_scheduler is not None:
+            self._poll_scheduler.record_setpoint(name)
 
-        # schedule temeperature update
-        schedule.every(self._config.setpoint_debounce_time).seconds.do(
-            self._set_temerature_task, device, temperature).tag(device)
+    def _refresh_all_fields(self):
+        # Home Assistant restarted and needs every field, not only ones due for refresh
+        for device in list(self._devices.values()):
+            device.invalidate()
 
     def _hass_birth_callback(self, mqtt: Mqtt):
-        schedule.run_all(delay_seconds=1)
+        # called from MQTT network thread, polling here would block publishing
+        self._refresh_all_fields()
+        self._poll_all_pending = True
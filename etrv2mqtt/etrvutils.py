@@ -1,37 +1,187 @@
 import json
+import math
 from dataclasses import dataclass
+from functools import lru_cache
 
-from libetrv.device import eTRVDevice
-from datetime import datetime
+from datetime import datetime, timedelta, tzinfo
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from libetrv.device import eTRVDevice
+    from etrv2mqtt.transport import Transport
+
+try:
+    import orjson
+
+    def _dumps_str(value: str) -> bytes:
+        return orjson.dumps(value)
+except ImportError:
+    def _dumps_str(value: str) -> bytes:
+        return json.dumps(value).encode('utf-8')
+
+
+class _TimestampFormatter():
+    """Formats naive local datetimes as ISO 8601 strings with local UTC offset.
+    Offset lookup is cached for the current hour, DST changes happen on full hours.
+    Called from worker threads, the cached hour is replaced with a single assignment."""
+
+    def __init__(self):
+        # (valid_from, valid_until, tz)
+        self._hour: Tuple[datetime, datetime, Optional[tzinfo]] = (
+            datetime.min, datetime.min, None)
+
+    def __call__(self, timestamp: datetime) -> str:
+        if timestamp.tzinfo is not None:
+            return timestamp.isoformat()
+
+        valid_from, valid_until, tz = self._hour
+        if not valid_from <= timestamp < valid_until:
+            valid_from = timestamp.replace(minute=0, second=0, microsecond=0)
+            tz = valid_from.astimezone().tzinfo
+            self._hour = (valid_from, valid_from + timedelta(hours=1), tz)
+
+        return timestamp.replace(tzinfo=tz).isoformat()
+
+
+format_timestamp = _TimestampFormatter()
+
+
+@lru_cache(maxsize=1024)
+def _encode_name(name: str) -> bytes:
+    return _dumps_str(name)
+
+
+def _encode_number(value) -> bytes:
+    # NaN and Infinity are not valid JSON
+    if value is None or not math.isfinite(value):
+        return b'null'
+    return repr(value).encode('ascii')
+
+
+_STATE_TEMPLATE = b'{"name": %s, "battery": %s, "room_temp": %s, "set_point": %s, "last_update": "%s"}'
+# last known state republished on startup before thermostat was read again
+_STALE_STATE_TEMPLATE = b'{"name": %s, "battery": %s, "room_temp": %s, "set_point": %s, "last_update": "%s", "stale": true}'
 
 
 @dataclass(repr=False)
 class eTRVData:
+    __slots__ = ('name', 'battery', 'room_temp', 'set_point', 'last_update')
     name: str
     battery: int
     room_temp: float
     set_point: float
     last_update: datetime
 
-    def _datetimeconverter(self, o):
-        if isinstance(o, datetime):
-            return o.astimezone().isoformat()
-        else:
-            return o
+    def to_bytes(self, stale: bool = False) -> bytes:
+        """JSON state payload as published over MQTT"""
+        return (_STALE_STATE_TEMPLATE if stale else _STATE_TEMPLATE) % (
+            _encode_name(self.name),
+            _encode_number(self.battery),
+            _encode_number(self.room_temp),
+            _encode_number(self.set_point),
+            format_timestamp(self.last_update).encode('ascii'),
+        )
 
     def __repr__(self):
-        return json.dumps(self.__dict__, default=self._datetimeconverter)
+        return self.to_bytes().decode('utf-8')
+
+
+# setting -> libetrv SettingsData attribute
+_SETTINGS_ATTRIBUTES = {
+    'adaptable_regulation': 'adaptable_regulation',
+    'vertical_installation': 'vertical_instalation',
+    'display_flip': 'display_flip',
+    'slow_regulation': 'slow_regulation',
+    'valve_installed': 'valve_installed',
+    'lock_control': 'lock_control',
+    'temperature_min': 'temperature_min',
+    'temperature_max': 'temperature_max',
+    'frost_protection_temperature': 'frost_protection_temperature',
+    'vacation_temperature': 'vacation_temperature',
+    'schedule_mode': 'schedule_mode',
+    'vacation_from': 'vacation_from',
+    'vacation_to': 'vacation_to',
+}
+_EPOCH = datetime(1970, 1, 1)
 
 
 class eTRVUtils:
+    # creates devices, real Bluetooth ones unless set otherwise. See etrv2mqtt.transport.
+    transport: Optional['Transport'] = None
+
     @staticmethod
-    def create_device(address: str, key: bytes, retry_limit: int = 5) -> eTRVDevice:
-        return eTRVDevice(address, secret=key, retry_limit=retry_limit)
+    def create_device(address: str, key: bytes, retry_limit: int = 5, adapter: int = 0) -> 'eTRVDevice':
+        if eTRVUtils.transport is None:
+            from etrv2mqtt.transport import BluetoothTransport
+            eTRVUtils.transport = BluetoothTransport()
+        return eTRVUtils.transport.create_device(address, key, retry_limit=retry_limit, adapter=adapter)
 
     @staticmethod
-    def read_device(device: eTRVDevice) -> eTRVData:
-        return eTRVData(device.name, device.battery, device.temperature.room_temperature, device.temperature.set_point_temperature, datetime.now())
+    def read_device(device: 'eTRVDevice', fields: Optional[Iterable[str]] = None,
+                    previous: Optional[eTRVData] = None) -> eTRVData:
+        """Reads device, fields lists properties to read again (all by default), others may come from libetrv cache.
+        Name and battery not listed are copied from previous readout if given, without touching the device."""
+        fields = None if fields is None else tuple(fields)
+        # libetrv caches values until disconnect, drop them so reads over a kept connection are fresh
+        for name, field in device.fields.items():
+            if fields is None or name in fields:
+                field.invalidate()
+        reuse = previous is not None and fields is not None
+        return eTRVData(previous.name if reuse and 'name' not in fields else device.name,
+                        previous.battery if reuse and 'battery' not in fields else device.battery,
+                        device.temperature.room_temperature, device.temperature.set_point_temperature, datetime.now())
+
+    @staticmethod
+    def read_temperature(device: 'eTRVDevice', previous: eTRVData) -> eTRVData:
+        """Readout with name and battery of previous readout, temperature comes from libetrv cache if populated"""
+        return eTRVData(previous.name, previous.battery, device.temperature.room_temperature, device.temperature.set_point_temperature, datetime.now())
+
+    @staticmethod
+    def read_settings(device: 'eTRVDevice') -> Dict[str, Any]:
+        """Name and settings characteristic read fresh from device, in etrv2mqtt.settings format"""
+        for name in ('name', 'settings'):
+            if name in device.fields:
+                device.fields[name].invalidate()
+        settings = device.settings
+        ret: Dict[str, Any] = {'name': device.name}
+        for key, attribute in _SETTINGS_ATTRIBUTES.items():
+            value = getattr(settings, attribute)
+            if key == 'schedule_mode':
+                value = value.name.lower()
+            elif key in ('vacation_from', 'vacation_to'):
+                value = 0 if value is None else int(
+                    (value - _EPOCH).total_seconds())
+            ret[key] = value
+        return ret
+
+    @staticmethod
+    def write_settings(device: 'eTRVDevice', current: Dict[str, Any], settings: Dict[str, Any]) -> List[str]:
+        """Writes settings differing from current read by read_settings(), settings characteristic
+        is written once for all changed settings. Returns written settings."""
+        from libetrv.data_struct import ScheduleMode
+
+        changed = [key for key, value in settings.items()
+                   if current.get(key) != value]
+        # populated by read_settings() in the same session
+        data = device.settings
+        for key in changed:
+            if key == 'name':
+                continue
+            value = settings[key]
+            if key == 'schedule_mode':
+                value = ScheduleMode[value.upper()]
+            setattr(data, _SETTINGS_ATTRIBUTES[key], value)
+        if any(key != 'name' for key in changed):
+            data.save()
+        if 'name' in changed:
+            # saved right away by libetrv
+            device.name = settings['name']
+        return changed
 
     @staticmethod
-    def set_temperature(device: eTRVDevice, temperature: float):
+    def set_temperature(device: 'eTRVDevice', temperature: float):
+        # set point is written together with the rest of temperature struct, read it fresh first.
+        # After the write libetrv cache holds new set point and room temperature from this session.
+        if 'temperature' in device.fields:
+            device.fields['temperature'].invalidate()
         device.temperature.set_point_temperature = float(temperature)
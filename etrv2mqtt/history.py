@@ -0,0 +1,130 @@
+import math
+import threading
+import time
+from array import array
+from typing import Dict, List, Optional
+
+from etrv2mqtt.etrvutils import eTRVData
+
+_FIELDS = ('room_temp', 'set_point', 'battery')
+
+
+class RingBuffer():
+    """Fixed number of (timestamp, room_temp, set_point, battery) samples in typed arrays,
+    oldest samples are overwritten. Missing values are stored as NaN and -1 battery."""
+
+    def __init__(self, capacity: int):
+        self._capacity = capacity
+        self._lock = threading.Lock()
+        # allocated up front, memory doesn't grow with uptime
+        self._timestamps = array('d', bytes(8 * capacity))
+        self._room_temps = array('f', bytes(4 * capacity))
+        self._set_points = array('f', bytes(4 * capacity))
+        self._batteries = array('b', bytes(capacity))
+        self._next = 0
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, timestamp: float, room_temp: Optional[float], set_point: Optional[float],
+               battery: Optional[int]):
+        with self._lock:
+            i = self._next
+            self._timestamps[i] = timestamp
+            self._room_temps[i] = math.nan if room_temp is None else room_temp
+            self._set_points[i] = math.nan if set_point is None else set_point
+            self._batteries[i] = -1 if battery is None else battery
+            self._next = (i + 1) % self._capacity
+            self._count = min(self._count + 1, self._capacity)
+
+    def samples(self, start: float, end: float) -> List[tuple]:
+        """(timestamp, room_temp, set_point, battery) with start <= timestamp < end, oldest first"""
+        with self._lock:
+            first = (self._next - self._count) % self._capacity
+            ret = []
+            for n in range(self._count):
+                i = (first + n) % self._capacity
+                timestamp = self._timestamps[i]
+                if start <= timestamp < end:
+                    ret.append((timestamp, self._room_temps[i], self._set_points[i],
+                                self._batteries[i]))
+            return ret
+
+
+def _value(value: float) -> Optional[float]:
+    # float32 storage, round back to thermostat resolution
+    return None if math.isnan(value) else round(value, 2)
+
+
+def _aggregate(values: List[float]) -> Optional[Dict[str, float]]:
+    if len(values) == 0:
+        return None
+    return {'min': round(min(values), 2), 'max': round(max(values), 2),
+            'avg': round(sum(values) / len(values), 2)}
+
+
+class History():
+    """Recent readings of every thermostat, capacity samples per thermostat"""
+
+    def __init__(self, capacity: int):
+        self._capacity = capacity
+        self._lock = threading.Lock()
+        self._buffers: Dict[str, RingBuffer] = {}
+
+    def record(self, name: str, data: eTRVData):
+        buffer = self._buffers.get(name)
+        if buffer is None:
+            with self._lock:
+                buffer = self._buffers.setdefault(
+                    name, RingBuffer(self._capacity))
+        buffer.append(data.last_update.timestamp(), data.room_temp,
+                      data.set_point, data.battery)
+
+    def remove(self, name: str):
+        with self._lock:
+            self._buffers.pop(name, None)
+
+    def query(self, name: str, start: Optional[float] = None, end: Optional[float] = None,
+              step: float = 0, now: Optional[float] = None) -> Dict:
+        """Samples between start and end in epoch seconds, negative values are relative to now.
+        With step > 0 samples are downsampled to min/max/avg of step seconds long windows."""
+        now = time.time() if now is None else now
+        start = -math.inf if start is None else (now + start if start < 0 else start)
+        end = math.inf if end is None else (now + end if end <= 0 else end)
+        buffer = self._buffers.get(name)
+        samples = buffer.samples(start, end) if buffer is not None else []
+
+        if step <= 0:
+            return {'name': name, 'step': 0, 'samples': [
+                {'t': timestamp, 'room_temp': _value(room_temp), 'set_point': _value(set_point),
+                 'battery': None if battery < 0 else battery}
+                for timestamp, room_temp, set_point, battery in samples]}
+
+        windows: List[Dict] = []
+        values: Dict[str, List[float]] = {}
+        window_start = None
+        for timestamp, room_temp, set_point, battery in samples:
+            # aligned to multiples of step, same windows in every query
+            bucket = math.floor(timestamp / step) * step
+            if bucket != window_start:
+                if window_start is not None:
+                    windows.append(self._window(window_start, values))
+                window_start = bucket
+                values = {field: [] for field in _FIELDS}
+            if not math.isnan(room_temp):
+                values['room_temp'].append(room_temp)
+            if not math.isnan(set_point):
+                values['set_point'].append(set_point)
+            if battery >= 0:
+                values['battery'].append(battery)
+        if window_start is not None:
+            windows.append(self._window(window_start, values))
+        return {'name': name, 'step': step, 'windows': windows}
+
+    @staticmethod
+    def _window(start: float, values: Dict[str, List[float]]) -> Dict:
+        window: Dict = {'t': start, 'n': max(len(v) for v in values.values())}
+        for field in _FIELDS:
+            window[field] = _aggregate(values[field])
+        return window
@@ -0,0 +1,320 @@
+import bisect
+import json
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from loguru import logger
+
+
+class _Value():
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = 0.0
+        self._function: Optional[Callable[[], float]] = None
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1.0):
+        with self._lock:
+            self._value -= amount
+
+    def set(self, value: float):
+        with self._lock:
+            self._value = value
+
+    def set_function(self, function: Callable[[], float]):
+        """Value is read from function whenever metrics are collected"""
+        self._function = function
+
+    def get(self) -> float:
+        if self._function is not None:
+            return float(self._function())
+        with self._lock:
+            return self._value
+
+
+class _HistogramValue():
+    def __init__(self, buckets: Sequence[float]):
+        self._lock = threading.Lock()
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def get(self) -> Tuple[List[int], float]:
+        with self._lock:
+            return list(self._counts), self._sum
+
+
+class _Metric(ABC):
+    metric_type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children: Dict[Tuple[str, ...], object] = {}
+
+    @abstractmethod
+    def _new_child(self):
+        """Value object holding one set of labels"""
+        pass
+
+    def labels(self, *labelvalues):
+        key = tuple(str(value) for value in labelvalues)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError("{} expects labels {}".format(
+                    self.name, self.labelnames))
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def remove(self, *labelvalues):
+        with self._lock:
+            self._children.pop(tuple(str(value)
+                                     for value in labelvalues), None)
+
+    def children(self) -> List[Tuple[Dict[str, str], object]]:
+        with self._lock:
+            items = list(self._children.items())
+        return [(dict(zip(self.labelnames, key)), child) for key, child in items]
+
+
+class Counter(_Metric):
+    metric_type = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+
+class Gauge(_Metric):
+    metric_type = 'gauge'
+
+    def _new_child(self):
+        return _Value()
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def set_function(self, function: Callable[[], float]):
+        self.labels().set_function(function)
+
+
+class Histogram(_Metric):
+    metric_type = 'histogram'
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                       0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for k, v in labels.items()) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class MetricsRegistry():
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def _register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = Histogram.DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """Metrics in Prometheus text exposition format"""
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.append('# HELP {} {}'.format(
+                metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(
+                metric.name, metric.metric_type))
+            for labels, child in metric.children():
+                if isinstance(metric, Histogram):
+                    counts, total = child.get()
+                    cumulative = 0
+                    for bound, count in zip(metric.buckets + (float('inf'),), counts):
+                        cumulative += count
+                        bucket_labels = dict(labels, le=_format_value(bound))
+                        lines.append('{}_bucket{} {}'.format(
+                            metric.name, _format_labels(bucket_labels), cumulative))
+                    lines.append('{}_sum{} {}'.format(
+                        metric.name, _format_labels(labels), _format_value(total)))
+                    lines.append('{}_count{} {}'.format(
+                        metric.name, _format_labels(labels), cumulative))
+                else:
+                    lines.append('{}{} {}'.format(
+                        metric.name, _format_labels(labels), _format_value(child.get())))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> Dict[str, List[Dict]]:
+        """Metrics as JSON serializable dict, histograms are reduced to count and sum"""
+        ret: Dict[str, List[Dict]] = {}
+        for metric in self._metrics:
+            samples = []
+            for labels, child in metric.children():
+                if isinstance(metric, Histogram):
+                    counts, total = child.get()
+                    samples.append(
+                        {'labels': labels, 'count': sum(counts), 'sum': total})
+                else:
+                    samples.append({'labels': labels, 'value': child.get()})
+            ret[metric.name] = samples
+        return ret
+
+
+class MetricsHttpServer():
+    """Serves registry in Prometheus text format on /metrics and JSON of added routes"""
+
+    def __init__(self, registry: MetricsRegistry, address: str, port: int):
+        # only imported when metrics server is enabled
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from urllib.parse import parse_qs, unquote, urlsplit
+        routes: Dict[str, Callable[[str, Dict[str, str]], Optional[object]]] = {}
+        self._routes = routes
+
+        class Handler(BaseHTTPRequestHandler):
+            def _send(self, body: bytes, content_type: str):
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                if url.path == '/metrics':
+                    self._send(registry.render().encode('utf-8'),
+                               'text/plain; version=0.0.4; charset=utf-8')
+                    return
+                for prefix, handler in list(routes.items()):
+                    if url.path.startswith(prefix):
+                        params = {key: values[-1]
+                                  for key, values in parse_qs(url.query).items()}
+                        try:
+                            ret = handler(unquote(url.path[len(prefix):]), params)
+                        except ValueError as e:
+                            self.send_error(400, str(e))
+                            return
+                        if ret is None:
+                            break
+                        self._send(json.dumps(ret).encode('utf-8'),
+                                   'application/json')
+                        return
+                self.send_error(404)
+
+            def log_message(self, format, *args):
+                logger.debug("metrics: " + format, *args)
+
+        self._server = ThreadingHTTPServer((address, port), Handler)
+        self._server.daemon_threads = True
+
+    def add_route(self, prefix: str, handler: Callable[[str, Dict[str, str]], Optional[object]]):
+        """Serves handler(rest of path, query parameters) as JSON on paths starting with prefix,
+        None means not found and ValueError bad request"""
+        self._routes[prefix] = handler
+
+    def start(self):
+        logger.info("Serving metrics on {}:{}", *
+                    self._server.server_address[:2])
+        threading.Thread(target=self._server.serve_forever,
+                         daemon=True, name='etrv-metrics').start()
+
+
+registry = MetricsRegistry()
+
+ble_operation_seconds = registry.histogram(
+    'etrv_ble_operation_seconds', 'Duration of BLE operations', ('operation',))
+device_field_reads_total = registry.counter(
+    'etrv_device_field_reads_total', 'Thermostat fields read over BLE, fields not due for refresh are reused', ('field',))
+device_failures_total = registry.counter(
+    'etrv_device_failures_total', 'Failed thermostat operations', ('device', 'error'))
+mqtt_publish_total = registry.counter(
+    'etrv_mqtt_publish_total', 'Messages published to MQTT server', ('kind',))
+mqtt_queue_depth = registry.gauge(
+    'etrv_mqtt_queue_depth', 'Messages handed to MQTT client and waiting to be written to socket')
+mqtt_outbound_queue_depth = registry.gauge(
+    'etrv_mqtt_outbound_queue_depth', 'Messages held in outbound queue until MQTT client can take them')
+mqtt_handler_queue_depth = registry.gauge(
+    'etrv_mqtt_handler_queue_depth', 'Received messages waiting for handler worker')
+mqtt_compacted_total = registry.counter(
+    'etrv_mqtt_compacted_total', 'Queued messages replaced by a newer message to the same topic')
+mqtt_dropped_total = registry.counter(
+    'etrv_mqtt_dropped_total', 'Messages dropped because outbound queue was full', ('policy',))
+setpoints_coalesced_total = registry.counter(
+    'etrv_setpoints_coalesced_total', 'Setpoint requests merged into a later one before writing')
+scheduler_lag_seconds = registry.histogram(
+    'etrv_scheduler_lag_seconds', 'Delay between planned and actual start of scheduled jobs')
+connection_pool_total = registry.counter(
+    'etrv_connection_pool_total', 'BLE connection pool events', ('event',))
+connection_pool_open = registry.gauge(
+    'etrv_connection_pool_open', 'Open pooled BLE connections')
+coordination_owned_devices = registry.gauge(
+    'etrv_coordination_owned_devices', 'Thermostats owned by this node in coordination mode')
+coordination_events_total = registry.counter(
+    'etrv_coordination_events_total', 'Thermostat claims made, taken over, lost and released by this node', ('event',))
+breaker_open_devices = registry.gauge(
+    'etrv_breaker_open_devices', 'Thermostats taken out of polling after repeated failures')
+radio_busy_seconds_total = registry.counter(
+    'etrv_radio_busy_seconds_total', 'Time adapters spent on thermostat operations', ('adapter',))
+radio_occupancy_ratio = registry.gauge(
+    'etrv_radio_occupancy_ratio', 'Share of last poll cycle adapter spent on thermostat operations', ('adapter',))
+radio_peak_occupancy_ratio = registry.gauge(
+    'etrv_radio_peak_occupancy_ratio', 'Occupancy of the busiest tenth of last poll cycle', ('adapter',))
+absent_devices = registry.gauge(
+    'etrv_absent_devices', 'Thermostats not polled because presence scan has not seen them recently')
@@ -1,104 +1,559 @@
 from __future__ import annotations
 
-from typing import Callable, Dict
+import asyncio
+import json
+import queue
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Mapping, Optional, Set, Tuple, Union
 
 import paho.mqtt.client as paho_mqtt
 from loguru import logger
 
-from .autodiscovery import Autodiscovery, AutodiscoveryResult
+from . import metrics
+from .autodiscovery import Autodiscovery
+from .commands import ZONE, CommandHandler, CommandRouter
 from .config import Config
+from .etrvutils import eTRVData, format_timestamp
+from .statecache import StateChangeCache
+
+
+class OutboundQueue():
+    """Bounded queue of messages waiting for MQTT client. Holds only the latest
+    message per topic, when full applies drop_oldest, drop_newest or block policy."""
+
+    def __init__(self, max_size: int, full_policy: str, block_timeout: float):
+        self._max_size = max_size
+        self._full_policy = full_policy
+        self._block_timeout = block_timeout
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+        # topic -> (payload, retain), oldest first
+        self._messages: 'OrderedDict[str, Tuple[Union[str, bytes], bool]]' = OrderedDict()
+        self.compacted = 0
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def put(self, topic: str, payload: Union[str, bytes], retain: bool = False, block: bool = False):
+        """Queues message. Block policy waits only if block is True, callers
+        on MQTT network thread must not wait for it to make room."""
+        with self._lock:
+            if topic in self._messages:
+                # last value wins, message moves to the end like a new one
+                del self._messages[topic]
+                self.compacted += 1
+                metrics.mqtt_compacted_total.inc()
+            elif len(self._messages) >= self._max_size:
+                if self._full_policy == 'block' and block:
+                    self._not_full.wait_for(lambda: len(self._messages) < self._max_size,
+                                            self._block_timeout)
+                if len(self._messages) >= self._max_size:
+                    self.dropped += 1
+                    metrics.mqtt_dropped_total.labels(self._full_policy).inc()
+                    if self._full_policy == 'drop_oldest':
+                        self._messages.popitem(last=False)
+                    else:
+                        return
+            self._messages[topic] = (payload, retain)
+
+    def pop_batch(self, size: int) -> List[Tuple[str, Union[str, bytes], bool]]:
+        with self._lock:
+            batch = []
+            while len(batch) < size and len(self._messages) > 0:
+                topic, (payload, retain) = self._messages.popitem(last=False)
+                batch.append((topic, payload, retain))
+            if len(batch) > 0:
+                self._not_full.notify_all()
+            return batch
+
+
+class HandlerWorker():
+    """Runs message handlers one at a time in arrival order outside MQTT network I/O,
+    on a worker thread or as event loop callbacks in asyncio mode"""
+
+    def __init__(self):
+        self._queue: queue.Queue = queue.Queue()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def __len__(self) -> int:
+        return self._queue.qsize()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run_forever, daemon=True,
+                                            name='etrv-mqtt-handlers')
+            self._thread.start()
+
+    def use_loop(self, loop: asyncio.AbstractEventLoop):
+        # asyncio mode handlers touch loop objects and must run on its thread
+        self._loop = loop
+
+    @staticmethod
+    def _run(handler: Callable, args: tuple):
+        try:
+            handler(*args)
+        except Exception:
+            logger.exception("MQTT message handler failed")
+
+    def _run_forever(self):
+        while True:
+            handler, args = self._queue.get()
+            self._run(handler, args)
+
+    def dispatch(self, handler: Callable, *args):
+        if self._loop is not None:
+            # after the current socket read is fully processed
+            self._loop.call_soon(self._run, handler, args)
+        elif self._thread is not None:
+            self._queue.put((handler, args))
+        else:
+            self._run(handler, args)
+
+
+# every Mqtt of the process counts, several run side by side in the multinode harness
+_instances: 'weakref.WeakSet[Mqtt]' = weakref.WeakSet()
+
+
+def _total(value: Callable[[Mqtt], int]) -> Callable[[], int]:
+    return lambda: sum(value(instance) for instance in list(_instances))
+
+
+metrics.mqtt_handler_queue_depth.set_function(
+    _total(lambda mqtt: len(mqtt._handler_worker)))
+metrics.mqtt_queue_depth.set_function(
+    _total(lambda mqtt: mqtt._client_queue_depth()))
+metrics.mqtt_outbound_queue_depth.set_function(
+    _total(lambda mqtt: len(mqtt._outbound)))
 
 
 class Mqtt(object):
 
     _is_connected: bool = False
+    _set_temperature_callback: Optional[Callable[[Mqtt, str, float], None]] = None
+    _hass_birth_callback: Optional[Callable[[Mqtt], None]] = None
+    _connected_callback: Optional[Callable[[Mqtt], None]] = None
 
     def is_connected(self) -> bool:
         return self._is_connected
 
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, autostart: bool = True):
         self._config = config
 
-        self._client = paho_mqtt.Client()
+        self._state_cache: Optional[StateChangeCache] = None
+        if config.suppress_unchanged_state:
+            self._state_cache = StateChangeCache(config.room_temp_deadband, config.battery_deadband,
+                                                 config.state_max_silence)
+
+        # thermostats announced by autodiscovery, None means all. In coordination
+        # mode only owned ones, see set_autodiscovery_devices()
+        self._autodiscovery_devices: Optional[Set[str]] = set() if config.coordination else None
+        self._autodiscovery_payloads: Mapping[str, bytes] = {}
+        if config.mqtt.autodiscovery:
+            self._autodiscovery_payloads = Autodiscovery(
+                config).payloads(self._autodiscovery_devices)
+        # retained autodiscovery payloads received from broker during sync
+        self._broker_autodiscovery: Dict[str, bytes] = {}
+        self._autodiscovery_sync_topic = config.mqtt.base_topic + \
+            '/_autodiscovery_sync/' + uuid.uuid4().hex
+
+        # coordinated nodes need distinct client ids, server assigns one otherwise
+        self._client = paho_mqtt.Client(
+            'etrv2mqtt-' + config.node_name if config.coordination else '')
         self._client.on_connect = self._on_connect
         self._client.on_disconnect = self._on_disconnect
         self._client.on_message = self._on_message
+        self._client.on_publish = self._on_publish
+
+        self._outbound = OutboundQueue(config.mqtt.queue_size, config.mqtt.queue_full_policy,
+                                       config.mqtt.queue_block_timeout)
+        self._flush_lock = threading.Lock()
+        # messages handed to paho and not yet written to socket
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+        # per thermostat command topics, see add_device_command()
+        self._router = CommandRouter(config.mqtt.base_topic)
+        self._router.set_targets(config.thermostats.keys())
+        self._router.set_targets(config.zones.keys(), ZONE)
+        self._router.register('set', self._on_set_command)
+        self._subscribed_command_topics: List[str] = []
+        # (topic filter, handler) registered with add_handler()
+        self._handlers: List[Tuple[str, Callable[[str, bytes, bool], None]]] = []
+        self._handler_worker = HandlerWorker()
+        _instances.add(self)
 
         if config.mqtt.user is not None:
             self._client.username_pw_set(
                 config.mqtt.user, password=config.mqtt.password)
-        logger.debug("connecting to {}:{}",
-                     config.mqtt.server, config.mqtt.port)
 
-        self._client.will_set(self._config.mqtt.base_topic +
-                              '/state', 'offline', retain=True)
-        self._client.connect_async(config.mqtt.server, port=config.mqtt.port)
+        self._client.will_set(self._config.availability_topic,
+                              'offline', retain=True)
+        if autostart:
+            self.start()
+
+    def start(self):
+        """Connect and run MQTT network I/O on paho background thread"""
+        logger.debug("connecting to {}:{}",
+                     self._config.mqtt.server, self._config.mqtt.port)
+        self._handler_worker.start()
+        self._client.connect_async(
+            self._config.mqtt.server, port=self._config.mqtt.port)
         self._client.loop_start()
 
-    def publish_device_data(self, name: str, data: str):
+    async def run_async(self):
+        """Connect and run MQTT network I/O on the running asyncio event loop.
+        Callbacks are then called from the event loop thread."""
+        loop = asyncio.get_running_loop()
+        self._handler_worker.use_loop(loop)
+
+        # publish() may be called from executor threads, asyncio loop must only be touched from its own thread
+        def on_socket_open(client, userdata, sock):
+            loop.call_soon_threadsafe(loop.add_reader, sock, client.loop_read)
+
+        def on_socket_close(client, userdata, sock):
+            loop.call_soon_threadsafe(loop.remove_reader, sock)
+
+        def on_socket_register_write(client, userdata, sock):
+            loop.call_soon_threadsafe(loop.add_writer, sock, client.loop_write)
+
+        def on_socket_unregister_write(client, userdata, sock):
+            loop.call_soon_threadsafe(loop.remove_writer, sock)
+
+        self._client.on_socket_open = on_socket_open
+        self._client.on_socket_close = on_socket_close
+        self._client.on_socket_register_write = on_socket_register_write
+        self._client.on_socket_unregister_write = on_socket_unregister_write
+
+        logger.debug("connecting to {}:{}",
+                     self._config.mqtt.server, self._config.mqtt.port)
+        self._client.connect_async(
+            self._config.mqtt.server, port=self._config.mqtt.port)
+
+        reconnect_delay = 1
+        while True:
+            try:
+                # DNS lookup and TCP connect block, socket callbacks above are thread safe
+                await loop.run_in_executor(None, self._client.reconnect)
+            except OSError as e:
+                logger.warning("Unable to connect to MQTT server: {}", e)
+                await asyncio.sleep(reconnect_delay)
+                reconnect_delay = min(reconnect_delay * 2, 120)
+                continue
+
+            reconnect_delay = 1
+            # keepalive handling, returns error once connection is lost
+            while self._client.loop_misc() == paho_mqtt.MQTT_ERR_SUCCESS:
+                await asyncio.sleep(1)
+
+    def _client_queue_depth(self) -> int:
+        return self._in_flight
+
+    def _send(self, topic: str, payload: Union[str, bytes], retain: bool = False):
+        """Hands message to paho, on_publish is called once it is written to socket"""
+        with self._in_flight_lock:
+            self._in_flight += 1
+        if self._client.publish(topic, payload=payload, retain=retain).rc != paho_mqtt.MQTT_ERR_SUCCESS:
+            self._message_written()
+
+    def _message_written(self):
+        with self._in_flight_lock:
+            self._in_flight = max(0, self._in_flight - 1)
+
+    def _reset_in_flight(self):
+        # paho drops unwritten messages when connection is lost
+        with self._in_flight_lock:
+            self._in_flight = 0
+
+    def _publish(self, topic: str, payload: Union[str, bytes], retain: bool = False, block: bool = False):
+        """Publishes directly while connected and paho keeps up, queues message otherwise"""
+        # batch popped by a running flush must reach paho before newer messages
+        with self._flush_lock:
+            if self._client.is_connected() and len(self._outbound) == 0 and \
+                    self._client_queue_depth() < self._config.mqtt.flush_batch_size:
+                self._send(topic, payload, retain)
+                return
+        self._outbound.put(topic, payload, retain, block)
+        self._flush()
+
+    def _flush(self):
+        """Hands queued messages to paho in batches, next batch goes once previous one is written"""
+        if len(self._outbound) == 0 or not self._client.is_connected():
+            return
+        # keeps order of messages, other threads just leave flushing to the current one
+        if not self._flush_lock.acquire(blocking=False):
+            return
+        try:
+            room = self._config.mqtt.flush_batch_size - self._client_queue_depth()
+            for topic, payload, retain in self._outbound.pop_batch(room):
+                self._send(topic, payload, retain)
+        finally:
+            self._flush_lock.release()
+
+    def publish(self, topic: str, payload: Union[str, bytes], retain: bool = False):
+        self._publish(topic, payload, retain)
+
+    def add_handler(self, topic_filter: str, handler: Callable[[str, bytes, bool], None]):
+        """Subscribes to topic_filter and calls handler(topic, payload, retain) for matching messages.
+        Handlers run one at a time on handler worker thread (event loop thread in asyncio mode)."""
+        self._handlers.append((topic_filter, handler))
+        if self._client.is_connected():
+            self._client.subscribe(topic_filter)
+
+    def add_device_command(self, command: str, handler: CommandHandler):
+        """Subscribes to <base_topic>/<thermostat>/<command> of every configured thermostat and calls
+        handler(thermostat, payload, retain) the same way as add_handler() handlers"""
+        self._router.register(command, handler)
+        self._update_command_subscriptions()
+
+    def add_zone_command(self, command: str, handler: CommandHandler):
+        """Same as add_device_command() for <base_topic>/<zone>/<command> of configured zones"""
+        self._router.register(command, handler, ZONE)
+        self._update_command_subscriptions()
+
+    def publish_device_data(self, name: str, data: eTRVData, stale: bool = False):
+        if stale:
+            # not remembered by state cache, first real reading is always published.
+            # Sent from event loop thread in asyncio mode, must not wait for queue room.
+            self._publish(self._config.mqtt.base_topic+'/'+name+'/state',
+                          data.to_bytes(stale=True))
+            metrics.mqtt_publish_total.labels('stale_state').inc()
+            return
+
+        if self._state_cache is not None and not self._state_cache.update(name, data):
+            if self._config.state_heartbeat:
+                self._publish(self._config.mqtt.base_topic+'/'+name+'/heartbeat',
+                              format_timestamp(data.last_update), block=True)
+                metrics.mqtt_publish_total.labels('heartbeat').inc()
+            return
+
+        self._publish(self._config.mqtt.base_topic+'/'+name+'/state',
+                      data.to_bytes(), block=True)
+        metrics.mqtt_publish_total.labels('state').inc()
+
+    def publish_metrics(self):
+        """Publish snapshot of all metrics as JSON to <base_topic>/_diagnostics/metrics
+        (<base_topic>/_diagnostics/<shard>/metrics in sharded mode)"""
         if self._client.is_connected():
-            self._client.publish(
-                self._config.mqtt.base_topic+'/'+name+'/state', payload=data)
+            shard = '' if self._config.shard is None else str(
+                self._config.shard) + '/'
+            self._publish(self._config.mqtt.base_topic+'/_diagnostics/'+shard+'metrics',
+                          json.dumps(metrics.registry.snapshot()))
+            metrics.mqtt_publish_total.labels('diagnostics').inc()
+
+    def _publish_autodiscovery(self, topics: Iterable[str]):
+        for topic in topics:
+            self._publish(topic, self._autodiscovery_payloads[topic],
+                          retain=self._config.mqtt.autodiscovery_retain)
+            metrics.mqtt_publish_total.labels('autodiscovery').inc()
+
+    def _command_topics(self) -> List[str]:
+        # in sharded mode remaining thermostats are handled by other workers
+        return self._router.topic_filters(per_target=self._config.shard is not None)
+
+    def _update_command_subscriptions(self):
+        previous = self._subscribed_command_topics
+        self._subscribed_command_topics = self._command_topics()
+        if self._client.is_connected():
+            removed = [topic for topic in previous
+                       if topic not in self._subscribed_command_topics]
+            added = [topic for topic in self._subscribed_command_topics
+                     if topic not in previous]
+            if len(removed) > 0:
+                self._client.unsubscribe(removed)
+            if len(added) > 0:
+                self._client.subscribe([(topic, 0) for topic in added])
+
+    def reload_thermostats(self):
+        """Updates subscriptions and autodiscovery after thermostats or zones in config changed"""
+        self._router.set_targets(self._config.thermostats.keys())
+        self._router.set_targets(self._config.zones.keys(), ZONE)
+        self._update_command_subscriptions()
+        self._reload_autodiscovery()
+
+    def _reload_autodiscovery(self):
+        """Only entities of added or modified thermostats are published, entities of removed ones are cleared"""
+        if not self._config.mqtt.autodiscovery:
+            return
+        previous = self._autodiscovery_payloads
+        self._autodiscovery_payloads = Autodiscovery(
+            self._config).payloads(self._autodiscovery_devices)
+        if not self._client.is_connected():
+            # everything is synced on connect
+            return
+
+        removed = [topic for topic in previous.keys()
+                   if topic not in self._autodiscovery_payloads]
+        changed = [topic for topic, payload in self._autodiscovery_payloads.items()
+                   if previous.get(topic) != payload]
+        logger.debug("Clearing {} and publishing {} autodiscovery messages",
+                     len(removed), len(changed))
+        for topic in removed:
+            # empty payload removes entity from Home Assistant
+            self._publish(topic, b'',
+                          retain=self._config.mqtt.autodiscovery_retain)
+            metrics.mqtt_publish_total.labels('autodiscovery').inc()
+        self._publish_autodiscovery(changed)
+
+    def set_autodiscovery_devices(self, names: Optional[Iterable[str]]):
+        """Limits autodiscovery to given thermostats, None announces all of them. Entities
+        of thermostats left out are not cleared, another bridge node announces them."""
+        self._autodiscovery_devices = None if names is None else set(names)
+        if not self._config.mqtt.autodiscovery:
+            return
+        previous = self._autodiscovery_payloads
+        self._autodiscovery_payloads = Autodiscovery(
+            self._config).payloads(self._autodiscovery_devices)
+        if self._client.is_connected():
+            self._publish_autodiscovery([topic for topic, payload in self._autodiscovery_payloads.items()
+                                         if previous.get(topic) != payload])
+
+    def publish_device_availability(self, name: str, available: bool):
+        self._publish(self._config.device_availability_topic(name),
+                      'online' if available else 'offline', retain=True)
+        metrics.mqtt_publish_total.labels('availability').inc()
 
-    def _publish_autodiscovery_result(self, result: AutodiscoveryResult, retain: bool = False):
-        self._client.publish(
-            result.topic, payload=result.payload, retain=retain)
+    def publish_zone_state(self, zone: str, state: bytes):
+        self._publish(self._config.mqtt.base_topic+'/'+zone+'/state', state)
+        metrics.mqtt_publish_total.labels('zone_state').inc()
+
+    def publish_device_rssi(self, name: str, rssi: int):
+        # sent after every reading, from event loop thread in asyncio mode
+        self._publish(self._config.mqtt.base_topic+'/'+name+'/rssi', str(rssi))
+        metrics.mqtt_publish_total.labels('rssi').inc()
+
+    def forget_device(self, name: str):
+        if self._state_cache is not None:
+            self._state_cache.invalidate(name)
+        self._publish(self._config.device_availability_topic(name),
+                      b'', retain=True)
+
+    def _sync_autodiscovery(self):
+        if len(self._autodiscovery_payloads) == 0:
+            return
+
+        if not self._config.mqtt.autodiscovery_retain:
+            self._publish_autodiscovery(self._autodiscovery_payloads.keys())
+            return
+
+        # Fetch retained payloads from broker and publish only ones that differ.
+        # Broker handles messages in order so all retained messages are
+        # delivered before our own sync message comes back.
+        self._broker_autodiscovery = {}
+        self._client.subscribe([(topic, 0) for topic in self._autodiscovery_payloads.keys()] +
+                               [(self._autodiscovery_sync_topic, 0)])
+        self._send(self._autodiscovery_sync_topic, b'')
+
+    def _finish_autodiscovery_sync(self):
+        self._client.unsubscribe(list(self._autodiscovery_payloads.keys()) +
+                                 [self._autodiscovery_sync_topic])
+        changed = [topic for topic, payload in self._autodiscovery_payloads.items()
+                   if self._broker_autodiscovery.get(topic) != payload]
+        logger.debug("Publishing {} of {} autodiscovery messages",
+                     len(changed), len(self._autodiscovery_payloads))
+        self._publish_autodiscovery(changed)
+        self._broker_autodiscovery = {}
 
     def _on_connect(self, client, userdata, flags, rc):
         logger.info("Connected to MQTT server")
+        self._reset_in_flight()
+
+        # retained state may have been lost, publish everything again
+        if self._state_cache is not None:
+            self._state_cache.invalidate()
 
-        self._client.publish(self._config.mqtt.base_topic +
-                             '/state', 'online', retain=True)
+        self._send(self._config.availability_topic, 'online', retain=True)
 
         if self._config.mqtt.autodiscovery:
-            ad = Autodiscovery(self._config)
-            for thermostat in self._config.thermostats.values():
-                self._publish_autodiscovery_result(ad.register_termostat(
-                    thermostat.topic, thermostat.address), self._config.mqtt.autodiscovery_retain)
-                self._publish_autodiscovery_result(ad.register_battery(
-                    thermostat.topic, thermostat.address), self._config.mqtt.autodiscovery_retain)
-                self._publish_autodiscovery_result(ad.register_reported_name(
-                    thermostat.topic, thermostat.address), self._config.mqtt.autodiscovery_retain)
-                if self._config.report_room_temperature:
-                    self._publish_autodiscovery_result(ad.register_room_temperature(
-                        thermostat.topic, thermostat.address), self._config.mqtt.autodiscovery_retain)
-                self._publish_autodiscovery_result(ad.register_last_update_timestamp(
-                    thermostat.topic, thermostat.address), self._config.mqtt.autodiscovery_retain)
-
-        # subscribe to set temperature topics
-        self._client.subscribe(
-            self._config.mqtt.base_topic+'/+/set')
+            self._sync_autodiscovery()
+
+        # subscribe to thermostat command topics
+        self._subscribed_command_topics = self._command_topics()
+        self._client.subscribe([(topic, 0)
+                                for topic in self._subscribed_command_topics])
 
         # subscribe to Home Assistant birth topic
         self._client.subscribe(self._config.mqtt.hass_birth_topic)
 
+        if len(self._handlers) > 0:
+            self._client.subscribe([(topic_filter, 0)
+                                    for topic_filter, _ in self._handlers])
+
         self._is_connected = True
 
+        # messages queued while disconnected
+        if len(self._outbound) > 0:
+            logger.info("Flushing {} queued messages", len(self._outbound))
+            self._flush()
+
+        if self._connected_callback is not None:
+            self._connected_callback(self)
+
     def _on_disconnect(self, client, userdata, rc):
         logger.debug("disconnected from mqtt server")
         self._is_connected = False
+        self._reset_in_flight()
+
+    def _on_publish(self, client, userdata, mid):
+        self._message_written()
+        self._flush()
+
+    def _on_set_command(self, name: str, payload: bytes, retain: bool):
+        try:
+            temperature = float(payload)
+        except ValueError:
+            logger.warning("{}: {} is not a valid float", name, payload)
+            return
+        if self._set_temperature_callback is not None:
+            self._set_temperature_callback(self, name, temperature)
 
     def _on_message(self, client, userdata, msg):
+        # thermostat commands
+        route = self._router.route(msg.topic)
+        if route is not None:
+            name, command_handler = route
+            self._handler_worker.dispatch(
+                command_handler, name, msg.payload, msg.retain)
+            return
+
+        for topic_filter, handler in self._handlers:
+            if paho_mqtt.topic_matches_sub(topic_filter, msg.topic):
+                self._handler_worker.dispatch(
+                    handler, msg.topic, msg.payload, msg.retain)
+                return
+
+        # autodiscovery sync
+        if msg.topic == self._autodiscovery_sync_topic:
+            self._finish_autodiscovery_sync()
+        elif msg.topic in self._autodiscovery_payloads:
+            if msg.retain:
+                self._broker_autodiscovery[msg.topic] = msg.payload
+
         # hass birth message
-        if msg.topic == self._config.mqtt.hass_birth_topic:
+        elif msg.topic == self._config.mqtt.hass_birth_topic:
             try:
                 # MQTT payload can be random bytes
                 payload_str = msg.payload.decode("utf-8")
-                if payload_str == self._config.mqtt.hass_birth_payload and self._hass_birth_callback is not None:
-                    self._hass_birth_callback(self)
+                if payload_str == self._config.mqtt.hass_birth_payload:
+                    if self._state_cache is not None:
+                        self._state_cache.invalidate()
+                    # Home Assistant only knows retained autodiscovery messages after restart
+                    if self._config.mqtt.autodiscovery and not self._config.mqtt.autodiscovery_retain:
+                        self._publish_autodiscovery(
+                            self._autodiscovery_payloads.keys())
+                    if self._hass_birth_callback is not None:
+                        self._hass_birth_callback(self)
             except UnicodeError:
                 pass
 
-        # thermostat set temperature message
-        elif msg.topic.startswith(self._config.mqtt.base_topic) and msg.topic.endswith('/set'):
-            name = msg.topic.split('/')[-2]
-            try:
-                if self._set_temperature_callback is not None:
-                    self._set_temperature_callback(
-                        self, name, float(msg.payload))
-            except ValueError:
-                logger.warning("{}: {} is not a valid float",
-                               name, msg.payload)
+        else:
+            name = self._router.unknown_thermostat(msg.topic)
+            if name is not None:
+                logger.warning("Device {} not found", name)
 
     @property
     def set_temperature_callback(self) -> Callable[[Mqtt, str, float], None]:
@@ -115,3 +570,11 @@ class Mqtt(object):
     @hass_birth_callback.setter
     def hass_birth_callback(self, callback: Callable[[Mqtt], None]):
         self._hass_birth_callback = callback
+
+    @property
+    def connected_callback(self) -> Optional[Callable[[Mqtt], None]]:
+        return self._connected_callback
+
+    @connected_callback.setter
+    def connected_callback(self, callback: Optional[Callable[[Mqtt], None]]):
+        self._connected_callback = callback
@@ -0,0 +1,72 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from itertools import zip_longest
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from loguru import logger
+
+from etrv2mqtt.presence import RadioGate
+from etrv2mqtt.scheduling import RadioOccupancy
+
+PollJob = Tuple[int, Callable[[], None]]
+
+
+class PollingEngine():
+    """Runs device jobs on a worker pool, limiting concurrent jobs per HCI adapter"""
+
+    def __init__(self, workers: int, adapters: Iterable[int], adapter_max_connections: int,
+                 occupancy: Optional[RadioOccupancy] = None, gate: Optional[RadioGate] = None):
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='etrv-poll')
+        self._adapter_max_connections = adapter_max_connections
+        self._occupancy = occupancy
+        self._gate = gate
+        self._slots_lock = threading.Lock()
+        self._adapter_slots: Dict[int, threading.BoundedSemaphore] = {}
+        for adapter in adapters:
+            self._slot(adapter)
+
+    def _slot(self, adapter: int) -> threading.BoundedSemaphore:
+        with self._slots_lock:
+            if adapter not in self._adapter_slots:
+                self._adapter_slots[adapter] = threading.BoundedSemaphore(
+                    self._adapter_max_connections)
+            return self._adapter_slots[adapter]
+
+    def _run_on_adapter(self, adapter: int, job: Callable[[], None]):
+        with self._slot(adapter):
+            start = time.monotonic()
+            try:
+                if self._gate is not None:
+                    return self._gate.run(adapter, job)
+                return job()
+            finally:
+                if self._occupancy is not None:
+                    self._occupancy.record(adapter, start, time.monotonic())
+
+    @staticmethod
+    def _interleave(jobs: Iterable[PollJob]) -> List[PollJob]:
+        # alternate between adapters so that workers blocked on a busy adapter
+        # don't hold up jobs queued for an idle one
+        per_adapter: Dict[int, List[PollJob]] = {}
+        for job in jobs:
+            per_adapter.setdefault(job[0], []).append(job)
+
+        return [job for batch in zip_longest(*per_adapter.values())
+                for job in batch if job is not None]
+
+    def submit(self, adapter: int, job: Callable[[], None]) -> Future:
+        return self._executor.submit(self._run_on_adapter, adapter, job)
+
+    def run(self, jobs: Iterable[PollJob]):
+        futures = [self.submit(adapter, job)
+                   for adapter, job in self._interleave(jobs)]
+        wait(futures)
+        for future in futures:
+            e = future.exception()
+            if e is not None:
+                logger.opt(exception=e).error("Polling job failed")
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
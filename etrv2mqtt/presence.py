@@ -0,0 +1,165 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Set, Tuple
+
+from loguru import logger
+
+from etrv2mqtt.config import ThermostatConfig
+
+
+class PresenceTable():
+    """When and with what signal strength thermostats were last heard from.
+
+    Thermostats advertise while nobody is connected to them, connected ones are
+    marked seen by successful readouts. Until scanning works for a whole timeout
+    every thermostat is considered present, so a broken scanner never stops polling."""
+
+    # scan without results for this many seconds means scanner stopped working
+    SCANNER_TIMEOUT = 60.0
+
+    def __init__(self, timeout: float):
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._names: Dict[str, str] = {}
+        # name -> (monotonic time, rssi in dBm)
+        self._seen: Dict[str, Tuple[float, Optional[int]]] = {}
+        self._scanning_since: Optional[float] = None
+        self._scanned_at = -math.inf
+
+    def set_thermostats(self, thermostats: Iterable[ThermostatConfig]):
+        with self._lock:
+            self._names = {thermostat.address.lower(): thermostat.topic
+                           for thermostat in thermostats}
+            self._seen = {name: seen for name, seen in self._seen.items()
+                          if name in self._names.values()}
+
+    def advertisement(self, address: str, rssi: int, now: Optional[float] = None):
+        name = self._names.get(address.lower())
+        if name is None:
+            return
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._seen[name] = (now, rssi)
+
+    def seen(self, name: str, now: Optional[float] = None):
+        """Thermostat was reached over a connection, it keeps the last advertised rssi"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._seen[name] = (now, self._seen.get(name, (now, None))[1])
+
+    def scan_completed(self, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self._scanning_since is None or now - self._scanned_at > self.SCANNER_TIMEOUT:
+                self._scanning_since = now
+            self._scanned_at = now
+
+    def present(self, name: str, now: Optional[float] = None) -> bool:
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self._scanning_since is None or now - self._scanned_at > self.SCANNER_TIMEOUT:
+                return True
+            seen_at = self._seen.get(name, (self._scanning_since, None))[0]
+            return now - max(seen_at, self._scanning_since) < self._timeout
+
+    def rssi(self, name: str) -> Optional[int]:
+        with self._lock:
+            return self._seen.get(name, (None, None))[1]
+
+    def signal_order(self, name: str) -> float:
+        """Sort key putting strongest signal first and thermostats without rssi last"""
+        rssi = self.rssi(name)
+        return math.inf if rssi is None else -rssi
+
+
+class RadioGate():
+    """Keeps scans and thermostat operations on the same adapter apart, BlueZ connects
+    commonly fail or stall while the controller is scanning. Scan waits for running
+    operations to finish and holds back new ones until it ends."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._operations: Dict[int, int] = {}
+        # adapters scanning or waiting to scan
+        self._scanning: Set[int] = set()
+
+    @contextmanager
+    def operation(self, adapter: int) -> Iterator[None]:
+        with self._condition:
+            self._condition.wait_for(lambda: adapter not in self._scanning)
+            self._operations[adapter] = self._operations.get(adapter, 0) + 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._operations[adapter] -= 1
+                self._condition.notify_all()
+
+    def run(self, adapter: int, func: Callable[..., Any], *args) -> Any:
+        with self.operation(adapter):
+            return func(*args)
+
+    @contextmanager
+    def scan(self, adapter: int) -> Iterator[None]:
+        with self._condition:
+            # operations starting from now wait, steady polling can't starve the scan
+            self._scanning.add(adapter)
+            self._condition.wait_for(
+                lambda: self._operations.get(adapter, 0) == 0)
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._scanning.discard(adapter)
+                self._condition.notify_all()
+
+
+class PresenceScanner():
+    """Passive BLE scan on one adapter feeding advertisements to presence table. Scans run
+    in short windows between thermostat operations on the adapter."""
+
+    # seconds of every scan window, polls on the adapter wait meanwhile
+    SCAN_WINDOW = 3.0
+    # seconds between scan windows, less than PresenceTable.SCANNER_TIMEOUT
+    SCAN_INTERVAL = 30.0
+    RETRY_DELAY = 30.0
+
+    def __init__(self, table: PresenceTable, adapter: int, gate: RadioGate):
+        self._table = table
+        self._adapter = adapter
+        self._gate = gate
+
+    def start(self):
+        threading.Thread(target=self._scan_forever, daemon=True,
+                         name='etrv-scan-hci{}'.format(self._adapter)).start()
+
+    def _scan_forever(self):
+        # libetrv takes long to import, load it only once scanning starts
+        from libetrv.bluetooth import btle
+        table = self._table
+
+        class Delegate(btle.DefaultDelegate):
+            def handleDiscovery(self, entry, is_new_device, is_new_data):
+                table.advertisement(entry.addr, entry.rssi)
+
+        logger.info("Scanning for thermostats on hci{}", self._adapter)
+        while True:
+            try:
+                scanner = btle.Scanner(self._adapter).withDelegate(Delegate())
+                while True:
+                    with self._gate.scan(self._adapter):
+                        scanner.start(passive=True)
+                        try:
+                            scanner.process(self.SCAN_WINDOW)
+                        finally:
+                            scanner.stop()
+                    table.scan_completed()
+                    # advertisements are kept in presence table only
+                    scanner.clear()
+                    time.sleep(self.SCAN_INTERVAL)
+            except btle.BTLEException as e:
+                logger.error("BLE scan on hci{} failed, retrying in {}s: {}",
+                             self._adapter, self.RETRY_DELAY, e)
+                time.sleep(self.RETRY_DELAY)
@@ -0,0 +1,284 @@
+import heapq
+import math
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from etrv2mqtt import metrics
+from etrv2mqtt.etrvutils import eTRVData
+
+
+class PollScheduler(ABC):
+    """Keeps per-device poll deadlines in a heap, subclasses decide when a device is polled
+    next after a reading. Devices added and polled all at once are made due catchup_rate
+    per second, 0 makes them due right away."""
+
+    def __init__(self, names: Iterable[str], catchup_rate: float = 0):
+        self._catchup_spacing = 1 / catchup_rate if catchup_rate > 0 else 0.0
+        self._catchup_next = -math.inf
+        self._lock = threading.Lock()
+        # (deadline, sequence, name), superseded entries are skipped when popped
+        self._heap: List[Tuple[float, int, str]] = []
+        self._sequence = 0
+        self._deadlines: Dict[str, float] = {}
+        self._names: Set[str] = set()
+
+        now = time.monotonic()
+        with self._lock:
+            for name in names:
+                self._add(name, now)
+
+    def _push(self, name: str, deadline: float):
+        # must be called with self._lock held
+        self._sequence += 1
+        self._deadlines[name] = deadline
+        heapq.heappush(self._heap, (deadline, self._sequence, name))
+
+    def _drop_stale(self):
+        # must be called with self._lock held
+        while len(self._heap) > 0:
+            deadline, _, name = self._heap[0]
+            if self._deadlines.get(name) == deadline:
+                break
+            heapq.heappop(self._heap)
+
+    def _catchup_deadline(self, now: float) -> float:
+        # must be called with self._lock held
+        deadline = max(now, self._catchup_next)
+        self._catchup_next = deadline + self._catchup_spacing
+        return deadline
+
+    def _add(self, name: str, now: float):
+        # must be called with self._lock held
+        self._names.add(name)
+        self._push(name, self._catchup_deadline(now))
+
+    def add(self, name: str, now: Optional[float] = None):
+        with self._lock:
+            self._add(name, time.monotonic() if now is None else now)
+
+    def remove(self, name: str):
+        with self._lock:
+            self._names.discard(name)
+            self._deadlines.pop(name, None)
+
+    def next_deadline(self) -> Optional[float]:
+        with self._lock:
+            self._drop_stale()
+            return self._heap[0][0] if len(self._heap) > 0 else None
+
+    def due_within(self, name: str, window: float, now: Optional[float] = None) -> bool:
+        """True if device is scheduled to be polled within window seconds"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            deadline = self._deadlines.get(name)
+            return deadline is not None and deadline <= now + window
+
+    def pop_due(self, now: Optional[float] = None) -> List[str]:
+        """Returns devices whose deadline has passed. They are not scheduled again
+        until record_reading() is called."""
+        now = time.monotonic() if now is None else now
+        due: List[str] = []
+        with self._lock:
+            self._drop_stale()
+            while len(self._heap) > 0 and self._heap[0][0] <= now:
+                _, _, name = heapq.heappop(self._heap)
+                del self._deadlines[name]
+                due.append(name)
+                self._drop_stale()
+        return due
+
+    def poll_all_now(self, now: Optional[float] = None):
+        """Makes every device due, soonest scheduled ones first"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._catchup_next = -math.inf
+            for name in sorted(self._names, key=lambda name: self._deadlines.get(name, now)):
+                self._push(name, self._catchup_deadline(now))
+
+    @abstractmethod
+    def _next_deadline(self, name: str, reading: Optional[eTRVData], now: float) -> float:
+        """Deadline of next poll after reading taken at now, called with self._lock held"""
+        pass
+
+    def record_reading(self, name: str, reading: Optional[eTRVData], now: Optional[float] = None):
+        """Schedules next poll of the device based on its latest reading, None means failed poll"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if name in self._names:
+                self._push(name, self._next_deadline(name, reading, now))
+
+    def record_setpoint(self, name: str, now: Optional[float] = None):
+        """Setpoint was requested over MQTT. Schedule stays as it is unless the
+        scheduler watches devices with new setpoints closely."""
+        pass
+
+
+class AdaptivePollScheduler(PollScheduler):
+    """Poll interval drops to min_interval when readings change or a setpoint was requested
+    and doubles with every stable reading up to max_interval. Devices with low battery are
+    never polled more often than low_battery_interval."""
+
+    LOW_BATTERY_LEVEL = 20
+
+    def __init__(self, names: Iterable[str], min_interval: float, max_interval: float,
+                 change_threshold: float, catchup_rate: float = 0):
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._low_battery_interval = min(min_interval * 4, max_interval)
+        self._change_threshold = change_threshold
+        self._intervals: Dict[str, float] = {}
+        self._last_readings: Dict[str, eTRVData] = {}
+        super().__init__(names, catchup_rate)
+
+    def _add(self, name: str, now: float):
+        self._intervals[name] = self._min_interval
+        super()._add(name, now)
+
+    def remove(self, name: str):
+        super().remove(name)
+        with self._lock:
+            self._intervals.pop(name, None)
+            self._last_readings.pop(name, None)
+
+    def interval(self, name: str) -> float:
+        with self._lock:
+            return self._intervals[name]
+
+    def _changed(self, previous: eTRVData, current: eTRVData) -> bool:
+        if previous.set_point != current.set_point:
+            return True
+        return abs(current.room_temp - previous.room_temp) >= self._change_threshold
+
+    def _next_deadline(self, name: str, reading: Optional[eTRVData], now: float) -> float:
+        interval = self._intervals[name]
+        if reading is not None:
+            previous = self._last_readings.get(name)
+            if previous is not None and self._changed(previous, reading):
+                interval = self._min_interval
+            elif previous is not None:
+                interval = min(interval * 2, self._max_interval)
+            if reading.battery is not None and reading.battery <= self.LOW_BATTERY_LEVEL:
+                interval = max(interval, self._low_battery_interval)
+            self._last_readings[name] = reading
+        self._intervals[name] = interval
+        return now + interval
+
+    def record_setpoint(self, name: str, now: Optional[float] = None):
+        """Setpoint was requested over MQTT, device will be watched closely for a while"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if name not in self._names:
+                return
+            self._intervals[name] = self._min_interval
+            self._push(name, min(self._deadlines.get(
+                name, now + self._min_interval), now + self._min_interval))
+
+
+class PollPlanner(PollScheduler):
+    """Polls every device once per interval in its own slot. Slots are spread evenly over
+    the interval in order of name hashes and aligned to wall clock, so a device keeps its
+    slot across restarts as long as the set of devices doesn't change. Setpoint writes
+    don't move slots, write refreshes the reading if the slot is close."""
+
+    def __init__(self, names: Iterable[str], interval: float, catchup_rate: float = 0):
+        self._interval = interval
+        # slots of every device repeat at _origin + phase + k * interval
+        self._origin = time.monotonic() - time.time() % interval
+        self._phases: Dict[str, float] = {}
+        super().__init__(names, catchup_rate)
+        # once for all initial devices, sorting on every add() is quadratic
+        with self._lock:
+            self._update_phases()
+
+    def _update_phases(self):
+        # must be called with self._lock held
+        names = sorted(self._names,
+                       key=lambda name: (zlib.crc32(name.encode('utf-8')), name))
+        self._phases = {name: i * self._interval / len(names)
+                        for i, name in enumerate(names)}
+
+    def add(self, name: str, now: Optional[float] = None):
+        super().add(name, now)
+        with self._lock:
+            self._update_phases()
+
+    def remove(self, name: str):
+        super().remove(name)
+        with self._lock:
+            self._update_phases()
+
+    def phase(self, name: str) -> float:
+        with self._lock:
+            return self._phases[name]
+
+    def _next_deadline(self, name: str, reading: Optional[eTRVData], now: float) -> float:
+        # poll that ended late or a catch-up poll is followed by at least half an interval
+        after = now + self._interval / 2
+        first = self._origin + self._phases[name]
+        return first + (math.floor((after - first) / self._interval) + 1) * self._interval
+
+
+class RadioOccupancy():
+    """Time each adapter spends on thermostat operations per poll cycle. Cycles are split
+    into slots, peak slot occupancy close to cycle occupancy means airtime is spread evenly
+    instead of coming in bursts. Ratios are relative to connections an adapter can hold."""
+
+    SLOTS = 10
+
+    def __init__(self, cycle: float, connections: int):
+        self._cycle = cycle
+        self._slot = cycle / self.SLOTS
+        self._connections = connections
+        self._lock = threading.Lock()
+        self._origin = time.monotonic()
+        self._cycle_index = 0
+        # adapter -> busy seconds in slots of current cycle
+        self._busy: Dict[int, List[float]] = {}
+        # adapter -> (occupancy, peak slot occupancy) of last completed cycle
+        self._completed: Dict[int, Tuple[float, float]] = {}
+
+    def _advance(self, now: float):
+        # must be called with self._lock held
+        index = int((now - self._origin) // self._cycle)
+        if index <= self._cycle_index:
+            return
+        for adapter, busy in self._busy.items():
+            if index == self._cycle_index + 1:
+                self._completed[adapter] = (sum(busy) / (self._cycle * self._connections),
+                                            max(busy) / (self._slot * self._connections))
+            else:
+                # nothing was recorded in the last cycle
+                self._completed[adapter] = (0.0, 0.0)
+            self._busy[adapter] = [0.0] * self.SLOTS
+        self._cycle_index = index
+
+    def record(self, adapter: int, start: float, end: float):
+        """Adapter was busy with an operation between monotonic times start and end"""
+        metrics.radio_busy_seconds_total.labels(str(adapter)).inc(end - start)
+        with self._lock:
+            self._advance(end)
+            if adapter not in self._busy:
+                self._busy[adapter] = [0.0] * self.SLOTS
+                metrics.radio_occupancy_ratio.labels(str(adapter)).set_function(
+                    lambda: self.completed(adapter)[0])
+                metrics.radio_peak_occupancy_ratio.labels(str(adapter)).set_function(
+                    lambda: self.completed(adapter)[1])
+            busy = self._busy[adapter]
+            # part of operation that fell into previous cycle is not counted
+            cycle_start = self._origin + self._cycle_index * self._cycle
+            start = max(start, cycle_start) - cycle_start
+            end -= cycle_start
+            for slot in range(min(int(start // self._slot), self.SLOTS - 1), self.SLOTS):
+                slot_end = end if slot == self.SLOTS - 1 else min(end, (slot + 1) * self._slot)
+                busy[slot] += max(0.0, slot_end - max(start, slot * self._slot))
+                if slot_end >= end:
+                    break
+
+    def completed(self, adapter: int, now: Optional[float] = None) -> Tuple[float, float]:
+        """(occupancy, peak slot occupancy) of adapter in last completed cycle"""
+        with self._lock:
+            self._advance(time.monotonic() if now is None else now)
+            return self._completed.get(adapter, (0.0, 0.0))
@@ -0,0 +1,97 @@
+import math
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+# setting -> accepted value type. Weekly schedules are not listed, libetrv can't read or write them yet.
+SETTINGS: Dict[str, type] = {
+    'name': str,
+    'adaptable_regulation': bool,
+    'vertical_installation': bool,
+    'display_flip': bool,
+    'slow_regulation': bool,
+    'valve_installed': bool,
+    'lock_control': bool,
+    'temperature_min': float,
+    'temperature_max': float,
+    'frost_protection_temperature': float,
+    'vacation_temperature': float,
+    'schedule_mode': str,
+    # epoch seconds, 0 for none
+    'vacation_from': int,
+    'vacation_to': int,
+}
+SCHEDULE_MODES = ('manual', 'scheduled', 'vacation', 'hold')
+
+
+def validate(document: Any) -> Dict[str, Any]:
+    """Settings document with values converted to their types, raises ValueError"""
+    if not isinstance(document, dict):
+        raise ValueError("settings must be an object")
+    ret: Dict[str, Any] = {}
+    for key, value in document.items():
+        if key == 'schedule':
+            raise ValueError("weekly schedules are not supported")
+        if key not in SETTINGS:
+            raise ValueError("unknown setting " + key)
+        kind = SETTINGS[key]
+        if kind is bool:
+            if not isinstance(value, bool):
+                raise ValueError(key + " must be true or false")
+        elif kind is str:
+            if not isinstance(value, str):
+                raise ValueError(key + " must be a string")
+        elif isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(key + " must be a number")
+        elif not math.isfinite(value):
+            # JSON parser takes Infinity and NaN
+            raise ValueError(key + " must be a finite number")
+        else:
+            value = kind(value)
+        if kind is float and value * 2 != int(value * 2):
+            raise ValueError(key + " must be a multiple of 0.5")
+        if key == 'schedule_mode' and value not in SCHEDULE_MODES:
+            raise ValueError("schedule_mode must be one of " +
+                             ', '.join(SCHEDULE_MODES))
+        if key == 'name' and len(value.encode('utf-8')) > 16:
+            raise ValueError("name must be at most 16 bytes")
+        ret[key] = value
+    return ret
+
+
+class SettingsSync():
+    """Desired settings waiting to be written and last known settings of every thermostat.
+    Requests for the same thermostat are merged, only settings that differ from the
+    known ones are written."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._known: Dict[str, Dict[str, Any]] = {}
+        self._pending: Dict[str, Dict[str, Any]] = {}
+
+    def request(self, name: str, settings: Dict[str, Any]) -> List[str]:
+        """Queues settings not known to be set already, returns names of queued settings"""
+        with self._lock:
+            known = self._known.get(name, {})
+            changes = {key: value for key, value in settings.items()
+                       if known.get(key) != value}
+            if len(changes) > 0:
+                self._pending.setdefault(name, {}).update(changes)
+            return sorted(changes.keys())
+
+    def pop_pending(self) -> List[Tuple[str, Dict[str, Any]]]:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return list(pending.items())
+
+    def applied(self, name: str, settings: Optional[Dict[str, Any]]):
+        """Records settings read back from thermostat, None forgets them after a failure"""
+        with self._lock:
+            if settings is None:
+                self._known.pop(name, None)
+            else:
+                self._known[name] = dict(settings)
+
+    def forget(self, name: str):
+        with self._lock:
+            self._known.pop(name, None)
+            self._pending.pop(name, None)
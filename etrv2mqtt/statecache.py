@@ -0,0 +1,49 @@
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from etrv2mqtt.etrvutils import eTRVData
+
+
+class StateChangeCache():
+    """Remembers last published state of every device and decides whether a new
+    reading differs enough to be worth publishing"""
+
+    def __init__(self, room_temp_deadband: float, battery_deadband: int, max_silence: float):
+        self._room_temp_deadband = room_temp_deadband
+        self._battery_deadband = battery_deadband
+        self._max_silence = max_silence
+        self._lock = threading.Lock()
+        # name -> (last published data, publish time)
+        self._published: Dict[str, Tuple[eTRVData, float]] = {}
+
+    def _changed(self, previous: eTRVData, current: eTRVData) -> bool:
+        if previous.name != current.name or previous.set_point != current.set_point:
+            return True
+        if (previous.room_temp is None) != (current.room_temp is None):
+            return True
+        if previous.room_temp is not None and \
+                abs(current.room_temp - previous.room_temp) > self._room_temp_deadband:
+            return True
+        if previous.battery is None or current.battery is None:
+            return previous.battery != current.battery
+        return abs(current.battery - previous.battery) > self._battery_deadband
+
+    def update(self, name: str, data: eTRVData, now: Optional[float] = None) -> bool:
+        """Returns True and remembers data if it should be published"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            published = self._published.get(name)
+            if published is not None and now - published[1] < self._max_silence \
+                    and not self._changed(published[0], data):
+                return False
+            self._published[name] = (data, now)
+            return True
+
+    def invalidate(self, name: Optional[str] = None):
+        """Forces next reading of device (or every device) to be published"""
+        with self._lock:
+            if name is None:
+                self._published.clear()
+            else:
+                self._published.pop(name, None)
@@ -0,0 +1,146 @@
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from etrv2mqtt.etrvutils import eTRVData
+
+_SCHEMA = (
+    # last reading of every thermostat, republished on startup
+    '''CREATE TABLE IF NOT EXISTS latest (
+        topic TEXT PRIMARY KEY, name TEXT, battery INTEGER, room_temp REAL,
+        set_point REAL, last_update REAL)''',
+    '''CREATE TABLE IF NOT EXISTS readings (
+        topic TEXT, battery INTEGER, room_temp REAL, set_point REAL, last_update REAL)''',
+    '''CREATE INDEX IF NOT EXISTS readings_last_update ON readings (last_update)''',
+    # setpoints requested over MQTT and not written to thermostat yet
+    '''CREATE TABLE IF NOT EXISTS setpoints (
+        topic TEXT PRIMARY KEY, temperature REAL, requested REAL)''',
+)
+
+
+class StateStore():
+    """Keeps readings and pending setpoints in SQLite database across restarts.
+    Changes are buffered in memory and written in one transaction every flush,
+    readings older than retention are pruned at most once an hour."""
+
+    PRUNE_INTERVAL = 3600
+
+    def __init__(self, path: str, retention: float):
+        self._path = path
+        # seconds, 0 keeps only the latest reading
+        self._retention = retention
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._latest: Dict[str, eTRVData] = {}
+        self._readings: List[Tuple[str, eTRVData]] = []
+        # topic -> (temperature, request time), None deletes stored setpoint
+        self._setpoints: Dict[str, Optional[Tuple[float, float]]] = {}
+        self._pruned_at = 0.0
+
+        directory = os.path.dirname(path)
+        if directory != '':
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=10, check_same_thread=False,
+                                   isolation_level=None)
+        # freed pages are returned to the file system after pruning
+        self._db.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        for statement in _SCHEMA:
+            self._db.execute(statement)
+
+    def load_readings(self) -> Dict[str, eTRVData]:
+        with self._db_lock:
+            rows = self._db.execute(
+                'SELECT topic, name, battery, room_temp, set_point, last_update FROM latest').fetchall()
+        return {topic: eTRVData(name, battery, room_temp, set_point, datetime.fromtimestamp(last_update))
+                for topic, name, battery, room_temp, set_point, last_update in rows}
+
+    def load_setpoints(self) -> Dict[str, float]:
+        with self._db_lock:
+            rows = self._db.execute(
+                'SELECT topic, temperature FROM setpoints').fetchall()
+        return {topic: temperature for topic, temperature in rows}
+
+    def record_reading(self, topic: str, data: eTRVData):
+        with self._lock:
+            self._latest[topic] = data
+            if self._retention > 0:
+                self._readings.append((topic, data))
+
+    def record_setpoint(self, topic: str, temperature: float):
+        with self._lock:
+            self._setpoints[topic] = (temperature, time.time())
+
+    def setpoint_written(self, topic: str, temperature: float):
+        """Forgets setpoint unless a different one was requested meanwhile"""
+        with self._lock:
+            pending = self._setpoints.get(topic)
+            if pending is None or pending[0] == temperature:
+                self._setpoints[topic] = None
+
+    def forget(self, topic: str):
+        with self._lock:
+            self._latest.pop(topic, None)
+            self._setpoints[topic] = None
+        with self._db_lock:
+            self._db.execute('DELETE FROM latest WHERE topic = ?', (topic,))
+
+    def _restore(self, latest: Dict[str, eTRVData], readings: List[Tuple[str, eTRVData]],
+                 setpoints: Dict[str, Optional[Tuple[float, float]]]):
+        # changes made since the failed flush are newer and win
+        with self._lock:
+            self._latest = {**latest, **self._latest}
+            self._readings = readings + self._readings
+            self._setpoints = {**setpoints, **self._setpoints}
+
+    def flush(self):
+        with self._lock:
+            latest, self._latest = self._latest, {}
+            readings, self._readings = self._readings, []
+            setpoints, self._setpoints = self._setpoints, {}
+        if len(latest) == 0 and len(readings) == 0 and len(setpoints) == 0:
+            return
+
+        now = time.time()
+        with self._db_lock:
+            try:
+                self._db.execute('BEGIN')
+                self._db.executemany('INSERT OR REPLACE INTO latest VALUES (?, ?, ?, ?, ?, ?)',
+                                     ((topic, data.name, data.battery, data.room_temp, data.set_point,
+                                       data.last_update.timestamp()) for topic, data in latest.items()))
+                self._db.executemany('INSERT INTO readings VALUES (?, ?, ?, ?, ?)',
+                                     ((topic, data.battery, data.room_temp, data.set_point,
+                                       data.last_update.timestamp()) for topic, data in readings))
+                self._db.executemany('INSERT OR REPLACE INTO setpoints VALUES (?, ?, ?)',
+                                     ((topic, pending[0], pending[1]) for topic, pending in setpoints.items()
+                                      if pending is not None))
+                self._db.executemany('DELETE FROM setpoints WHERE topic = ?',
+                                     ((topic,) for topic, pending in setpoints.items() if pending is None))
+                prune = now - self._pruned_at >= self.PRUNE_INTERVAL
+                if prune:
+                    self._db.execute('DELETE FROM readings WHERE last_update < ?',
+                                     (now - self._retention,))
+                self._db.execute('COMMIT')
+            except sqlite3.Error as e:
+                if self._db.in_transaction:
+                    self._db.execute('ROLLBACK')
+                logger.error("Unable to write state store {}: {}", self._path, e)
+                self._restore(latest, readings, setpoints)
+                return
+            if prune:
+                self._pruned_at = now
+                self._db.execute('PRAGMA incremental_vacuum')
+        logger.debug("Stored {} readings and {} setpoint changes",
+                     len(latest) + len(readings), len(setpoints))
+
+    def close(self):
+        """Writes buffered changes and closes database, call once on shutdown"""
+        self.flush()
+        with self._db_lock:
+            self._db.close()
@@ -0,0 +1,115 @@
+import multiprocessing
+import os
+import signal
+import time
+from typing import TYPE_CHECKING, Dict, List, Optional, Type
+
+from loguru import logger
+
+from etrv2mqtt.config import Config
+
+if TYPE_CHECKING:
+    from etrv2mqtt.devices import DeviceBase
+
+
+def _run_shard(config_file: str, cache_dir: Optional[str], shard: int, deviceClass: Type['DeviceBase']):
+    # supervisor stops workers with SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    config = Config(config_file, cache_dir=cache_dir)
+    config.select_shard(shard)
+    logger.info("Shard {} worker started with {} thermostats",
+                shard, len(config.thermostats))
+
+    from etrv2mqtt.devices import DeviceManager
+    if config.event_loop == 'asyncio':
+        from etrv2mqtt.aio import AsyncDeviceManager
+        deviceManager = AsyncDeviceManager(config, deviceClass)
+    else:
+        deviceManager = DeviceManager(config, deviceClass)
+    deviceManager.poll_forever()
+
+
+class _Worker():
+    def __init__(self, shard: int):
+        self.shard = shard
+        self.process: Optional[multiprocessing.Process] = None
+        self.restart_delay = 1.0
+        self.restart_at = 0.0
+        self.started_at = 0.0
+
+
+class ShardSupervisor():
+    """Runs thermostats of every shard in a separate worker process and
+    restarts workers that exit, without touching the other ones"""
+
+    # worker running this long is considered healthy and restart delay is reset
+    STABLE_RUN_TIME = 60.0
+    MAX_RESTART_DELAY = 60.0
+
+    def __init__(self, config: Config, deviceClass: Type['DeviceBase']):
+        self._config = config
+        self._device_class = deviceClass
+        self._context = multiprocessing.get_context('spawn')
+        self._workers: List[_Worker] = [_Worker(shard)
+                                        for shard in range(config.shards)]
+        self._stopping = False
+
+    def _start(self, worker: _Worker):
+        worker.process = self._context.Process(target=_run_shard, name='etrv-shard-{}'.format(worker.shard),
+                                               args=(self._config.filename, self._config.cache_dir, worker.shard,
+                                                     self._device_class))
+        worker.process.start()
+        worker.started_at = time.monotonic()
+        logger.info("Started shard {} worker, pid {}",
+                    worker.shard, worker.process.pid)
+
+    def _check(self, worker: _Worker):
+        now = time.monotonic()
+        if worker.process is not None:
+            if worker.process.is_alive():
+                if now - worker.started_at > self.STABLE_RUN_TIME:
+                    worker.restart_delay = 1.0
+                return
+            logger.error("Shard {} worker exited with code {}, restarting in {}s",
+                         worker.shard, worker.process.exitcode, worker.restart_delay)
+            worker.process = None
+            worker.restart_at = now + worker.restart_delay
+            worker.restart_delay = min(
+                worker.restart_delay * 2, self.MAX_RESTART_DELAY)
+
+        if now >= worker.restart_at:
+            self._start(worker)
+
+    def _forward_reload(self, signum, frame):
+        for worker in self._workers:
+            if worker.process is not None and worker.process.is_alive():
+                os.kill(worker.process.pid, signal.SIGHUP)
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self._forward_reload)
+
+        shards: Dict[int, int] = {}
+        for thermostat in self._config.thermostats.values():
+            shard = self._config.shard_of(thermostat)
+            shards[shard] = shards.get(shard, 0) + 1
+        logger.info("Running {} shards, thermostats per shard: {}", self._config.shards,
+                    [shards.get(shard, 0) for shard in range(self._config.shards)])
+
+        try:
+            while not self._stopping:
+                for worker in self._workers:
+                    self._check(worker)
+                time.sleep(1)
+        finally:
+            for worker in self._workers:
+                if worker.process is not None:
+                    worker.process.terminate()
+            for worker in self._workers:
+                if worker.process is not None:
+                    worker.process.join()
@@ -0,0 +1,257 @@
+import random
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, Any, Dict, Optional, Union
+
+from libetrv.bluetooth import btle
+from loguru import logger
+
+if TYPE_CHECKING:
+    from etrv2mqtt.config import Config, _SimulationConfig
+
+if btle is not None:
+    DisconnectError = btle.BTLEDisconnectError
+else:
+    class DisconnectError(Exception):  # type: ignore[no-redef]
+        """Raised by simulated thermostats in place of bluepy BTLEDisconnectError
+        when bluepy is not installed"""
+
+
+class Transport(ABC):
+    """Creates thermostat objects used by eTRVUtils. Returned objects behave like
+    libetrv eTRVDevice and raise DisconnectError when connection fails or drops."""
+
+    @abstractmethod
+    def create_device(self, address: str, key: bytes, retry_limit: int = 5, adapter: int = 0) -> Any:
+        pass
+
+
+class BluetoothTransport(Transport):
+    """Real thermostats reached over bluepy"""
+
+    def create_device(self, address: str, key: bytes, retry_limit: int = 5, adapter: int = 0) -> Any:
+        # libetrv takes long to import, load it only once a device is really needed
+        from etrv2mqtt.adapterdevice import eTRVAdapterDevice
+
+        return eTRVAdapterDevice(address, adapter=adapter, secret=key, retry_limit=retry_limit)
+
+
+class _SimulatedField():
+    # value read over a connection is cached until invalidated, like libetrv fields
+    def __init__(self):
+        self.valid = False
+
+    def invalidate(self):
+        self.valid = False
+
+
+class _SimulatedTemperature():
+    def __init__(self, device: 'SimulatedDevice'):
+        self._device = device
+
+    @property
+    def room_temperature(self) -> float:
+        return self._device._read_field('temperature')[0]
+
+    @property
+    def set_point_temperature(self) -> float:
+        return self._device._read_field('temperature')[1]
+
+    @set_point_temperature.setter
+    def set_point_temperature(self, value: float):
+        self._device._write_set_point(value)
+
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _utc_datetime_property(attribute: str) -> property:
+    # stores raw epoch seconds like libetrv UTCDateTimeField, 0 reads back as None
+    def getter(self) -> Optional[datetime]:
+        raw = getattr(self, attribute)
+        return None if raw == 0 else _EPOCH + timedelta(seconds=raw)
+
+    def setter(self, value: Union[None, int, datetime]):
+        if value is None:
+            value = 0
+        elif isinstance(value, datetime):
+            value = int((value - _EPOCH).total_seconds())
+        elif not isinstance(value, int):
+            raise ValueError('type not supported')
+        setattr(self, attribute, value)
+
+    return property(getter, setter)
+
+
+class _SimulatedSettings():
+    def __init__(self, device: 'SimulatedDevice'):
+        from libetrv.data_struct import ScheduleMode
+
+        self._device = device
+        self.adaptable_regulation = True
+        self.vertical_instalation = False
+        self.display_flip = False
+        self.slow_regulation = False
+        self.valve_installed = True
+        self.lock_control = False
+        self.temperature_min = 5.0
+        self.temperature_max = 28.0
+        self.frost_protection_temperature = 6.0
+        self.vacation_temperature = 16.0
+        self.schedule_mode = ScheduleMode.MANUAL
+        self._vacation_from = 0
+        self._vacation_to = 0
+
+    vacation_from = _utc_datetime_property('_vacation_from')
+    vacation_to = _utc_datetime_property('_vacation_to')
+
+    def save(self):
+        self._device._operation()
+
+
+class SimulatedDevice():
+    """In-memory thermostat with the eTRVDevice interface used by eTRVUtils. Every
+    operation takes simulated time and may fail the way a BLE link does."""
+
+    def __init__(self, transport: 'SimulatedTransport', address: str, adapter: int, retry_limit: int):
+        self.address = address
+        self.adapter = adapter
+        self.retry_limit = retry_limit
+        self._transport = transport
+        self._config = transport.config
+        # same sequence of failures for the same address and seed on every run
+        self._random = random.Random(
+            self._config.seed ^ zlib.crc32(address.encode('ascii')))
+        self._connected = False
+        self._battery = 100.0
+        self._room_temp = 20.0 + self._random.randrange(-4, 5) / 2
+        self._set_point = 21.0
+        self._name = 'eTRV ' + address[-5:]
+        self.fields: Dict[str, _SimulatedField] = {name: _SimulatedField()
+                                                   for name in ('name', 'battery', 'temperature', 'settings')}
+        self._cached: Dict[str, Any] = {}
+        self._settings = _SimulatedSettings(self)
+
+    def _sleep(self, seconds: float):
+        jitter = self._config.latency_jitter
+        time.sleep(max(0.0, seconds + self._random.uniform(-jitter, jitter)))
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    def connect(self):
+        if self._connected:
+            return
+        retry_limit = self.retry_limit
+        while True:
+            self._sleep(self._config.connect_latency)
+            if self._random.random() >= self._config.connect_failure_rate and \
+                    self._transport.acquire_slot(self.adapter):
+                break
+            logger.error(
+                "Unable connect to {}. Retrying in 100ms", self.address)
+            if retry_limit is not None:
+                retry_limit -= 1
+                if retry_limit < 0:
+                    raise DisconnectError(
+                        "Failed to connect to peripheral {}".format(self.address))
+            time.sleep(0.1)
+        self._connected = True
+        self._battery = max(0.0, self._battery - self._config.battery_drain)
+
+    def disconnect(self):
+        if not self._connected:
+            return
+        self._connected = False
+        self._transport.release_slot(self.adapter)
+        for field in self.fields.values():
+            field.invalidate()
+
+    def _operation(self):
+        if not self._connected:
+            raise DisconnectError("Device disconnected")
+        self._sleep(self._config.operation_latency)
+        if self._random.random() < self._config.drop_rate:
+            self.disconnect()
+            raise DisconnectError("Device disconnected")
+
+    def _read_field(self, name: str) -> Any:
+        field = self.fields[name]
+        if not field.valid:
+            self._operation()
+            if name == 'temperature':
+                # room drifts towards set point
+                step = 0.5 if self._set_point > self._room_temp else -0.5
+                if self._room_temp != self._set_point and self._random.random() < 0.3:
+                    self._room_temp += step
+                self._cached[name] = (self._room_temp, self._set_point)
+            elif name == 'battery':
+                self._cached[name] = int(self._battery)
+            elif name == 'name':
+                self._cached[name] = self._name
+            field.valid = True
+        return self._cached.get(name)
+
+    def _write_set_point(self, value: float):
+        # whole temperature struct is written, cache keeps written values like libetrv does
+        room_temp, _ = self._read_field('temperature')
+        self._operation()
+        self._set_point = value
+        self._cached['temperature'] = (room_temp, value)
+
+    @property
+    def name(self) -> str:
+        return self._read_field('name')
+
+    @name.setter
+    def name(self, value: str):
+        self._operation()
+        self._name = value
+        self.fields['name'].invalidate()
+
+    @property
+    def battery(self) -> int:
+        return self._read_field('battery')
+
+    @property
+    def temperature(self) -> _SimulatedTemperature:
+        return _SimulatedTemperature(self)
+
+    @property
+    def settings(self) -> _SimulatedSettings:
+        self._read_field('settings')
+        return self._settings
+
+
+class SimulatedTransport(Transport):
+    """Simulated thermostats for load tests without hardware. Each adapter holds a
+    limited number of connections, connects beyond that fail like on a real controller."""
+
+    def __init__(self, config: '_SimulationConfig'):
+        self.config = config
+        self._lock = threading.Lock()
+        self._connections: Dict[int, int] = {}
+
+    def acquire_slot(self, adapter: int) -> bool:
+        with self._lock:
+            if self._connections.get(adapter, 0) >= self.config.adapter_slots:
+                return False
+            self._connections[adapter] = self._connections.get(adapter, 0) + 1
+            return True
+
+    def release_slot(self, adapter: int):
+        with self._lock:
+            self._connections[adapter] -= 1
+
+    def create_device(self, address: str, key: bytes, retry_limit: int = 5, adapter: int = 0) -> Any:
+        return SimulatedDevice(self, address, adapter, retry_limit)
+
+
+def create_transport(config: 'Config') -> Transport:
+    if config.transport == 'simulated':
+        logger.warning("Using simulated thermostats")
+        return SimulatedTransport(config.simulation)
+    return BluetoothTransport()
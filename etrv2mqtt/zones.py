@@ -0,0 +1,81 @@
+import json
+import threading
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from etrv2mqtt.config import ZoneConfig
+
+
+class ZoneStates():
+    """Combines states published by zone thermostats into zone states, no thermostat
+    is read for it. Zone room temperature is mean or min of the thermostats and set
+    point the one most of them share."""
+
+    def __init__(self, zones: Iterable[ZoneConfig]):
+        self._lock = threading.Lock()
+        # thermostat -> (room_temp, set_point, last_update)
+        self._states: Dict[str, Tuple[Optional[float], Optional[float], Optional[str]]] = {}
+        self.set_zones(zones)
+
+    def set_zones(self, zones: Iterable[ZoneConfig]):
+        with self._lock:
+            self._zones = {zone.topic: zone for zone in zones}
+            self._member_of: Dict[str, List[str]] = {}
+            for zone in self._zones.values():
+                for name in zone.thermostats:
+                    self._member_of.setdefault(name, []).append(zone.topic)
+
+    def zones_of(self, name: str) -> List[str]:
+        return self._member_of.get(name, [])
+
+    def update(self, name: str, payload: bytes) -> List[str]:
+        """Records state published by a thermostat, returns zones it belongs to"""
+        zones = self.zones_of(name)
+        if len(zones) == 0:
+            return []
+        try:
+            state = json.loads(payload)
+            room_temp = state.get('room_temp')
+            set_point = state.get('set_point')
+            last_update = state.get('last_update')
+        except (ValueError, AttributeError):
+            return []
+        with self._lock:
+            self._states[name] = (room_temp, set_point, last_update)
+        return zones
+
+    def forget(self, name: str):
+        with self._lock:
+            self._states.pop(name, None)
+
+    def state(self, zone_name: str) -> Optional[bytes]:
+        """Zone state payload, None until a thermostat of the zone reported"""
+        with self._lock:
+            zone = self._zones.get(zone_name)
+            if zone is None:
+                return None
+            states = [self._states[name]
+                      for name in zone.thermostats if name in self._states]
+        if len(states) == 0:
+            return None
+        room_temps = [room_temp for room_temp, _,
+                      _ in states if room_temp is not None]
+        set_points = [set_point for _, set_point,
+                      _ in states if set_point is not None]
+        room_temp = None
+        if len(room_temps) > 0:
+            room_temp = round(sum(room_temps) / len(room_temps), 2) if zone.room_temp == 'mean' \
+                else min(room_temps)
+        set_point = None
+        if len(set_points) > 0:
+            # most common, the higher one on a tie
+            set_point = max(Counter(set_points).items(),
+                            key=lambda item: (item[1], item[0]))[0]
+        return json.dumps({
+            'name': zone_name,
+            'room_temp': room_temp,
+            'set_point': set_point,
+            'thermostats': len(states),
+            'last_update': max((last_update for _, _, last_update in states if last_update is not None),
+                               default=None),
+        }).encode('utf-8')
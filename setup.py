@@ -24,5 +24,9 @@ setuptools.setup(
     },
     install_requires=('jsonschema', 'loguru', 'paho-mqtt', 'schedule',
                       'libetrv',),
+    extras_require={
+        # faster JSON encoding of published state
+        'orjson': ('orjson',),
+    },
     setup_requires=('wheel'),
 )
@@ -0,0 +1,46 @@
+import json
+import sys
+import timeit
+from datetime import datetime
+
+from etrv2mqtt.etrvutils import eTRVData
+
+# eTRVData serialization before switching to eTRVData.to_bytes(),
+# paho encodes str payloads to bytes on publish
+
+
+def _datetimeconverter(o):
+    if isinstance(o, datetime):
+        return o.astimezone().isoformat()
+    else:
+        return o
+
+
+def legacy_serialize(data: eTRVData) -> bytes:
+    fields = {
+        'name': data.name,
+        'battery': data.battery,
+        'room_temp': data.room_temp,
+        'set_point': data.set_point,
+        'last_update': data.last_update,
+    }
+    return json.dumps(fields, default=_datetimeconverter).encode('utf-8')
+
+
+def main(number: int):
+    data = eTRVData('Living room', 87, 21.5, 22.0, datetime.now())
+
+    assert json.loads(legacy_serialize(data)) == json.loads(data.to_bytes())
+
+    results = {}
+    for name, func in (('legacy', legacy_serialize), ('to_bytes', eTRVData.to_bytes)):
+        best = min(timeit.repeat(lambda: func(data), number=number, repeat=5))
+        results[name] = best / number * 1e9
+
+    for name, ns in results.items():
+        print('{:10} {:8.0f} ns/op'.format(name, ns))
+    print('speedup    {:8.2f}x'.format(results['legacy'] / results['to_bytes']))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
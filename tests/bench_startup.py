@@ -0,0 +1,75 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List
+
+from .benchmark import make_config, percentile
+from .mqttbroker import MqttBroker
+
+
+def time_to_first_publish(broker: MqttBroker, config_file: str, cache_home: str, timeout: float) -> float:
+    """Starts etrv2mqtt and returns seconds until its first message reaches the broker"""
+    published = threading.Event()
+
+    def on_publish(topic, payload, retain):
+        published.set()
+
+    broker.add_listener(on_publish)
+    env = dict(os.environ, XDG_CACHE_HOME=cache_home)
+    start = time.monotonic()
+    process = subprocess.Popen([sys.executable, '-m', 'etrv2mqtt.cli', config_file], env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not published.wait(timeout):
+            raise TimeoutError('etrv2mqtt did not publish anything')
+        return time.monotonic() - start
+    finally:
+        process.kill()
+        process.wait()
+        broker.remove_listener(on_publish)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='etrv2mqtt startup time until first MQTT publish, with and without config cache')
+    parser.add_argument('--devices', type=int, default=20,
+                        help='number of thermostats in config')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of starts per mode')
+    parser.add_argument('--timeout', type=float, default=30)
+    args = parser.parse_args()
+
+    broker = MqttBroker().start()
+    results: Dict[str, List[float]] = {'cold': [], 'warm': []}
+    with tempfile.TemporaryDirectory() as tmp:
+        config_file = os.path.join(tmp, 'config.json')
+        with open(config_file, 'w') as f:
+            json.dump(make_config(args.devices, broker.port, {}), f)
+
+        warm_cache = os.path.join(tmp, 'warm')
+        # populate cache
+        time_to_first_publish(broker, config_file, warm_cache, args.timeout)
+
+        for i in range(args.repeat):
+            cold_cache = os.path.join(tmp, 'cold{}'.format(i))
+            results['cold'].append(time_to_first_publish(
+                broker, config_file, cold_cache, args.timeout))
+            results['warm'].append(time_to_first_publish(
+                broker, config_file, warm_cache, args.timeout))
+    broker.stop()
+
+    report = {mode: {'p50': percentile(times, 50), 'min': min(times), 'max': max(times)}
+              for mode, times in results.items()}
+    for mode, stats in report.items():
+        print('{:5} start: first publish after {p50:.3f}s (min {min:.3f}s, max {max:.3f}s)'.format(
+            mode, **stats), file=sys.stderr)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List
+
+import paho.mqtt.client as paho_mqtt
+from loguru import logger
+
+from etrv2mqtt import metrics
+from etrv2mqtt.aio import AsyncDeviceManager
+from etrv2mqtt.config import Config
+from etrv2mqtt.devices import DeviceManager, TRVDevice
+from .dummyDevice import DummyDevice
+from .mqttbroker import MqttBroker
+
+
+def percentile(values: List[float], p: float) -> float:
+    if len(values) == 0:
+        return float('nan')
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * p / 100
+    lower = int(k)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (k - lower)
+
+
+def current_rss_kb() -> int:
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() // 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def make_config(devices: int, port: int, options: Dict) -> Dict:
+    return {
+        'mqtt': {
+            'server': '127.0.0.1',
+            'port': port,
+            'base_topic': 'bench',
+        },
+        'options': options,
+        'thermostats': [{
+            'topic': 'dev{}'.format(i),
+            'address': '00:00:00:{:02X}:{:02X}:{:02X}'.format(i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff),
+            'secret_key': '{:032x}'.format(i),
+        } for i in range(devices)],
+    }
+
+
+class StateCollector():
+    """Tracks state messages published to the broker"""
+
+    def __init__(self, broker: MqttBroker, base_topic: str):
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._prefix = base_topic + '/'
+        self._states: Dict[str, List] = {}
+        broker.add_listener(self._on_publish)
+
+    def _on_publish(self, topic: str, payload: bytes, retain: bool):
+        levels = topic[len(self._prefix):].split('/')
+        if not topic.startswith(self._prefix) or len(levels) != 2 or levels[1] != 'state':
+            return
+        name = levels[0]
+        received = time.monotonic()
+        with self._condition:
+            self._states.setdefault(name, []).append(
+                (received, json.loads(payload)))
+            self._condition.notify_all()
+
+    def count(self) -> int:
+        with self._lock:
+            return sum(len(states) for states in self._states.values())
+
+    def _wait(self, predicate: Callable[[], bool], timeout: float) -> bool:
+        # failures publish no state, predicates checking them are polled
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while not predicate():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(min(remaining, 0.1))
+            return True
+
+    def wait_count(self, count: int, timeout: float, failures: Callable[[], int] = lambda: 0) -> bool:
+        """Waits for count states, failed operations given by failures() count as well"""
+        return self._wait(lambda: sum(len(states) for states in self._states.values()) + failures() >= count,
+                          timeout)
+
+    def wait_set_point(self, name: str, set_point: float, after: float, timeout: float,
+                       failed: Callable[[], bool] = lambda: False) -> float:
+        """Returns time of first state of device with given set_point received after timestamp,
+        None if it didn't come or failed() became true"""
+        def find():
+            for received, state in self._states.get(name, []):
+                if received >= after and state['set_point'] == set_point:
+                    return received
+            return None
+
+        self._wait(lambda: find() is not None or failed(), timeout)
+        with self._condition:
+            return find()
+
+
+def failed_operations() -> int:
+    return int(sum(sample['value'] for sample in
+                   metrics.registry.snapshot().get('etrv_device_failures_total', [])))
+
+
+def run_single(args) -> Dict:
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level)
+
+    DummyDevice.latency = args.latency
+    DummyDevice.latency_jitter = args.jitter
+
+    broker = MqttBroker().start()
+    options = {
+        'poll_interval': 3600,
+        'poll_workers': args.workers,
+        'setpoint_debounce_time': 1,
+        'event_loop': args.event_loop,
+        # measures how fast a full cycle can go, catch-up polls are not rate limited
+        'catchup_poll_rate': 0,
+    }
+    config_json = make_config(args.devices, broker.port, options)
+    if args.transport == 'simulated':
+        options.update({
+            'transport': 'simulated',
+            'adapters': list(range(args.adapters)),
+            'max_connections': args.max_connections,
+            # every failing thermostat is retried each cycle, cycles finish when all were tried
+            'breaker_failures': 0,
+        })
+        config_json['simulation'] = {
+            'connect_latency': args.latency,
+            'operation_latency': args.latency / 4,
+            'latency_jitter': args.jitter,
+            'connect_failure_rate': args.connect_failure_rate,
+            'drop_rate': args.drop_rate,
+            'adapter_slots': args.adapter_slots,
+            'seed': args.seed,
+        }
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as config_file:
+        json.dump(config_json, config_file)
+    config = Config(config_file.name)
+    os.unlink(config_file.name)
+
+    states = StateCollector(broker, config.mqtt.base_topic)
+    autodiscovery_messages = []
+    broker.add_listener(lambda topic, payload, retain: autodiscovery_messages.append(topic)
+                        if topic.startswith(config.mqtt.autodiscovery_topic) else None)
+
+    cpu_start = time.process_time()
+    start = time.monotonic()
+    publishes_start = broker.publish_count
+
+    device_class = TRVDevice if args.transport == 'simulated' else DummyDevice
+    if args.event_loop == 'asyncio':
+        manager = AsyncDeviceManager(config, device_class)
+    else:
+        manager = DeviceManager(config, device_class)
+    threading.Thread(target=manager.poll_forever, daemon=True).start()
+
+    # first poll cycle starts on connect
+    expected = args.devices
+    if not states.wait_count(expected, args.timeout, failed_operations):
+        raise TimeoutError('initial poll cycle did not finish')
+    first_cycle = time.monotonic() - start
+
+    client = paho_mqtt.Client()
+    client.connect(broker.host, broker.port)
+    client.loop_start()
+
+    # Home Assistant birth message polls every device
+    cycles: List[float] = []
+    for _ in range(args.cycles):
+        expected += args.devices
+        cycle_start = time.monotonic()
+        client.publish(config.mqtt.hass_birth_topic,
+                       config.mqtt.hass_birth_payload)
+        if not states.wait_count(expected, args.timeout, failed_operations):
+            raise TimeoutError('poll cycle did not finish')
+        cycles.append(time.monotonic() - cycle_start)
+
+    setpoint_latencies: List[float] = []
+    setpoint_failures = 0
+    for i in range(args.setpoints):
+        name = 'dev{}'.format(i % args.devices)
+        set_point = 10.0 + (i % 60) / 2
+        failures = failed_operations()
+        sent = time.monotonic()
+        client.publish(config.mqtt.base_topic + '/' + name + '/set', str(set_point))
+        received = states.wait_set_point(name, set_point, sent, args.timeout,
+                                         lambda: failed_operations() > failures)
+        if received is None:
+            if failed_operations() == failures:
+                raise TimeoutError('setpoint was not confirmed')
+            setpoint_failures += 1
+            continue
+        setpoint_latencies.append(received - sent)
+
+    elapsed = time.monotonic() - start
+    publishes = broker.publish_count - publishes_start
+
+    client.loop_stop()
+    broker.stop()
+
+    return {
+        'devices': args.devices,
+        'event_loop': args.event_loop,
+        'workers': args.workers,
+        'ble_latency_s': args.latency,
+        'ble_jitter_s': args.jitter,
+        'transport': args.transport,
+        'failed_operations': failed_operations(),
+        'failed_setpoints': setpoint_failures,
+        'first_poll_cycle_s': first_cycle,
+        'poll_cycle_s': {
+            'mean': sum(cycles) / len(cycles) if len(cycles) > 0 else float('nan'),
+            'min': min(cycles, default=float('nan')),
+            'max': max(cycles, default=float('nan')),
+        },
+        'setpoint_latency_s': {
+            'debounce': config.setpoint_debounce_time,
+            'p50': percentile(setpoint_latencies, 50),
+            'p95': percentile(setpoint_latencies, 95),
+            'p99': percentile(setpoint_latencies, 99),
+        },
+        'autodiscovery_messages': len(autodiscovery_messages),
+        'publishes': publishes,
+        'publishes_per_s': publishes / elapsed,
+        # broker runs in the same process and is included in CPU time and memory
+        'cpu_s': time.process_time() - cpu_start,
+        'rss_kb': current_rss_kb(),
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='etrv2mqtt load test with simulated thermostats and in-process MQTT broker')
+    parser.add_argument('--devices', type=int, nargs='+', default=[10, 100, 1000],
+                        help='number of simulated thermostats, one run per value')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='simulated BLE operation latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.02,
+                        help='maximum random deviation from latency in seconds')
+    parser.add_argument('--transport', choices=['dummy', 'simulated'], default='dummy',
+                        help='dummy replaces whole thermostat, simulated runs real thermostat code '
+                        'on simulated BLE transport with latency as connect latency')
+    parser.add_argument('--drop-rate', type=float, default=0.0,
+                        help='simulated transport: probability of connection drop per operation')
+    parser.add_argument('--connect-failure-rate', type=float, default=0.0,
+                        help='simulated transport: probability of failed connection attempt')
+    parser.add_argument('--adapter-slots', type=int, default=5,
+                        help='simulated transport: connections one adapter can hold')
+    parser.add_argument('--adapters', type=int, default=1,
+                        help='simulated transport: number of adapters thermostats are spread over')
+    parser.add_argument('--max-connections', type=int, default=0,
+                        help='simulated transport: max_connections option, enables connection pool')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='simulated transport: seed of simulated failures')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='poll_workers option')
+    parser.add_argument('--event-loop', choices=['schedule', 'asyncio'], default='schedule',
+                        help='event_loop option')
+    parser.add_argument('--cycles', type=int, default=3,
+                        help='number of measured poll cycles')
+    parser.add_argument('--setpoints', type=int, default=20,
+                        help='number of measured setpoint updates')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='timeout of single measured operation in seconds')
+    parser.add_argument('--output', help='write JSON results to file')
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--single', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        args.devices = args.devices[0]
+        print(json.dumps(run_single(args)))
+        return
+
+    # every run in a fresh process so memory and scheduler state don't leak between runs
+    results = []
+    for devices in args.devices:
+        cmd = [sys.executable, '-m', 'tests.benchmark', '--single',
+               '--devices', str(devices),
+               '--latency', str(args.latency),
+               '--jitter', str(args.jitter),
+               '--transport', args.transport,
+               '--drop-rate', str(args.drop_rate),
+               '--connect-failure-rate', str(args.connect_failure_rate),
+               '--adapter-slots', str(args.adapter_slots),
+               '--adapters', str(args.adapters),
+               '--max-connections', str(args.max_connections),
+               '--seed', str(args.seed),
+               '--workers', str(args.workers),
+               '--event-loop', args.event_loop,
+               '--cycles', str(args.cycles),
+               '--setpoints', str(args.setpoints),
+               '--timeout', str(args.timeout),
+               '--log-level', args.log_level]
+        output = subprocess.run(cmd, check=True, stdout=subprocess.PIPE).stdout
+        result = json.loads(output)
+        results.append(result)
+        print('{devices:5} devices: poll cycle {poll_cycle_s[mean]:.3f}s, '
+              'setpoint p50/p95/p99 {setpoint_latency_s[p50]:.3f}/{setpoint_latency_s[p95]:.3f}/'
+              '{setpoint_latency_s[p99]:.3f}s, {publishes_per_s:.1f} publishes/s, '
+              'cpu {cpu_s:.2f}s, rss {rss_kb}kB'.format(**result), file=sys.stderr)
+
+    report = json.dumps({'results': results}, indent=2)
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            output_file.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
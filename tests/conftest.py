@@ -0,0 +1,57 @@
+import json
+from typing import Any, Callable, Dict
+
+import pytest
+
+from etrv2mqtt.config import Config
+from etrv2mqtt.devices import DeviceManager
+from tests.dummyDevice import DummyDevice
+
+
+def config_json(devices: int, options: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'mqtt': {
+            'server': '127.0.0.1',
+            'base_topic': 'test',
+        },
+        'options': options,
+        'thermostats': [{
+            'topic': 'dev{}'.format(i),
+            'address': '00:00:00:00:{:02X}:{:02X}'.format(i >> 8 & 0xff, i & 0xff),
+            'secret_key': '{:032x}'.format(i),
+        } for i in range(devices)],
+    }
+
+
+@pytest.fixture
+def write_config(tmp_path) -> Callable[..., str]:
+    """write_config(devices=1, **options) writes config with dummy thermostats dev0, dev1...
+    and returns its path. Every call in a test overwrites the same file."""
+    def write(devices: int = 1, **options) -> str:
+        config_file = tmp_path / 'config.json'
+        config_file.write_text(json.dumps(config_json(devices, options)))
+        return str(config_file)
+    return write
+
+
+@pytest.fixture
+def make_config(write_config) -> Callable[..., Config]:
+    """Same arguments as write_config, returns loaded Config"""
+    return lambda devices=1, **options: Config(write_config(devices, **options))
+
+
+@pytest.fixture
+def manager_options() -> Dict[str, Any]:
+    """Options of manager fixture, override in test module"""
+    return {}
+
+
+@pytest.fixture
+def manager(make_config, manager_options):
+    """DeviceManager of DummyDevice thermostats, not connected to MQTT. manager_options
+    may set 'devices', everything else goes to options."""
+    options = dict(manager_options)
+    manager = DeviceManager(make_config(
+        options.pop('devices', 1), **options), DummyDevice)
+    yield manager
+    manager._poll_engine.shutdown()
@@ -3,7 +3,9 @@ import sys
 from loguru import logger
 
 from etrv2mqtt.config import Config
+from etrv2mqtt.aio import AsyncDeviceManager
 from etrv2mqtt.devices import DeviceManager
+from etrv2mqtt.supervisor import ShardSupervisor
 from .dummyDevice import DummyDevice
 
 
@@ -14,7 +16,14 @@ def main(config_file: str):
         logger.error(e)
         sys.exit(1)
 
-    deviceManager = DeviceManager(config, DummyDevice)
+    if config.shards > 1:
+        ShardSupervisor(config, DummyDevice).run()
+        return
+
+    if config.event_loop == 'asyncio':
+        deviceManager = AsyncDeviceManager(config, DummyDevice)
+    else:
+        deviceManager = DeviceManager(config, DummyDevice)
     deviceManager.poll_forever()
 
 
@@ -1,10 +1,13 @@
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, asdict, field
 from etrv2mqtt.mqtt import Mqtt
 from etrv2mqtt.devices import DeviceBase
 from etrv2mqtt.config import ThermostatConfig, Config
 from etrv2mqtt.etrvutils import eTRVData
 from loguru import logger
 from datetime import datetime
+import random
+import time
+from typing import Any, Dict, Set
 
 
 @dataclass
@@ -15,22 +18,59 @@ class _eTRVDummyDevice:
     battery: int = 99
     set_point: float = 21
     current_temp: float = 21
+    settings: Dict[str, Any] = field(default_factory=dict)
 
 
 class DummyDevice(DeviceBase):
+    # simulated BLE round trip time in seconds, set before creating devices to load test
+    latency: float = 0.0
+    latency_jitter: float = 0.0
+    # names of thermostats out of range, every operation on them fails
+    unreachable: Set[str] = set()
+
     def __init__(self, thermostat_config: ThermostatConfig, config: Config):
         super().__init__(thermostat_config, config)
         self._device = _eTRVDummyDevice(
             thermostat_config.topic, thermostat_config.address, bytes.fromhex(thermostat_config.secret_key))
 
-    def poll(self, mqtt: Mqtt):
+    def _simulate_latency(self):
+        if self.latency > 0 or self.latency_jitter > 0:
+            time.sleep(max(0.0, self.latency +
+                           random.uniform(-self.latency_jitter, self.latency_jitter)))
+
+    def poll(self, mqtt: Mqtt, probe: bool = False):
         logger.debug("Polling data from {}", self._device.name)
+        self._simulate_latency()
+        if self._device.name in self.unreachable:
+            logger.error("Unable connect to {}", self._device.name)
+            return None
         ret = eTRVData(self._device.name, self._device.battery,
                        self._device.current_temp, self._device.set_point, datetime.now())
-        logger.debug(str(ret))
-        mqtt.publish_device_data(self._device.name, str(ret))
+        logger.debug("{}", ret)
+        mqtt.publish_device_data(self._device.name, ret)
+        return ret
 
-    def set_temperature(self, mqtt: Mqtt, temperature: float):
+    def set_temperature(self, mqtt: Mqtt, temperature: float, refresh: bool = False, probe: bool = False):
         logger.debug("Setting {} to {}C", self._device.name, temperature)
+        self._simulate_latency()
+        if self._device.name in self.unreachable:
+            logger.error("Unable connect to {}", self._device.name)
+            return None
         self._device.set_point = temperature
-        self.poll(mqtt)
+        # confirmation is folded into the write session, refresh costs one more round trip
+        if refresh:
+            return self.poll(mqtt)
+        ret = eTRVData(self._device.name, self._device.battery,
+                       self._device.current_temp, self._device.set_point, datetime.now())
+        logger.debug("{}", ret)
+        mqtt.publish_device_data(self._device.name, ret)
+        return ret
+
+    def apply_settings(self, settings: Dict[str, Any], probe: bool = False):
+        logger.debug("Writing settings {} to {}", settings, self._device.name)
+        self._simulate_latency()
+        if self._device.name in self.unreachable:
+            logger.error("Unable connect to {}", self._device.name)
+            return None
+        self._device.settings.update(settings)
+        return dict(self._device.settings)
@@ -0,0 +1,301 @@
+import socket
+import struct
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from loguru import logger
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    filter_levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+    for i, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level != '+' and level != topic_levels[i]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+def _encode_length(length: int) -> bytes:
+    ret = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length > 0:
+            byte |= 0x80
+        ret.append(byte)
+        if length == 0:
+            return bytes(ret)
+
+
+def _encode_string(s: bytes) -> bytes:
+    return struct.pack('!H', len(s)) + s
+
+
+def _packet(header: int, body: bytes) -> bytes:
+    return bytes((header,)) + _encode_length(len(body)) + body
+
+
+class _ClientSession():
+    def __init__(self, broker: 'MqttBroker', sock: socket.socket):
+        self.broker = broker
+        self.sock = sock
+        self.client_id = ''
+        self.subscriptions: List[str] = []
+        self.will: Optional[Tuple[str, bytes, bool]] = None
+        self._send_lock = threading.Lock()
+
+    def send(self, data: bytes):
+        with self._send_lock:
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                pass
+
+    def deliver(self, topic: str, payload: bytes, retain: bool = False):
+        header = 0x30 | (0x01 if retain else 0x00)
+        self.send(_packet(header, _encode_string(topic.encode()) + payload))
+
+    def _recv_exact(self, n: int) -> bytes:
+        data = bytearray()
+        while len(data) < n:
+            chunk = self.sock.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError
+            data += chunk
+        return bytes(data)
+
+    def _read_packet(self) -> Tuple[int, bytes]:
+        header = self._recv_exact(1)[0]
+        multiplier = 1
+        length = 0
+        while True:
+            byte = self._recv_exact(1)[0]
+            length += (byte & 0x7f) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header, self._recv_exact(length) if length else b''
+
+    def run(self):
+        clean_disconnect = False
+        try:
+            while True:
+                header, body = self._read_packet()
+                packet_type = header >> 4
+                if packet_type == 1:
+                    self._on_connect(body)
+                elif packet_type == 3:
+                    self._on_publish(header, body)
+                elif packet_type == 6:
+                    # PUBREL -> PUBCOMP
+                    self.send(_packet(0x70, body[:2]))
+                elif packet_type == 8:
+                    self._on_subscribe(body)
+                elif packet_type == 10:
+                    self._on_unsubscribe(body)
+                elif packet_type == 12:
+                    self.send(_packet(0xd0, b''))
+                elif packet_type == 14:
+                    clean_disconnect = True
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.broker._remove_session(self)
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            if not clean_disconnect and self.will is not None:
+                self.broker.publish(*self.will)
+
+    def _on_connect(self, body: bytes):
+        pos = 2 + struct.unpack('!H', body[0:2])[0]
+        flags = body[pos + 1]
+        pos += 4
+        id_len = struct.unpack('!H', body[pos:pos+2])[0]
+        self.client_id = body[pos+2:pos+2+id_len].decode()
+        pos += 2 + id_len
+        if flags & 0x04:
+            topic_len = struct.unpack('!H', body[pos:pos+2])[0]
+            will_topic = body[pos+2:pos+2+topic_len].decode()
+            pos += 2 + topic_len
+            msg_len = struct.unpack('!H', body[pos:pos+2])[0]
+            will_payload = body[pos+2:pos+2+msg_len]
+            self.will = (will_topic, will_payload, bool(flags & 0x20))
+        self.send(_packet(0x20, b'\x00\x00'))
+
+    def _on_publish(self, header: int, body: bytes):
+        qos = (header >> 1) & 0x03
+        retain = bool(header & 0x01)
+        topic_len = struct.unpack('!H', body[0:2])[0]
+        topic = body[2:2+topic_len].decode()
+        pos = 2 + topic_len
+        if qos > 0:
+            packet_id = body[pos:pos+2]
+            pos += 2
+            self.send(_packet(0x40 if qos == 1 else 0x50, packet_id))
+        self.broker.publish(topic, body[pos:], retain)
+
+    def _on_subscribe(self, body: bytes):
+        packet_id = body[0:2]
+        pos = 2
+        filters = []
+        while pos < len(body):
+            filter_len = struct.unpack('!H', body[pos:pos+2])[0]
+            filters.append(body[pos+2:pos+2+filter_len].decode())
+            pos += 3 + filter_len
+        self.send(_packet(0x90, packet_id + b'\x00' * len(filters)))
+        for topic_filter in filters:
+            self.broker._subscribe(self, topic_filter)
+
+    def _on_unsubscribe(self, body: bytes):
+        packet_id = body[0:2]
+        pos = 2
+        while pos < len(body):
+            filter_len = struct.unpack('!H', body[pos:pos+2])[0]
+            self.broker._unsubscribe(
+                self, body[pos+2:pos+2+filter_len].decode())
+            pos += 2 + filter_len
+        self.send(_packet(0xb0, packet_id))
+
+
+class MqttBroker():
+    """Minimal in-process MQTT 3.1.1 broker for tests and benchmarks.
+    Supports retained messages, wildcards and last will, every message is delivered with QoS 0."""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((host, port))
+        self._server.listen(128)
+        self.host = host
+        self.port = self._server.getsockname()[1]
+
+        self._lock = threading.Lock()
+        # every subscriber gets messages in the same order, like from a real broker
+        self._order_lock = threading.RLock()
+        self._sessions: List[_ClientSession] = []
+        self._retained: Dict[str, bytes] = {}
+        self._listeners: List[Callable[[str, bytes, bool], None]] = []
+        self.publish_count = 0
+        self._running = False
+
+    def start(self) -> 'MqttBroker':
+        self._running = True
+        threading.Thread(target=self._accept_loop, daemon=True,
+                         name='mqtt-broker').start()
+        return self
+
+    def stop(self):
+        self._running = False
+        try:
+            # wakes up accept() so the port is released right away
+            self._server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._server.close()
+        with self._lock:
+            sessions = list(self._sessions)
+        for session in sessions:
+            try:
+                session.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _accept_loop(self):
+        while self._running:
+            try:
+                sock, _ = self._server.accept()
+            except OSError:
+                break
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            session = _ClientSession(self, sock)
+            with self._lock:
+                self._sessions.append(session)
+            threading.Thread(target=session.run, daemon=True).start()
+
+    def _remove_session(self, session: _ClientSession):
+        with self._lock:
+            if session in self._sessions:
+                self._sessions.remove(session)
+
+    def disconnect(self, client_id: str):
+        """Drop connection of one client without DISCONNECT, its last will is published"""
+        with self._lock:
+            sessions = [s for s in self._sessions if s.client_id == client_id]
+        for session in sessions:
+            try:
+                session.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def disconnect_all(self):
+        """Drop every client connection without DISCONNECT, last will messages are published"""
+        with self._lock:
+            sessions = list(self._sessions)
+        for session in sessions:
+            try:
+                session.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _subscribe(self, session: _ClientSession, topic_filter: str):
+        with self._order_lock:
+            with self._lock:
+                if topic_filter not in session.subscriptions:
+                    session.subscriptions.append(topic_filter)
+                retained = [(t, p) for t, p in self._retained.items()
+                            if topic_matches(topic_filter, t)]
+            for topic, payload in retained:
+                session.deliver(topic, payload, retain=True)
+
+    def _unsubscribe(self, session: _ClientSession, topic_filter: str):
+        with self._lock:
+            if topic_filter in session.subscriptions:
+                session.subscriptions.remove(topic_filter)
+
+    def add_listener(self, listener: Callable[[str, bytes, bool], None]):
+        """Call listener(topic, payload, retain) for every message published to the broker"""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[str, bytes, bool], None]):
+        self._listeners.remove(listener)
+
+    def retained(self, topic: str) -> Optional[bytes]:
+        with self._lock:
+            return self._retained.get(topic)
+
+    def publish(self, topic: str, payload: bytes, retain: bool = False):
+        with self._order_lock:
+            with self._lock:
+                self.publish_count += 1
+                if retain:
+                    if len(payload) == 0:
+                        self._retained.pop(topic, None)
+                    else:
+                        self._retained[topic] = payload
+                receivers = [s for s in self._sessions
+                             if any(topic_matches(f, topic) for f in s.subscriptions)]
+            for listener in self._listeners:
+                try:
+                    listener(topic, payload, retain)
+                except Exception as e:
+                    logger.opt(exception=e).error("Broker listener failed")
+            for session in receivers:
+                session.deliver(topic, payload)
+
+
+def wait_for(condition: Callable[[], bool], timeout: float = 5.0, interval: float = 0.01) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(interval)
+    logger.warning("Timed out waiting for condition")
+    return condition()
@@ -0,0 +1,215 @@
+import argparse
+import asyncio
+import json
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import paho.mqtt.client as paho_mqtt
+from loguru import logger
+
+from etrv2mqtt.aio import AsyncDeviceManager
+from etrv2mqtt.config import Config, ThermostatConfig
+from etrv2mqtt.mqtt import Mqtt
+from .benchmark import make_config
+from .dummyDevice import DummyDevice
+from .mqttbroker import MqttBroker, wait_for
+
+# (node, thermostat, operation, start, end) of every simulated BLE session
+_sessions: List[Tuple[str, str, str, float, float]] = []
+_sessions_lock = threading.Lock()
+
+
+class RecordingDevice(DummyDevice):
+    """Dummy thermostat recording which node accessed it and when. Node on the
+    same floor as the thermostat reaches it faster."""
+
+    floors = 1
+
+    def __init__(self, thermostat_config: ThermostatConfig, config: Config):
+        super().__init__(thermostat_config, config)
+        self._node = config.node_name
+        self._name = thermostat_config.topic
+        node_floor = int(self._node.split('-')[-1]) % self.floors
+        device_floor = int(self._name[len('dev'):]) % self.floors
+        self._latency = 0.05 * (1 + abs(node_floor - device_floor))
+
+    def _record(self, operation: str, func, *args):
+        start = time.monotonic()
+        time.sleep(self._latency)
+        ret = func(*args)
+        with _sessions_lock:
+            _sessions.append((self._node, self._name, operation,
+                              start, time.monotonic()))
+        return ret
+
+    def poll(self, mqtt: Mqtt, probe: bool = False):
+        return self._record('poll', super().poll, mqtt, probe)
+
+    def set_temperature(self, mqtt: Mqtt, temperature: float, refresh: bool = False, probe: bool = False):
+        return self._record('write', super().set_temperature, mqtt, temperature, refresh, probe)
+
+
+class Node():
+    def __init__(self, config_file: str, node_id: str):
+        self.node_id = node_id
+        config = Config(config_file)
+        config.node_id = node_id
+        self.manager = AsyncDeviceManager(config, RecordingDevice)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread = threading.Thread(
+            target=self._run, daemon=True, name=node_id)
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        try:
+            self._loop.run_until_complete(self.manager._run())
+        except RuntimeError:
+            # stopped by crash()
+            pass
+
+    def start(self):
+        self._thread.start()
+
+    @property
+    def client_id(self) -> str:
+        return self.manager._mqtt._client._client_id.decode()
+
+    def owned(self) -> List[str]:
+        return sorted(name for name in self.manager._devices.keys()
+                      if self.manager._coordinator.owns(name))
+
+    def crash(self):
+        """Stops the node without a clean MQTT disconnect"""
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+def overlaps() -> List[Tuple]:
+    """Sessions of different nodes on the same thermostat overlapping in time"""
+    by_device: Dict[str, List[Tuple[str, str, str, float, float]]] = defaultdict(list)
+    with _sessions_lock:
+        for session in _sessions:
+            by_device[session[1]].append(session)
+    ret = []
+    for sessions in by_device.values():
+        sessions.sort(key=lambda session: session[3])
+        for i, session in enumerate(sessions):
+            for other in sessions[i+1:]:
+                if other[3] >= session[4]:
+                    break
+                if other[0] != session[0]:
+                    ret.append((session, other))
+    return ret
+
+
+def polled_since(since: float) -> Dict[str, str]:
+    """Thermostat -> node that last accessed it after since"""
+    with _sessions_lock:
+        return {name: node for node, name, _, start, _ in _sessions if start >= since}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Runs several coordinated bridge nodes against in-process MQTT broker and checks '
+                    'that no thermostat is accessed by two nodes at once, also across node failures')
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--devices', type=int, default=12)
+    parser.add_argument('--lease-time', type=int, default=3)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level)
+    RecordingDevice.floors = args.nodes
+
+    broker = MqttBroker().start()
+    options = {
+        'poll_interval': 2,
+        'setpoint_debounce_time': 1,
+        'event_loop': 'asyncio',
+        'coordination': True,
+        'lease_time': args.lease_time,
+    }
+    with tempfile.NamedTemporaryFile('w', suffix='.json') as config_file:
+        json.dump(make_config(args.devices, broker.port, options), config_file)
+        config_file.flush()
+        nodes = [Node(config_file.name, 'node-{}'.format(i))
+                 for i in range(args.nodes)]
+    names = ['dev{}'.format(i) for i in range(args.devices)]
+    failures: List[str] = []
+
+    def check(condition: bool, message: str):
+        print('{}: {}'.format('ok' if condition else 'FAILED', message), file=sys.stderr)
+        if not condition:
+            failures.append(message)
+
+    def all_owned(alive: List[Node]) -> bool:
+        owned = [name for node in alive for name in node.owned()]
+        return sorted(owned) == sorted(names)
+
+    start = time.monotonic()
+    for node in nodes:
+        node.start()
+    check(wait_for(lambda: all_owned(nodes), args.timeout),
+          'every thermostat has exactly one owner after {:.1f}s'.format(time.monotonic() - start))
+    for node in nodes:
+        print('  {}: {}'.format(node.node_id, node.owned()), file=sys.stderr)
+
+    # every node receives the setpoint, only the owner writes it
+    client = paho_mqtt.Client()
+    client.connect(broker.host, broker.port)
+    client.loop_start()
+    sent = time.monotonic()
+    for name in names:
+        client.publish('bench/' + name + '/set', '22.5')
+    time.sleep(options['setpoint_debounce_time'] + 2)
+    with _sessions_lock:
+        writes = [session for session in _sessions
+                  if session[2] == 'write' and session[3] >= sent]
+    check(sorted(session[1] for session in writes) == sorted(names),
+          'every setpoint written once ({} writes for {} thermostats)'.format(len(writes), len(names)))
+
+    # crashed node's last will hands its thermostats over to the others
+    crashed = nodes[0]
+    orphans = crashed.owned()
+    crashed.crash()
+    crashed_at = time.monotonic()
+    broker.disconnect(crashed.client_id)
+    alive = nodes[1:]
+    check(wait_for(lambda: all_owned(alive), args.timeout),
+          '{} thermostats of crashed node taken over after {:.1f}s'.format(
+              len(orphans), time.monotonic() - crashed_at))
+    check(wait_for(lambda: all(name in polled_since(crashed_at) for name in orphans), args.timeout),
+          'thermostats of crashed node polled again')
+
+    # node that lost connection stops accessing its thermostats until claims settle again
+    dropped = nodes[1]
+    dropped_at = time.monotonic()
+    broker.disconnect(dropped.client_id)
+    check(wait_for(lambda: dropped.manager._mqtt.is_connected() and all_owned(alive), args.timeout),
+          'ownership settled after node reconnected in {:.1f}s'.format(time.monotonic() - dropped_at))
+    time.sleep(args.lease_time * 2)
+
+    check(len(overlaps()) == 0, 'no thermostat accessed by two nodes at the same time')
+    for session, other in overlaps()[:10]:
+        print('  {} overlaps {}'.format(session, other), file=sys.stderr)
+
+    near = sum(1 for node in alive for name in node.owned()
+               if int(node.node_id.split('-')[-1]) % RecordingDevice.floors ==
+               int(name[len('dev'):]) % RecordingDevice.floors)
+    print('{} of {} thermostats owned by the node on the same floor'.format(near, len(names)),
+          file=sys.stderr)
+
+    client.loop_stop()
+    # nodes keep running in daemon threads until interpreter exits
+    logger.remove()
+    broker.stop()
+    sys.exit(1 if len(failures) > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import time
+
+import pytest
+
+from etrv2mqtt.devices import CircuitBreaker
+from tests.dummyDevice import DummyDevice
+
+
+def open_breaker(now: float = 0) -> CircuitBreaker:
+    breaker = CircuitBreaker(2, 10, 40)
+    assert breaker.record(False, now) is False
+    assert breaker.record(False, now) is True
+    return breaker
+
+
+def test_opens_after_threshold():
+    breaker = CircuitBreaker(2, 10, 40)
+    assert breaker.acquire(0) is False
+    breaker.record(False, 0)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.acquire(0) is False
+    breaker.record(False, 0)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.available
+
+
+def test_success_resets_failure_count():
+    breaker = CircuitBreaker(2, 10, 40)
+    breaker.record(False, 0)
+    assert breaker.record(True, 0) is False
+    breaker.record(False, 0)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_open_lets_single_probe_through_after_backoff():
+    breaker = open_breaker()
+    assert breaker.acquire(5) is None
+    assert breaker.acquire(5, force=True) is True
+    assert breaker.state == CircuitBreaker.OPEN
+
+    assert breaker.acquire(12) is True
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.acquire(12) is None
+
+
+def test_successful_probe_closes():
+    breaker = open_breaker()
+    breaker.acquire(12)
+    assert breaker.record(True, 12) is True
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.failures == 0
+
+
+def test_failed_probe_reopens_with_longer_backoff():
+    breaker = open_breaker()
+    breaker.acquire(12)
+    assert breaker.record(False, 12) is False
+    assert breaker.state == CircuitBreaker.OPEN
+    # backoff doubled to 20s
+    assert breaker.acquire(29) is None
+    assert breaker.acquire(35) is True
+
+    breaker.record(False, 35)
+    breaker.acquire(100)
+    breaker.record(False, 100)
+    # capped at max_backoff
+    assert breaker.acquire(145) is True
+
+
+def test_lost_probe_reopens_after_max_backoff():
+    breaker = open_breaker()
+    assert breaker.acquire(12) is True
+    assert breaker.acquire(40) is None
+    # probe counted as failed at 52, open for another 20s
+    assert breaker.acquire(52) is None
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.acquire(75) is True
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+
+@pytest.fixture
+def manager_options():
+    return {'breaker_failures': 1, 'breaker_backoff': 1, 'breaker_max_backoff': 60}
+
+
+def raise_error(*args, **kwargs):
+    raise RuntimeError("adapter gone")
+
+
+def test_raising_probe_reopens_breaker(manager, monkeypatch):
+    breaker = manager._breakers['dev0']
+    now = time.monotonic()
+    breaker.record(False, now - 10)
+    assert breaker.state == CircuitBreaker.OPEN
+
+    monkeypatch.setattr(DummyDevice, 'poll', raise_error)
+    assert breaker.acquire(now) is True
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    manager._poll_device('dev0', True)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_raising_setpoint_write_reopens_breaker(manager, monkeypatch):
+    breaker = manager._breakers['dev0']
+    # backoff has passed, write goes through as a probe
+    breaker.record(False, time.monotonic() - 10)
+
+    monkeypatch.setattr(DummyDevice, 'set_temperature', raise_error)
+    manager._set_temperature('dev0', 22)
+    assert breaker.state == CircuitBreaker.OPEN
@@ -0,0 +1,41 @@
+import os
+import stat
+
+import pytest
+
+from etrv2mqtt.config import Config
+
+
+def test_validated_config_is_cached_privately(tmp_path, write_config):
+    cache_dir = tmp_path / 'cache'
+    config_file = write_config(poll_interval=60)
+    Config(config_file, cache_dir=str(cache_dir))
+
+    assert stat.S_IMODE(os.stat(str(cache_dir)).st_mode) == 0o700
+    cached = os.listdir(str(cache_dir))
+    assert len(cached) == 1
+    assert stat.S_IMODE(os.stat(str(cache_dir / cached[0])).st_mode) == 0o600
+    assert Config(config_file, cache_dir=str(cache_dir)).poll_interval == 60
+
+
+def test_cache_keeps_only_current_config(tmp_path, write_config):
+    cache_dir = tmp_path / 'cache'
+    cache_dir.mkdir(mode=0o755)
+    for poll_interval in (60, 120, 180):
+        config_file = write_config(poll_interval=poll_interval)
+        assert Config(config_file, cache_dir=str(cache_dir)).poll_interval == poll_interval
+
+    assert len(os.listdir(str(cache_dir))) == 1
+    assert stat.S_IMODE(os.stat(str(cache_dir)).st_mode) == 0o700
+
+
+@pytest.mark.parametrize('adapters', [[0], [0, 2]])
+def test_shards_without_adapter_are_rejected(make_config, adapters):
+    with pytest.raises(ValueError):
+        make_config(devices=4, shards=2, adapters=adapters)
+
+
+def test_shards_split_thermostats_by_adapter(make_config):
+    config = make_config(devices=4, shards=2, adapters=[0, 1])
+    config.select_shard(1)
+    assert sorted(config.thermostats) == ['dev1', 'dev3']
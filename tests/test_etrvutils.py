@@ -0,0 +1,24 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from etrv2mqtt.etrvutils import _TimestampFormatter, eTRVData
+
+
+@pytest.mark.parametrize('value', [float('nan'), float('inf'), float('-inf')])
+def test_non_finite_temperature_is_published_as_null(value):
+    data = eTRVData('dev', 99, value, 21.5, datetime(2020, 1, 1, 12))
+    state = json.loads(data.to_bytes())
+    assert state['room_temp'] is None
+    assert state['set_point'] == 21.5
+
+
+def test_timestamp_offset_is_looked_up_again_next_hour():
+    format_timestamp = _TimestampFormatter()
+    timestamp = datetime(2020, 1, 1, 12, 30)
+    assert datetime.fromisoformat(format_timestamp(timestamp)) == timestamp.astimezone()
+    later = timestamp + timedelta(hours=1)
+    assert datetime.fromisoformat(format_timestamp(later)) == later.astimezone()
+    assert format_timestamp._hour[:2] == (datetime(2020, 1, 1, 13), datetime(2020, 1, 1, 14))
+    assert format_timestamp(later.replace(tzinfo=timezone.utc)) == '2020-01-01T13:30:00+00:00'
@@ -0,0 +1,50 @@
+import json
+from datetime import datetime
+
+import pytest
+
+from etrv2mqtt.etrvutils import eTRVData
+
+
+@pytest.fixture
+def manager_options():
+    return {'history_size': 100}
+
+
+@pytest.fixture
+def published(manager, monkeypatch):
+    published = []
+    monkeypatch.setattr(manager._mqtt, 'publish',
+                        lambda topic, payload, retain=False: published.append((topic, json.loads(payload))))
+    manager._history.record('dev0', eTRVData('dev0', 90, 21, 22, datetime.now()))
+    return published
+
+
+def test_response_on_default_topic(manager, published):
+    manager._history_request('dev0', b'{"id": 1, "start": -60}', False)
+    topic, result = published[0]
+    assert topic == 'test/dev0/history'
+    assert result['id'] == 1
+
+
+def test_response_topic_under_base_topic(manager, published):
+    manager._history_request('dev0', b'{"response_topic": "test/ui/reply"}', False)
+    assert published[0][0] == 'test/ui/reply'
+
+
+@pytest.mark.parametrize('request_payload', [
+    b'{"response_topic": "homeassistant/climate/x/config"}',
+    b'{"response_topic": "test/#"}',
+    b'{"response_topic": 1}',
+    b'{"step": Infinity}',
+    b'{"start": NaN}',
+    b'{"end": "x"}',
+])
+def test_invalid_request_is_ignored(manager, published, request_payload):
+    manager._history_request('dev0', request_payload, False)
+    assert published == []
+
+
+def test_non_finite_query_is_rejected(manager):
+    with pytest.raises(ValueError):
+        manager._query_history('dev0', {'step': 'inf'})
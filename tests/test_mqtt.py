@@ -0,0 +1,73 @@
+import threading
+
+import paho.mqtt.client as paho_mqtt
+import pytest
+
+from etrv2mqtt import metrics
+from etrv2mqtt.mqtt import Mqtt
+
+
+class FakeClient():
+    """Connected paho client recording published topics"""
+
+    def __init__(self):
+        self.published = []
+        self.on_publish_topic = None
+
+    def is_connected(self) -> bool:
+        return True
+
+    def publish(self, topic, payload=None, retain=False):
+        self.published.append(topic)
+        if self.on_publish_topic is not None:
+            self.on_publish_topic(topic)
+        return paho_mqtt.MQTTMessageInfo(len(self.published))
+
+
+@pytest.fixture
+def mqtt(make_config):
+    mqtt = Mqtt(make_config(), autostart=False)
+    mqtt._client = FakeClient()
+    return mqtt
+
+
+def test_publishes_directly_when_queue_is_empty(mqtt):
+    mqtt.publish('a', '1')
+    assert mqtt._client.published == ['a']
+    assert len(mqtt._outbound) == 0
+
+
+def test_direct_publish_waits_for_running_flush(mqtt):
+    for topic in ('old0', 'old1'):
+        mqtt._outbound.put(topic, '1')
+    publishers = []
+
+    def publish_newer(topic):
+        # message published while flush is handing the popped batch to paho
+        if topic == 'old0':
+            publisher = threading.Thread(target=mqtt.publish, args=('new', '1'))
+            publisher.start()
+            publishers.append(publisher)
+            publisher.join(0.2)
+
+    mqtt._client.on_publish_topic = publish_newer
+    mqtt._flush()
+    publishers[0].join()
+    assert mqtt._client.published == ['old0', 'old1', 'new']
+
+
+def test_in_flight_messages_are_counted_until_written(mqtt):
+    mqtt.publish('a', '1')
+    mqtt.publish('b', '1')
+    assert mqtt._client_queue_depth() == 2
+    mqtt._on_publish(mqtt._client, None, 1)
+    assert mqtt._client_queue_depth() == 1
+    mqtt._on_disconnect(mqtt._client, None, 1)
+    assert mqtt._client_queue_depth() == 0
+
+
+def test_queue_gauges_sum_every_instance(make_config):
+    instances = [Mqtt(make_config(), autostart=False) for _ in range(2)]
+    for mqtt in instances:
+        mqtt._outbound.put('a', '1')
+    assert metrics.mqtt_outbound_queue_depth.labels().get() >= 2
@@ -0,0 +1,48 @@
+import threading
+import time
+
+from etrv2mqtt.presence import PresenceTable, RadioGate
+
+
+def test_absent_after_timeout_once_scanning_works():
+    table = PresenceTable(60)
+    assert table.present('dev0', now=0)
+    table.scan_completed(now=0)
+    assert table.present('dev0', now=30)
+    table.scan_completed(now=50)
+    assert not table.present('dev0', now=61)
+
+
+def test_scan_waits_for_running_operation():
+    gate = RadioGate()
+    events = []
+
+    def scan():
+        with gate.scan(0):
+            events.append('scan')
+
+    with gate.operation(0):
+        scanner = threading.Thread(target=scan)
+        scanner.start()
+        time.sleep(0.1)
+        events.append('operation done')
+    scanner.join()
+    assert events == ['operation done', 'scan']
+
+
+def test_operation_waits_for_scan_on_same_adapter():
+    gate = RadioGate()
+    events = []
+
+    def operation(adapter):
+        gate.run(adapter, events.append, 'hci{}'.format(adapter))
+
+    with gate.scan(0):
+        workers = [threading.Thread(target=operation, args=(adapter,)) for adapter in (0, 1)]
+        for worker in workers:
+            worker.start()
+        workers[1].join()
+        time.sleep(0.1)
+        events.append('scan done')
+    workers[0].join()
+    assert events == ['hci1', 'scan done', 'hci0']
@@ -0,0 +1,100 @@
+from datetime import datetime
+
+import pytest
+
+from etrv2mqtt.etrvutils import eTRVData
+from etrv2mqtt.scheduling import AdaptivePollScheduler, PollPlanner
+from tests.dummyDevice import DummyDevice
+
+
+def reading(room_temp: float = 21, set_point: float = 21, battery: int = 99) -> eTRVData:
+    return eTRVData('dev', battery, room_temp, set_point, datetime.now())
+
+
+def test_pop_due_holds_device_until_reading_is_recorded():
+    scheduler = AdaptivePollScheduler(['dev0'], 10, 80, 0.5)
+    assert scheduler.pop_due(now=1e9) == ['dev0']
+    assert scheduler.pop_due(now=1e9) == []
+    assert scheduler.next_deadline() is None
+
+    scheduler.record_reading('dev0', None, now=100)
+    assert scheduler.next_deadline() == 110
+
+
+def test_interval_doubles_while_stable_and_drops_on_change():
+    scheduler = AdaptivePollScheduler(['dev0'], 10, 80, 0.5)
+    scheduler.record_reading('dev0', reading(), now=0)
+    assert scheduler.interval('dev0') == 10
+    for expected in (20, 40, 80, 80):
+        scheduler.record_reading('dev0', reading(), now=0)
+        assert scheduler.interval('dev0') == expected
+
+    scheduler.record_reading('dev0', reading(room_temp=22), now=0)
+    assert scheduler.interval('dev0') == 10
+
+
+def test_failed_poll_keeps_interval():
+    scheduler = AdaptivePollScheduler(['dev0'], 10, 80, 0.5)
+    scheduler.record_reading('dev0', reading(), now=0)
+    scheduler.record_reading('dev0', reading(), now=0)
+    scheduler.record_reading('dev0', None, now=0)
+    assert scheduler.interval('dev0') == 20
+
+
+def test_low_battery_is_polled_less_often():
+    scheduler = AdaptivePollScheduler(['dev0'], 10, 80, 0.5)
+    scheduler.record_reading('dev0', reading(battery=10), now=0)
+    assert scheduler.interval('dev0') == 40
+
+
+def test_catchup_rate_spreads_added_devices():
+    scheduler = AdaptivePollScheduler([], 10, 80, 0.5, catchup_rate=2)
+    for i in range(4):
+        scheduler.add('dev{}'.format(i), now=100)
+    assert scheduler.pop_due(now=100) == ['dev0']
+    assert scheduler.pop_due(now=101) == ['dev1', 'dev2']
+
+
+def test_planner_keeps_slot_after_failed_poll():
+    names = ['dev{}'.format(i) for i in range(4)]
+    planner = PollPlanner(names, 60)
+    assert sorted(planner.phase(name) for name in names) == [0, 15, 30, 45]
+
+    due = planner.pop_due(now=1e9)
+    assert sorted(due) == names
+    for name in due:
+        planner.record_reading(name, None)
+    assert sorted(planner.pop_due(now=1e12)) == names
+
+
+
+def test_planner_spreads_phases_after_add_and_remove():
+    planner = PollPlanner(['dev0', 'dev1'], 60)
+    planner.add('dev2')
+    planner.add('dev3')
+    planner.remove('dev0')
+    assert sorted(planner.phase(name) for name in ('dev1', 'dev2', 'dev3')) == [0, 20, 40]
+
+
+def test_planner_keeps_slot_on_setpoint():
+    planner = PollPlanner(['dev0'], 60)
+    planner.pop_due(now=1e9)
+    planner.record_reading('dev0', None, now=100)
+    deadline = planner.next_deadline()
+    planner.record_setpoint('dev0', now=101)
+    assert planner.next_deadline() == deadline
+
+@pytest.fixture
+def manager_options():
+    return {'devices': 2, 'adaptive_polling': True, 'min_poll_interval': 10, 'breaker_failures': 0}
+
+
+def test_raising_poll_keeps_device_scheduled(manager, monkeypatch):
+    def poll(self, mqtt, probe=False):
+        raise RuntimeError("adapter gone")
+
+    monkeypatch.setattr(DummyDevice, 'poll', poll)
+    manager._poll_due_devices()
+    scheduler = manager._poll_scheduler
+    assert scheduler.next_deadline() is not None
+    assert sorted(scheduler.pop_due(now=1e12)) == sorted(manager._devices.keys())
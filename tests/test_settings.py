@@ -0,0 +1,81 @@
+import time
+
+import pytest
+
+from etrv2mqtt.devices import CircuitBreaker
+from etrv2mqtt.settings import validate
+from tests.dummyDevice import DummyDevice
+
+
+def test_validate_converts_values():
+    assert validate({'temperature_min': 10, 'vacation_from': 1.0}) == \
+        {'temperature_min': 10.0, 'vacation_from': 1}
+
+
+@pytest.mark.parametrize('document', [
+    {'temperature_min': 10.2},
+    {'temperature_min': float('inf')},
+    {'temperature_max': float('nan')},
+    {'vacation_from': float('inf')},
+    {'lock_control': 1},
+    {'schedule_mode': 'auto'},
+    {'schedule': []},
+    [],
+])
+def test_validate_rejects_invalid(document):
+    with pytest.raises(ValueError):
+        validate(document)
+
+
+@pytest.fixture
+def manager_options():
+    return {'breaker_failures': 1, 'breaker_backoff': 1, 'breaker_max_backoff': 60}
+
+
+@pytest.fixture
+def results(manager, monkeypatch):
+    """(status, error) of every settings result published by manager"""
+    results = []
+    monkeypatch.setattr(manager, '_publish_settings_result',
+                        lambda name, status, requested, settings=None, error=None:
+                        results.append((status, error)))
+    return results
+
+
+def open_breaker(manager) -> CircuitBreaker:
+    # failed long enough ago for the next write to be a probe
+    breaker = manager._breakers['dev0']
+    breaker.record(False, now=time.monotonic() - 10)
+    return breaker
+
+
+def test_infinite_value_is_reported_invalid(manager, results):
+    manager._settings_request('dev0', b'{"temperature_min": Infinity}', False)
+    assert results == [('invalid', 'temperature_min must be a finite number')]
+
+
+def test_write_closes_open_breaker(manager, results):
+    breaker = open_breaker(manager)
+    manager._settings_request('dev0', b'{"lock_control": true}', False)
+    manager._run_pending_settings()
+    assert results == [('pending', None), ('applied', None)]
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_failed_write_reopens_breaker(manager, results, monkeypatch):
+    breaker = open_breaker(manager)
+    monkeypatch.setattr(DummyDevice, 'unreachable', {'dev0'})
+    manager._settings_request('dev0', b'{"lock_control": true}', False)
+    manager._run_pending_settings()
+    assert results[-1] == ('failed', None)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_rejected_value_is_reported(manager, results, monkeypatch):
+    def apply_settings(self, settings, probe=False):
+        raise OverflowError("temperature_max out of range")
+
+    monkeypatch.setattr(DummyDevice, 'apply_settings', apply_settings)
+    manager._settings_request('dev0', b'{"temperature_max": 1000}', False)
+    manager._run_pending_settings()
+    assert results[-1] == ('failed', "temperature_max out of range")
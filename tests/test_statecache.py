@@ -0,0 +1,40 @@
+from datetime import datetime
+from typing import Optional
+
+from etrv2mqtt.etrvutils import eTRVData
+from etrv2mqtt.statecache import StateChangeCache
+
+
+def reading(room_temp: Optional[float] = 21, battery: Optional[int] = 90) -> eTRVData:
+    return eTRVData('dev', battery, room_temp, 21, datetime.now())
+
+
+def cache() -> StateChangeCache:
+    return StateChangeCache(0.5, 5, 600)
+
+
+def test_small_changes_are_not_published():
+    state = cache()
+    assert state.update('dev', reading(), now=0)
+    assert not state.update('dev', reading(room_temp=21.5, battery=86), now=1)
+    assert state.update('dev', reading(room_temp=22), now=2)
+
+
+def test_published_after_max_silence():
+    state = cache()
+    state.update('dev', reading(), now=0)
+    assert state.update('dev', reading(), now=600)
+
+
+def test_battery_change_without_room_temperature():
+    state = cache()
+    assert state.update('dev', reading(room_temp=None, battery=90), now=0)
+    assert not state.update('dev', reading(room_temp=None, battery=88), now=1)
+    assert state.update('dev', reading(room_temp=None, battery=10), now=2)
+
+
+def test_room_temperature_appearing_is_published():
+    state = cache()
+    state.update('dev', reading(room_temp=None), now=0)
+    assert state.update('dev', reading(), now=1)
+    assert state.update('dev', reading(room_temp=None), now=2)
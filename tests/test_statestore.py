@@ -0,0 +1,27 @@
+import os
+from datetime import datetime
+
+from etrv2mqtt.etrvutils import eTRVData
+from etrv2mqtt.statestore import StateStore
+
+
+def test_pending_setpoints_are_replayed_after_restart(tmp_path):
+    path = str(tmp_path / 'state.db')
+    store = StateStore(path, 0)
+    store.record_setpoint('dev0', 21.5)
+    store.record_setpoint('dev1', 18)
+    store.setpoint_written('dev1', 18)
+    store.flush()
+
+    assert StateStore(path, 0).load_setpoints() == {'dev0': 21.5}
+
+
+def test_close_checkpoints_write_ahead_log(tmp_path):
+    path = str(tmp_path / 'state.db')
+    store = StateStore(path, 0)
+    reading = eTRVData('Living room', 99, 20.5, 21.0, datetime(2020, 1, 1, 12))
+    store.record_reading('dev0', reading)
+    store.close()
+
+    assert not os.path.exists(path + '-wal')
+    assert StateStore(path, 0).load_readings()['dev0'].room_temp == 20.5
@@ -0,0 +1,23 @@
+from etrv2mqtt.config import _SimulationConfig
+from etrv2mqtt.etrvutils import eTRVUtils
+from etrv2mqtt.transport import SimulatedTransport
+
+
+def simulated_device():
+    transport = SimulatedTransport(_SimulationConfig(
+        connect_latency=0, operation_latency=0, latency_jitter=0, connect_failure_rate=0,
+        drop_rate=0, adapter_slots=1, battery_drain=0, seed=0))
+    device = transport.create_device('00:00:00:00:00:01', bytes(16))
+    device.connect()
+    return device
+
+
+def test_settings_round_trip():
+    device = simulated_device()
+    current = eTRVUtils.read_settings(device)
+    assert current['vacation_from'] == 0
+
+    settings = {'vacation_from': 86400, 'vacation_to': 0,
+                'schedule_mode': 'vacation', 'name': 'Kitchen'}
+    eTRVUtils.write_settings(device, current, settings)
+    assert eTRVUtils.read_settings(device) == dict(current, **settings)